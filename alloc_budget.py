@@ -0,0 +1,254 @@
+import gc
+import yaml
+import numpy as np
+import json, time
+import os, sys, shutil, tempfile
+import config, logutil
+from shared import SharedControl
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+logger = logutil.get_logger('alloc_budget')
+
+class StageCounts(object):
+    """
+    Stands in for SharedControl.timings: at each mark, records the allocation
+    counters instead of the time. Counts go into preallocated lists of ints
+    (which the collector does not track), so the probe adds no objects of its
+    own; probe_overhead() measures what it does add.
+    """
+    def __init__(self, size=16):
+        self.stages = [None]*size
+        self.objects = [0]*size
+        self.bytes = [0]*size
+        self.n = 0
+
+    def reset(self):
+        self.n = 0
+
+    def mark(self, stage):
+        self.stages[self.n] = stage
+        self.objects[self.n] = gc.get_count()[0]
+        self.bytes[self.n] = tracemalloc.get_traced_memory()[0] if tracing() else 0
+        self.n += 1
+
+def tracing():
+    return tracemalloc is not None and tracemalloc.is_tracing()
+
+def probe_overhead(shared, probe, marks=1000):
+    """
+    Generation 0 growth per SharedControl.mark call with probe attached, which
+    measure() takes off every stage
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    shared.timings = probe
+    total = 0
+    try:
+        for k in range(marks):
+            probe.reset()
+            before = gc.get_count()[0]
+            shared.mark("probe")
+            total += gc.get_count()[0]-before
+    finally:
+        shared.timings = None
+        if enabled:
+            gc.enable()
+    return total/float(marks)
+
+def measure(shared, frames, warmup=200):
+    """
+    Runs shared.update over frames (sensor dicts) and measures, per frame and
+    per stage of update (see SharedControl.mark):
+        gc_objects: the growth of the collector's generation 0 count, i.e.
+            container objects allocated and not freed within the frame; this
+            is what triggers collections
+        cyclic_garbage: the unreachable objects the collector finds afterwards
+            (e.g. the per-transition classes fysom creates)
+        bytes: net bytes allocated, when tracemalloc is available (otherwise None)
+    The first warmup frames fill the caches and are not measured. Returns a
+    dict of per-frame means, with the same measures per stage under 'stages'.
+    A stage is charged for the objects still alive when it ends, e.g. the
+    events infer returns; their release shows up in a later stage, often as
+    a negative count under 'return'.
+    """
+    for sensor_dict in frames[:warmup]:
+        shared.update(sensor_dict)
+    frames = frames[warmup:]
+    probe = StageCounts()
+    overhead = probe_overhead(shared, probe)
+    stage_objects = {}
+    stage_bytes = {}
+
+    enabled = gc.isenabled()
+    gc.collect()
+    gc.disable()
+    shared.timings = probe
+    total_objects = total_bytes = 0
+    start = time.time()
+    try:
+        for sensor_dict in frames:
+            probe.reset()
+            objects_before = gc.get_count()[0]
+            bytes_before = tracemalloc.get_traced_memory()[0] if tracing() else 0
+            shared.update(sensor_dict)
+            probe.mark("return")
+            last_objects, last_bytes = objects_before, bytes_before
+            for k in range(probe.n):
+                stage = probe.stages[k]
+                stage_objects[stage] = stage_objects.get(stage, 0) + probe.objects[k]-last_objects-overhead
+                stage_bytes[stage] = stage_bytes.get(stage, 0) + probe.bytes[k]-last_bytes
+                last_objects, last_bytes = probe.objects[k], probe.bytes[k]
+            total_objects += last_objects-objects_before-overhead*probe.n
+            total_bytes += last_bytes-bytes_before
+        elapsed = time.time()-start
+        collect_start = time.time()
+        garbage = gc.collect()
+        collect_time = time.time()-collect_start
+    finally:
+        shared.timings = None
+        if enabled:
+            gc.enable()
+
+    n = float(max(len(frames), 1))
+    traced = tracing()
+    return {'frames': len(frames),
+            'frame_time': elapsed/n,
+            'gc_objects': total_objects/n,
+            'cyclic_garbage': garbage/n,
+            'bytes': total_bytes/n if traced else None,
+            # how often generation 0 would be collected, and what one collection of it costs
+            'collections_per_1000_frames': 1000*total_objects/n/gc.get_threshold()[0],
+            'collect_time': collect_time,
+            'probe_overhead': overhead,
+            'stages': dict((stage, {'gc_objects': stage_objects[stage]/n,
+                                    'bytes': stage_bytes[stage]/n if traced else None})
+                           for stage in stage_objects)}
+
+def check(result, budgets):
+    """
+    Compares a measure() result with budgets: {measure: limit} for the whole
+    frame, and {stage: {measure: limit}} per stage. Returns the violations as
+    (where, measure, value, limit); measures that were not taken are skipped.
+    """
+    violations = []
+    for key, limit in budgets.iteritems():
+        if isinstance(limit, dict):
+            stage = result['stages'].get(key, {})
+            for measure, stage_limit in limit.iteritems():
+                value = stage.get(measure)
+                if value is not None and value>stage_limit:
+                    violations.append((key, measure, value, stage_limit))
+        else:
+            value = result.get(key)
+            if value is not None and value>limit:
+                violations.append(('frame', key, value, limit))
+    return violations
+
+def random_frames(shared, n, seed=0):
+    """
+    n sensor dicts with every sensor of the model uniform in [0, 1]
+    """
+    rng = np.random.RandomState(seed)
+    sensors = sorted(shared.sensor_encoder.compile().slots)
+    values = rng.rand(n, len(sensors))
+    return [dict(zip(sensors, row)) for row in values.tolist()]
+
+def generate_model(path, sensors=16, inferred=8, fsms=4, parents=3, seed=0):
+    """
+    Writes a synthetic model to path: one threshold-encoded sensor_input per
+    sensor, noisy-OR inferred nodes over random sensors and an FSM state, and
+    two-state FSMs toggled by start and stop outputs, so random sensor input
+    keeps the FSMs moving.
+    """
+    rng = np.random.RandomState(seed)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    encoder = {}
+    nodes = {}
+    for i in range(sensors):
+        encoder["s%d" % i] = [{"node": "s%d_high" % i, "type": "threshold", "params": {"threshold": 0.5}}]
+        nodes["s%d_high" % i] = {"type": "sensor_input"}
+
+    machines = {}
+    for j in range(fsms):
+        machines["f%d" % j] = {"initial": "idle",
+                               "events": {"start": {"src": "idle", "dst": "active", "after": "f%d_started" % j},
+                                          "stop": {"src": "active", "dst": "idle", "after": "f%d_stopped" % j}}}
+        nodes["f%d/idle" % j] = {"type": "fsm_input"}
+
+    for k in range(inferred):
+        inputs = ["s%d_high" % i for i in rng.choice(sensors, min(parents, sensors), replace=False)]
+        nodes["i%d" % k] = {"type": "inferred", "cpt": "noisy_or", "leak": 0.01,
+                            "parents": inputs + ["f%d/idle" % (k % fsms)],
+                            "p": [float(p) for p in rng.uniform(0.5, 0.9, len(inputs)+1)]}
+    for k in range(inferred):
+        j = k % fsms
+        event = "start" if (k // fsms) % 2==0 else "stop"
+        nodes["send_%d" % k] = {"type": "output", "query": ["i%d" % k],
+                                "event": {"fsm": "f%d" % j, "event": event, "logp": -1.0}}
+
+    for fname, spec in [("encoder.yaml", encoder), ("fsms.yaml", machines), ("bayes_net.yaml", nodes)]:
+        with open(os.path.join(path, fname), "w") as f:
+            yaml.safe_dump(spec, f, default_flow_style=False)
+    return path
+
+def budgets_for(name, engine, budgets=None):
+    """
+    The budgets for a model under an engine, from budgets (default
+    config.ALLOC_BUDGETS) keyed by "<name>/<engine>" or else by name;
+    None if the model has none
+    """
+    budgets = config.ALLOC_BUDGETS if budgets is None else budgets
+    return budgets.get("%s/%s" % (name, engine), budgets.get(name))
+
+def run(model_dir, engine="exact", frames=2000, budgets=None, name=None, **engine_options):
+    """
+    Measures a model's update and checks it against its budgets (see
+    budgets_for; name defaults to the model directory's name); logs the
+    result as an alloc_budget record, and each violation as
+    alloc_budget_exceeded. Returns (result, violations), violations being
+    None if the model has no budgets.
+    """
+    name = os.path.basename(os.path.normpath(model_dir)) if name is None else name
+    shared = SharedControl(model_dir, engine, **engine_options)
+    result = measure(shared, random_frames(shared, frames))
+    limits = budgets_for(name, engine, budgets)
+    violations = None if limits is None else check(result, limits)
+    logger.info(json.dumps(dict(result, type='alloc_budget', model=name, engine=engine)))
+    for where, measure_name, value, limit in violations or []:
+        logger.warn(json.dumps({'type': 'alloc_budget_exceeded', 'model': name, 'engine': engine,
+                                'stage': where, 'measure': measure_name, 'value': value, 'limit': limit}))
+    return result, violations
+
+if __name__=="__main__":
+    # allocation budgets of the demo model and a generated one, per engine;
+    # exits with status 1 if any budget is exceeded
+    if tracemalloc is not None:
+        tracemalloc.start()
+    generated = tempfile.mkdtemp(prefix='shared_control_model_')
+    failed = False
+    try:
+        generate_model(generated)
+        # exact inference on the generated model takes seconds per frame
+        runs = [(sys.argv[1] if len(sys.argv)>1 else "demo_model", None, ["exact", "tables", "loopy_bp"]),
+                (generated, "generated", ["tables", "loopy_bp"])]
+        for model_dir, name, engines in runs:
+            for engine in engines:
+                result, violations = run(model_dir, engine, name=name)
+                print('%-12s %-8s %.2f gc objects/frame, %.2f cyclic garbage/frame, %.2f ms/frame' % (
+                    name or os.path.basename(model_dir), engine, result['gc_objects'],
+                    result['cyclic_garbage'], 1000*result['frame_time']))
+                print('    stages: %s' % ", ".join(["%s %.2f" % (stage, values['gc_objects'])
+                                                    for stage, values in sorted(result['stages'].items())]))
+                if violations is None:
+                    print('    no budgets for this model')
+                for where, measure_name, value, limit in violations or []:
+                    print('    OVER BUDGET: %s %s %.2f > %s' % (where, measure_name, value, limit))
+                    failed = True
+    finally:
+        shutil.rmtree(generated, ignore_errors=True)
+    sys.exit(1 if failed else 0)
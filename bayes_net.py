@@ -8,11 +8,25 @@ from collections import defaultdict
 import pydot
 import pprint
 import numpy as np
+import copy
 import os, sys, json
 import config, logutil
+import sampling, loopy_bp, posterior_tables
 
 logger = logutil.get_logger('BAYES')
 
+# largest number of parents a parametric CPT may be expanded to a full table for
+MAX_TABLE_PARENTS = 16
+
+# inference engines selectable with BayesNet(..., engine=<name>), besides libpgm's "exact"
+ENGINES = {"sampling": sampling.LikelihoodWeighting,
+           "loopy_bp": loopy_bp.LoopyBP,
+           "tables": posterior_tables.PosteriorTables}
+
+# CPT storage, BayesNet(..., storage=<name>): element type of the stored tables.
+# "log" keeps float32 log p and log 1-p, for deep networks where products underflow
+STORAGE = {"float64": np.float64, "float32": np.float32, "log": np.float32}
+
 def normalise_name(n):
     if n.startswith('~'):
         return n[1:]
@@ -38,6 +52,25 @@ def parse_truth_table(truth_table, parents):
         cond_table[cond_def] = [prob, 1.0-prob]
     return cond_table
     
+def make_cpt_array(truth_table, parents):
+    """
+    Converts a truth table into an array of p(node=T | parents), with one
+    axis per parent, indexed 1 for true and 0 for false
+    """
+    table = np.empty((2,)*len(parents))
+    table.fill(np.nan)
+    for row, prob in truth_table.iteritems():
+        index = []
+        for i,p in enumerate(parents):
+            on_true = row[i]=='t'
+            if is_negated(p):
+                on_true = not on_true
+            index.append(1 if on_true else 0)
+        table[tuple(index)] = prob
+    if np.any(np.isnan(table)):
+        raise ValueError("Truth table does not cover every combination of %s" % ", ".join(parents))
+    return table
+
 def make_node(truth_table, parents, node_type):
     pgm_node = {}
     pgm_node["numoutcomes"] = 2
@@ -47,16 +80,348 @@ def make_node(truth_table, parents, node_type):
     pgm_node["type"] = node_type
     return pgm_node
 
-    
+def table_to_cprob(table):
+    """
+    Converts an array of p(node=T | parents) into a libpgm cprob dict
+    """
+    cprob = {}
+    for index in np.ndindex(*table.shape):
+        cond_def = "[%s]" % ", ".join(["'T'" if v else "'F'" for v in index])
+        p = float(table[index])
+        cprob[cond_def] = [p, 1.0-p]
+    return cprob
+
+def parent_grid(k):
+    """
+    Every assignment of k parents, as a (k, 2**k) array in table order
+    """
+    if k>MAX_TABLE_PARENTS:
+        raise ValueError("Cannot expand a CPT with %d parents into a table (limit %d)" % (k, MAX_TABLE_PARENTS))
+    return np.indices((2,)*k).reshape(k, -1).astype(np.uint8)
+
+
+class TableCPT(object):
+    """
+    Full conditional probability table, as listed in the p: block, stored as
+    a contiguous array in one of the STORAGE types
+    """
+    def __init__(self, table, storage="float64"):
+        if storage not in STORAGE:
+            raise ValueError("Unknown CPT storage %s" % storage)
+        self.storage = storage
+        if storage=="log":
+            with np.errstate(divide="ignore"):
+                self.logp = np.log(table).astype(np.float32)
+                self.log1mp = np.log1p(-table).astype(np.float32)
+        else:
+            self.p = table.astype(STORAGE[storage])
+
+    def p_true(self, parent_values):
+        """
+        p(node=T) for each column of a (k, n) array of parent values
+        """
+        if self.storage=="log":
+            return np.exp(self.logp[tuple(parent_values)])
+        return self.p[tuple(parent_values)]
+
+    def log_p(self, parent_values, value):
+        """
+        log p(node=value) for each column of a (k, n) array of parent values
+        """
+        if self.storage=="log":
+            return (self.logp if value else self.log1mp)[tuple(parent_values)]
+        p = self.p[tuple(parent_values)]
+        with np.errstate(divide="ignore"):
+            return np.log(p) if value else np.log1p(-p)
+
+    def table(self):
+        if self.storage=="log":
+            return np.exp(self.logp.astype(float))
+        return self.p
+
+    def factors(self, scope, new_variable):
+        """
+        Factors over (parents..., node) equivalent to this CPT, as (scope, table) pairs
+        """
+        p = self.table()
+        table = np.empty(p.shape+(2,))
+        table[..., 1] = p
+        table[..., 0] = 1-p
+        return [(scope, table)]
+
+
+class NoisyOrCPT(object):
+    """
+    Noisy-OR: each true parent literal independently makes the node true with
+    probability p[i]; leak is the probability it is true with no cause
+    """
+    def __init__(self, p, leak, negated):
+        self.p = np.array(p, dtype=float)
+        self.leak = leak
+        self.negated = np.array(negated, dtype=np.uint8)
+
+    def p_true(self, parent_values):
+        literals = parent_values ^ self.negated[:, None]
+        inhibited = np.where(literals, 1-self.p[:, None], 1.0)
+        return 1 - (1-self.leak)*np.prod(inhibited, axis=0)
+
+    def log_p(self, parent_values, value):
+        literals = parent_values ^ self.negated[:, None]
+        with np.errstate(divide="ignore"):
+            # log p(F) is a sum; p(T) is its complement
+            log_false = np.log1p(-self.leak) + np.sum(np.where(literals, np.log1p(-self.p[:, None]), 0.0), axis=0)
+            return np.log(-np.expm1(log_false)) if value else log_false
+
+    def table(self):
+        k = len(self.p)
+        return self.p_true(parent_grid(k)).reshape((2,)*k)
+
+    def factors(self, scope, new_variable):
+        """
+        A leak factor and a chain of three-way factors, one per parent, each
+        true if the previous link is true or its own parent causes it;
+        the last link is the node itself
+        """
+        parents, node = scope[:-1], scope[-1]
+        if len(parents)==0:
+            return [([node], np.array([1-self.leak, self.leak]))]
+        state = new_variable()
+        factors = [([state], np.array([1-self.leak, self.leak]))]
+        for j, parent in enumerate(parents):
+            link = node if j==len(parents)-1 else new_variable()
+            factors.append(([state, parent, link], noisy_or_link(self.p[j], self.negated[j])))
+            state = link
+        return factors
+
+
+class LogisticCPT(object):
+    """
+    Logistic: p(node=T) = sigmoid(bias + sum of the weights of the true parent literals)
+    """
+    def __init__(self, weights, bias, negated):
+        self.weights = np.array(weights, dtype=float)
+        self.bias = bias
+        self.negated = np.array(negated, dtype=np.uint8)
+
+    def p_true(self, parent_values):
+        literals = parent_values ^ self.negated[:, None]
+        return 1 / (1+np.exp(-(self.bias + np.dot(self.weights, literals))))
+
+    def log_p(self, parent_values, value):
+        literals = parent_values ^ self.negated[:, None]
+        z = self.bias + np.dot(self.weights, literals)
+        # log sigmoid(z) and log sigmoid(-z), without underflow
+        return -np.logaddexp(0, -z if value else z)
+
+    def table(self):
+        k = len(self.weights)
+        return self.p_true(parent_grid(k)).reshape((2,)*k)
+
+    def factors(self, scope, new_variable):
+        # no exact decomposition; expanded to a single table factor
+        return TableCPT(self.table()).factors(scope, new_variable)
+
+
+def noisy_or_link(p, negated):
+    """
+    Table over (previous link, parent, link) for one step of a noisy-OR chain
+    """
+    link = np.zeros((2, 2, 2))
+    link[1, :, 1] = 1.0
+    link[0, 0 if negated else 1, 1] = p
+    link[0, :, 0] = 1-link[0, :, 1]
+    return link
+
+def make_cpt(node_spec, storage="float64"):
+    """
+    Builds the CPT object for an inferred node, from its cpt: type
+    (table, noisy_or or logistic)
+    """
+    parents = node_spec["parents"]
+    negated = [is_negated(p) for p in parents]
+    cpt_type = node_spec.get("cpt", "table")
+    if cpt_type=="table":
+        return TableCPT(make_cpt_array(node_spec["p"], parents), storage)
+    if cpt_type=="noisy_or":
+        params = node_spec["p"]
+        cpt = NoisyOrCPT(params, node_spec.get("leak", 0.0), negated)
+    elif cpt_type=="logistic":
+        params = node_spec["weights"]
+        cpt = LogisticCPT(params, node_spec.get("bias", 0.0), negated)
+    else:
+        raise ValueError("Unknown CPT type %s" % cpt_type)
+    if len(params)!=len(parents):
+        raise ValueError("%s CPT needs one parameter per parent (%s)" % (cpt_type, ", ".join(parents)))
+    return cpt
+
+def noisy_or_nodes(name, parents, cpt):
+    """
+    libpgm nodes for a noisy-OR node, decomposed as in NoisyOrCPT.factors so that no
+    table has more than two parents. The chain nodes are proxies and are not drawn.
+    Returns a dict of node name -> libpgm node
+    """
+    if len(parents)==0:
+        return {name: make_node([cpt.leak, 1-cpt.leak], None, "inferred")}
+    state = "_leak_%s" % name
+    nodes = {state: make_node([cpt.leak, 1-cpt.leak], None, "proxy")}
+    for j, parent in enumerate(parents):
+        if j==len(parents)-1:
+            link, link_type = name, "inferred"
+        else:
+            link, link_type = "_noisy_or_%s_%d" % (name, j), "proxy"
+        nodes[link] = make_node(table_to_cprob(noisy_or_link(cpt.p[j], cpt.negated[j])[..., 1]), [state, parent], link_type)
+        state = link
+    return nodes
+
+
+class CompiledNet(object):
+    """
+    Array form of a BayesNet for the NumPy inference engines.
+    Nodes are stored in topological order (proxy nodes are dropped; the
+    sensor probabilities are applied directly to the sensor_input nodes).
+    """
+    def __init__(self, specs, order, outputs, cpts, temporal=()):
+        self.names = list(order)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        self.types = [specs[name]["type"] for name in self.names]
+        self.parents = []
+        self.cpts = []
+        for name in self.names:
+            spec = specs[name]
+            if spec["type"]=="inferred":
+                parents = spec["parents"]
+                self.parents.append(np.array([self.index[normalise_name(p)] for p in parents], dtype=np.intp))
+                self.cpts.append(cpts[name])
+            else:
+                self.parents.append(np.zeros(0, dtype=np.intp))
+                self.cpts.append(None)
+
+        self.outputs = []
+        for name, output in outputs.iteritems():
+            ev = output["event"]
+            query = []
+            for q in output["query"]:
+                query.append((self.index[normalise_name(q)], 0 if is_negated(q) else 1))
+            self.outputs.append({"name":name, "query":query, "threshold":1-np.exp(ev["logp"])})
+        # beliefs of temporal nodes are queried like outputs, but fire nothing
+        for name in temporal:
+            self.outputs.append({"name":belief_name(name), "query":[(self.index[name], 1)], "threshold":None})
+
+    def root_prob(self, i, sensor_evidence, fsm_evidence):
+        """
+        Probability that root node i is true. Unobserved sensors are uninformative;
+        unobserved FSM inputs are true, as in the libpgm model.
+        """
+        name = self.names[i]
+        if self.types[i]=="sensor_input":
+            return sensor_evidence.get(name, 0.5)
+        return 0.0 if fsm_evidence.get(name, "T")=="F" else 1.0
+
+    def ancestors(self, nodes):
+        """
+        Sorted indices of the given nodes and all of their ancestors
+        """
+        found = set()
+        stack = list(nodes)
+        while stack:
+            i = stack.pop()
+            if i not in found:
+                found.add(i)
+                stack.extend(self.parents[i])
+        return sorted(found)
+
+    def conditioning(self, nodes):
+        """
+        Names of the observable nodes (all but the sensor and fsm inputs) that
+        share an ancestor with any of nodes, so that observing them conditions
+        nodes: their probability is then a ratio, no longer multilinear in the
+        sensor probabilities
+        """
+        relevant = set(self.ancestors(nodes))
+        return [name for i, name in enumerate(self.names)
+                if self.types[i] not in ("sensor_input", "fsm_input") and relevant & set(self.ancestors([i]))]
+
+
+def expand_temporal(nodes):
+    """
+    Rewrites each temporal node as an inferred node whose first parent is a
+    sensor_input node _prev_<name>, which is given the node's belief from the
+    last frame. Returns (specs, {name: previous node}, {name: initial belief})
+    """
+    specs = dict(nodes)
+    temporal = {}
+    initial = {}
+    for name, spec in nodes.iteritems():
+        if spec["type"]=="temporal":
+            previous = "_prev_%s" % name
+            specs[name] = dict(spec, type="inferred", parents=[previous] + list(spec.get("parents") or []))
+            specs[previous] = {"type": "sensor_input"}
+            temporal[name] = previous
+            initial[name] = float(spec.get("initial", 0.0))
+    return specs, temporal, initial
+
+def belief_name(name):
+    """
+    The engine query for a temporal node's belief
+    """
+    return "_belief_%s" % name
+
+def deep_sizeof(obj, seen=None):
+    """
+    Approximate bytes held by obj and the containers and arrays it refers to
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, np.ndarray):
+        # a view's data belongs to its base
+        return size if obj.base is not None else max(size, obj.nbytes)
+    if isinstance(obj, dict):
+        for k, v in obj.iteritems():
+            size += deep_sizeof(k, seen) + deep_sizeof(v, seen)
+    elif isinstance(obj, (list, tuple, set)):
+        for v in obj:
+            size += deep_sizeof(v, seen)
+    elif hasattr(obj, "__dict__"):
+        size += deep_sizeof(obj.__dict__, seen)
+    return size
+
+def fires(lower, logp, caution=0.0):
+    """
+    True if the lower bound on p(query) clears the output's threshold
+    1-exp(logp) by caution, compared in log space as log(1-lower) < logp,
+    which still works when the threshold rounds to 1
+    """
+    with np.errstate(divide="ignore"):
+        if caution:
+            logp = np.log(max(np.exp(logp)-caution, 0.0))
+        return np.log1p(-min(lower, 1.0)) < logp
 
 class BayesNet(object):
-    def __init__(self, nodes):
-        
+    def __init__(self, nodes, engine="exact", storage="float64", early_exit=True, **engine_options):
+        """
+        storage selects how CPT tables are held (see STORAGE). With compact
+        storage libpgm's own tables, Python lists of floats, are only built if
+        libpgm is actually used for inference.
+        early_exit skips outputs whose event provably cannot change this frame
+        (see skippable); it only applies to the exact engines, "exact" and "tables".
+        """
+        self.storage = storage
+        # temporal nodes: their previous-frame nodes, and the belief state
+        # p(node=T) carried from one frame to the next (a forward filter);
+        # per session, like the rest of the state in snapshot() (see fork)
+        nodes, self.temporal, self.initial_belief = expand_temporal(nodes)
+        self.belief = dict(self.initial_belief)
+
         self.nodes = {}
         
         self.children = defaultdict(list)
         self.parents = defaultdict(list)
         self.outputs = {}
+        self.cpts = {}
         for name, node_spec in nodes.iteritems():
             node_type = node_spec["type"]
             if node_type=="inferred":
@@ -66,9 +431,18 @@ class BayesNet(object):
                     normalised = normalise_name(parent)
                     self.parents[name].append(normalised)
                     self.children[normalised].append(name)
-                truth_table = parse_truth_table(node_spec["p"], parents)
-                node = make_node(truth_table, parents, node_type)
-                self.nodes[name] = node
+                cpt = self.cpts[name] = make_cpt(node_spec, storage)
+                if isinstance(cpt, NoisyOrCPT):
+                    self.nodes.update(noisy_or_nodes(name, self.parents[name], cpt))
+                else:
+                    if storage!="float64":
+                        # filled in by pgm_tables() when first needed
+                        truth_table = None
+                    elif isinstance(cpt, TableCPT):
+                        truth_table = parse_truth_table(node_spec["p"], parents)
+                    else:
+                        truth_table = table_to_cprob(cpt.table())
+                    self.nodes[name] = make_node(truth_table, self.parents[name], node_type)
                 
             if node_type=="fsm_input":
                 node = make_node([1.0, 0.0], None, node_type)
@@ -84,71 +458,254 @@ class BayesNet(object):
             if node_type=="output":
                 self.outputs[name] = node_spec
             
+        # libpgm's edges follow its own parents, which include the proxy and noisy-OR chain nodes
+        pgm_children = defaultdict(list)
+        for name, node in self.nodes.iteritems():
+            for parent in node["parents"] or []:
+                pgm_children[parent].append(name)
+
         for node in self.nodes:
-            if len(self.children[node])>0:
-                self.nodes[node]["children"] = self.children[node]
+            if len(pgm_children[node])>0:
+                self.nodes[node]["children"] = pgm_children[node]
             else:
                 self.nodes[node]["children"] = None
                 
         # certainty scaling
         self.event_caution = 0.0
+        # output name -> probability at the last infer(); for the outputs in
+        # stale, early exit skipped them and it is from their last full evaluation,
+        # off by at most stale[name]
+        self.last_probs = {}
+        self.stale = {}
         
         og = OrderedSkeleton()
         og.V = self.nodes.keys()
         edges = []
-        for k,children in self.children.iteritems():
+        for k,children in pgm_children.iteritems():
             for child in children:
                 edges.append((k, child))
         
         og.E = edges
         og.toporder()
-             
+
         nd = NodeData()
         nd.Vdata = self.nodes
-        
+
         #logging.debug(pprint.pformat(nd.Vdata))
-        
+
         self.net = DiscreteBayesianNetwork(og, nd)
-        self.factor_net = TableCPDFactorization(self.net)
-        
-    def infer(self, sensor_evidence, fsm_evidence):
-        # sensor values are always True; their proxy nodes encode the real probability
-        evidence = dict(fsm_evidence)
-        evidence.update({k:"T" for k in sensor_evidence})
-        
-        # update probability of proxy nodes
-        for sensor,p in sensor_evidence.iteritems():
-            self.net.Vdata[sensor]["cprob"] = {"['T']":[p, 1-p], "['F']":[(1-p),p]}
-                
+        if storage=="float64":
+            self.factor_net = TableCPDFactorization(self.net)
+
+        # topological order from the skeleton, without the proxy nodes
+        self.order = [v for v in og.V if self.nodes[v]["type"]!="proxy"]
+        self.fsm_inputs = [v for v in self.order if self.nodes[v]["type"]=="fsm_input"]
+        self.compiled = CompiledNet(nodes, self.order, self.outputs, self.cpts, self.temporal)
+        # query per output or belief, for libpgm
+        self.queries = dict((name, output["query"]) for name, output in self.outputs.iteritems())
+        for name in self.temporal:
+            self.queries[belief_name(name)] = [name]
+
+        # approximate engines run on the compiled net; "exact" uses libpgm
+        if engine=="exact":
+            self.engine = None
+        else:
+            self.engine = ENGINES[engine](self.compiled, **engine_options)
+        logger.info(json.dumps(dict(self.memory(), type='model_memory', storage=storage)))
+
+        # per output: the sensors it depends on and the other nodes whose
+        # evidence it depends on, by index in the compiled net
+        self.early_exit = early_exit and engine in ("exact", "tables")
+        self.dependencies = {}
+        for output in self.compiled.outputs:
+            relevant = self.compiled.ancestors([i for i, value in output["query"]])
+            sensors = [i for i in relevant if self.compiled.types[i]=="sensor_input"]
+            others = [i for i in relevant if self.compiled.types[i]!="sensor_input"]
+            self.dependencies[output["name"]] = (sensors, others)
+        # per output: the nodes whose observation early exit cannot bound
+        self.conditioning = dict((output["name"], self.compiled.conditioning([i for i, value in output["query"]]))
+                                 for output in self.compiled.outputs)
+        # output name -> the evidence, sensor probabilities, sensitivities and
+        # result of its last full evaluation
+        self.reference = {}
+        self.evaluations = 0
+        self.skipped = 0
+
+    def pgm_tables(self):
+        """
+        Builds any libpgm tables left out under compact storage
+        """
+        for name, cpt in self.cpts.iteritems():
+            if self.nodes[name]["cprob"] is None:
+                self.nodes[name]["cprob"] = table_to_cprob(cpt.table())
+
+    def memory(self):
+        """
+        Approximate bytes held by the model: the CPT arrays, libpgm's tables
+        and the inference engine's own arrays
+        """
+        seen = set()
+        cpts = deep_sizeof(self.cpts, seen)
+        pgm = deep_sizeof(self.nodes, seen)
+        engine = 0
+        if self.engine is not None:
+            engine = deep_sizeof(self.engine, seen)
+        return {"cpt_bytes": cpts, "libpgm_bytes": pgm, "engine_bytes": engine,
+                "total_bytes": cpts+pgm+engine}
+
+    def exact_query(self, sensor_evidence, fsm_evidence, names=None):
+        """
+        Exact inference by variable elimination in libpgm, for the named outputs
+        (default all). Returns a dict of output name -> (p, lower, upper), with lower==upper==p
+        """
+        # the proxy nodes are always True, so each sensor node is true with the encoded
+        # probability; fsm_input nodes are clamped to the FSM state rather than observed
+        # (their prior is [1, 0], so observing them False would have zero probability)
+        self.pgm_tables()
+        evidence = {}
+        compiled = self.compiled
+        for i, node in enumerate(compiled.names):
+            p = compiled.root_prob(i, sensor_evidence, fsm_evidence)
+            if compiled.types[i]=="sensor_input":
+                self.net.Vdata[node]["cprob"] = {"['T']":[p, 1-p], "['F']":[(1-p),p]}
+            elif compiled.types[i]=="fsm_input":
+                self.net.Vdata[node]["cprob"] = [p, 1-p]
+            elif node in fsm_evidence:
+                evidence[node] = fsm_evidence[node]
+
         # refactorize
         fn = TableCPDFactorization(self.net)
-        events = []
-        
-        for name,output in self.outputs.iteritems():
+        results = {}
+
+        for name in names or self.outputs:
             fn.refresh()
             query = {}
-            
-            for q in output["query"]:
+
+            for q in self.queries[name]:
                 if is_negated(q):
                    query[normalise_name(q)] = ['F']
                 else:
                     query[normalise_name(q)] = ['T']
-            
-            prob = result = fn.specificquery(query, evidence)
+
+            prob = fn.specificquery(query, evidence)
+            results[name] = (prob, prob, prob)
+        return results
+
+    def evidence_key(self, name, fsm_evidence):
+        sensors, others = self.dependencies[name]
+        return tuple([fsm_evidence.get(self.compiled.names[i]) for i in others])
+
+    def sensor_probs(self, name, sensor_evidence):
+        sensors, others = self.dependencies[name]
+        return np.array([sensor_evidence.get(self.compiled.names[i], 0.5) for i in sensors])
+
+    def conditioned(self, name, fsm_evidence):
+        return any([node in fsm_evidence for node in self.conditioning[name]])
+
+    def skippable(self, sensor_evidence, fsm_evidence):
+        """
+        Outputs whose event decision cannot differ from their last full
+        evaluation. With the evidence on the FSM side unchanged, an output's
+        probability is multilinear in its sensor probabilities, so it can have
+        moved by at most the sum over sensors of sensitivity * change; if that
+        is less than its distance from the threshold, it is still on the same side.
+        Sensitivities come from the posterior tables, or are 1 (the most any
+        single sensor can move a probability) under libpgm. None of this holds
+        for an output conditioned on an observed inferred node (see
+        conditioned), so those are never skipped.
+        Returns {output name: that bound} for the outputs that can be skipped.
+        """
+        skip = {}
+        if not self.early_exit:
+            return skip
+        for name, ref in self.reference.iteritems():
+            if ref["key"]!=self.evidence_key(name, fsm_evidence) or self.conditioned(name, fsm_evidence):
+                continue
+            threshold = 1-np.exp(self.outputs[name]["event"]["logp"])+self.event_caution
+            moved = np.dot(ref["sensitivity"], np.abs(self.sensor_probs(name, sensor_evidence)-ref["probs"]))
+            if moved<abs(ref["result"][1]-threshold):
+                skip[name] = moved
+        return skip
+
+    def set_reference(self, name, result, sensor_evidence, fsm_evidence):
+        sensitivity = None
+        if self.engine is not None:
+            sensitivity = self.engine.sensitivity(name, fsm_evidence)
+        if sensitivity is None:
+            # libpgm, or an output left untabulated: unconditioned, it is
+            # multilinear in the sensors, so 1 bounds each one
+            sensitivity = np.ones(len(self.dependencies[name][0]))
+        self.reference[name] = {"key": self.evidence_key(name, fsm_evidence),
+                                "probs": self.sensor_probs(name, sensor_evidence),
+                                "sensitivity": sensitivity,
+                                "result": result}
+
+    def early_exit_stats(self):
+        return {"evaluations": self.evaluations, "skipped": self.skipped,
+                "skip_fraction": float(self.skipped)/self.evaluations if self.evaluations else 0.0}
+
+    def infer(self, sensor_evidence, fsm_evidence):
+        if self.temporal:
+            # the previous frame's beliefs enter as sensor probabilities
+            sensor_evidence = dict(sensor_evidence)
+            for name, previous in self.temporal.iteritems():
+                sensor_evidence[previous] = self.belief[name]
+        skip = self.skippable(sensor_evidence, fsm_evidence)
+        names = [name for name in self.outputs if name not in skip]
+        queried = names + [belief_name(name) for name in self.temporal]
+        results = dict((name, self.reference[name]["result"]) for name in skip)
+        if self.engine is None:
+            if queried:
+                results.update(self.exact_query(sensor_evidence, fsm_evidence, queried))
+        else:
+            if skip:
+                # only the tables engine skips, and it can query a subset
+                results.update(self.engine.query(sensor_evidence, fsm_evidence, queried))
+            else:
+                results.update(self.engine.query(sensor_evidence, fsm_evidence))
+            logger.info(json.dumps(dict(self.engine.stats(), type='engine_stats')))
+            # engines may leave outputs they cannot handle to libpgm
+            missing = [name for name in queried if name not in results]
+            if missing:
+                results.update(self.exact_query(sensor_evidence, fsm_evidence, missing))
+        if self.temporal:
+            for name in self.temporal:
+                self.belief[name] = results[belief_name(name)][0]
+            logger.info(json.dumps({'type': 'belief', 'value': self.belief}))
+        if self.early_exit:
+            for name in names:
+                if self.conditioned(name, fsm_evidence):
+                    self.reference.pop(name, None)
+                else:
+                    self.set_reference(name, results[name], sensor_evidence, fsm_evidence)
+            self.evaluations += len(self.outputs)
+            self.skipped += len(skip)
+            logger.info(json.dumps(dict(self.early_exit_stats(), type='early_exit_stats')))
+        self.stale = skip
+        events = []
+
+        for name,output in self.outputs.iteritems():
+            prob, lower, upper = results[name]
+            self.last_probs[name] = prob
             ev = output["event"]
-            formatted_query = " AND ".join(query)
+            formatted_query = " AND ".join(normalise_name(q) for q in output["query"])
             # logging.debug("Query p(%s)=%.8f; need p(%s)>%.8f to trigger event %s/%s" % (formatted_query, prob, formatted_query, 1-np.exp(ev["logp"]), ev.get("fsm", None), ev["event"]))
 
             logger.info(json.dumps({ \
                 'type' : 'query',
                 'query' : formatted_query,
                 'value' : '%.8f' % prob,
+                'lower' : '%.8f' % lower,
+                'upper' : '%.8f' % upper,
                 'threshold' : '%.8f' % (1-np.exp(ev['logp'])),
                 'fsm' : ev.get("fsm", None),
-                'event' : ev['event']
+                'event' : ev['event'],
+                # a skipped output's value is from its last full evaluation
+                'stale' : name in skip
             }))
 
-            if prob>(1-np.exp(ev["logp"]))+self.event_caution:
+            # approximate engines only fire once the whole confidence interval clears the threshold
+            if fires(lower, ev["logp"], self.event_caution):
                 #logging.debug("Fired event %s/%s" % (ev.get("fsm", None), ev["event"]))
                 logger.info(json.dumps({'type': 'fire_event', 'fsm': ev.get("fsm", None), 'event': ev['event']}))
 
@@ -158,6 +715,43 @@ class BayesNet(object):
         return events
         
         
+    def snapshot(self):
+        """
+        State carried from one infer() to the next: the last output probabilities
+        and which of them are stale, the temporal beliefs, the early exit
+        references, and the engine's own state if it keeps any
+        """
+        engine = None
+        if self.engine is not None and hasattr(self.engine, "snapshot"):
+            engine = self.engine.snapshot()
+        return {"last_probs": dict(self.last_probs), "stale": dict(self.stale), "engine": engine,
+                "reference": dict(self.reference), "belief": dict(self.belief)}
+
+    def fork(self):
+        """
+        A BayesNet for another session of the same model. The model itself
+        (CPTs, libpgm network, compiled net, posterior tables) is shared; the
+        state carried between frames, everything snapshot() covers, is the
+        new session's own and starts from the initial state.
+        """
+        net = copy.copy(self)
+        net.engine = None if self.engine is None else self.engine.fork()
+        net.last_probs = {}
+        net.stale = {}
+        net.belief = dict(self.initial_belief)
+        net.reference = {}
+        net.evaluations = 0
+        net.skipped = 0
+        return net
+
+    def restore(self, snapshot):
+        self.last_probs = dict(snapshot["last_probs"])
+        self.stale = dict(snapshot.get("stale", {}))
+        self.belief = dict(snapshot.get("belief", self.initial_belief))
+        self.reference = dict(snapshot.get("reference", {}))
+        if snapshot["engine"] is not None:
+            self.engine.restore(snapshot["engine"])
+
     def update_nodes(self, prob_dict):
         for node,p in prob_dict.iteritems():
             vdata = {}
@@ -213,12 +807,36 @@ class BayesNet(object):
             outputs[name] = {"node":bel_node, "fsm":ev["fsm"], "event":ev["event"]}
         return fsm_inputs, sensor_inputs, outputs
     
-def load_bayes_net(yaml_file):
+def load_bayes_net(yaml_file, engine="exact", **engine_options):
     with open(yaml_file) as f:
         bayes_specs = yaml.load(f)
-    bn = BayesNet(bayes_specs)
+    bn = BayesNet(bayes_specs, engine, **engine_options)
     return bn
 
+def check_early_exit(engines=("exact", "tables")):
+    """
+    Checks that early exit does not skip an output conditioned on an observed
+    inferred node: with seen observed, moving the sensor from 0.005 to 0.1
+    moves p(copy) from about 0.33 to 0.92, far more than the sensor moved,
+    and across the event threshold, which the multilinear bound would miss.
+    """
+    nodes = {"sensor": {"type": "sensor_input"},
+             "copy": {"type": "inferred", "parents": ["sensor"], "p": {"t": 0.999, "f": 0.001}},
+             "seen": {"type": "inferred", "parents": ["sensor"], "p": {"t": 0.99, "f": 0.01}},
+             "send": {"type": "output", "query": ["copy"], "event": {"event": "copied", "logp": float(np.log(0.1))}}}
+    evidence = {"seen": "T"}
+    for engine in engines:
+        net, plain = BayesNet(nodes, engine), BayesNet(nodes, engine, early_exit=False)
+        probs = []
+        for p in [0.005, 0.1]:
+            events = net.infer({"sensor": p}, evidence)
+            assert events==plain.infer({"sensor": p}, evidence), engine
+            assert not net.stale, engine
+            probs.append(net.last_probs["send"])
+        assert probs[1]-probs[0]>0.1-0.005 and events, (engine, probs)
+
 if __name__=="__main__":    
     bn = load_bayes_net("demo_model/bayes_net.yaml")
     print(bn.infer({}, {"hand/not_grasping":"F"}))
+    check_early_exit()
+    print("early exit check passed")
@@ -4,3 +4,50 @@ LOG_LEVEL = logging.INFO
 LOG_IP = '127.0.0.1'
 LOG_PORT = 16679
 LOG_TO_STDOUT = False
+
+# per-type policies for the high-rate log records (see logutil.PolicyFilter);
+# types not listed, e.g. fire_event, inferred_event and transition, are always logged.
+# Set to {} to log every record.
+LOG_POLICIES = {
+    'encode': {'policy': 'aggregate', 'key': 'target', 'field': 'p', 'window': 0.5},
+    'query': {'policy': 'delta', 'key': 'query', 'field': 'value', 'delta': 0.02, 'max_interval': 0.5},
+    'sensor_update': {'policy': 'sample', 'every': 100},
+    'engine_stats': {'policy': 'sample', 'every': 100},
+    'early_exit_stats': {'policy': 'sample', 'every': 100},
+    'belief': {'policy': 'sample', 'every': 10},
+    # each fired event is also logged on its own, as inferred_event
+    'inferred_events': {'policy': 'sample', 'every': 100},
+}
+
+# numeric kernel backend (see kernels): "auto" uses numba when it is installed,
+# otherwise NumPy; "numpy" or "numba" to force one
+KERNELS = 'auto'
+
+# latency spike reports (see watchdog), a bounded ring of files
+SPIKE_DIR = 'spike_reports'
+
+# rendered model graphs, keyed by a hash of the model files (see graph_render)
+GRAPH_CACHE_DIR = 'graph_cache'
+
+# allocation budgets per SharedControl.update (see alloc_budget), per model
+# (by directory name, or "<name>/<engine>" for one engine): limits on the
+# per-frame means of gc_objects, cyclic_garbage and (with tracemalloc) bytes,
+# for the whole frame or per stage as {stage: {measure: limit}}.
+# "generated" is alloc_budget.generate_model(); most of its garbage is from
+# fysom, which builds a class per transition.
+ALLOC_BUDGETS = {
+    'demo_model': {
+        'gc_objects': 2,
+        'cyclic_garbage': 0.5,
+        'encode': {'gc_objects': 3},
+        'infer': {'gc_objects': 2},
+        'fsm': {'gc_objects': 2},
+    },
+    'generated': {
+        'gc_objects': 60,
+        'cyclic_garbage': 48,
+        'encode': {'gc_objects': 12},
+        'infer': {'gc_objects': 4},
+        'fsm': {'gc_objects': 52},
+    },
+}
@@ -0,0 +1,135 @@
+import time
+import json
+import logutil
+
+logger = logutil.get_logger('loop')
+
+# what to do when a cycle runs past the next deadline(s)
+SKIP = 'skip'           # drop the missed cycles and wait for the next deadline
+CATCH_UP = 'catchup'    # run the missed cycles back to back (up to max_catch_up)
+DEGRADE = 'degrade'     # run the late cycle at once, on cached inference
+OVERRUN_POLICIES = (SKIP, CATCH_UP, DEGRADE)
+
+class ControlLoop(object):
+    """
+    Runs the sense -> infer -> FSM cycle of a SharedControl at a fixed rate.
+    Cycle k is scheduled at start + k/rate and the loop sleeps until that absolute
+    deadline, so timing errors do not accumulate. Per-cycle jitter (lateness of
+    the start against its deadline), execution time and overruns are recorded;
+    stats() are logged every stats_interval seconds.
+
+    read_sensors() is called at the start of each cycle and returns a sensor dict
+    (or None to skip the update); on_events(events), if given, receives each
+    cycle's output events.
+    """
+    def __init__(self, shared, read_sensors, rate=100.0, overrun_policy=SKIP,
+                 on_events=None, max_catch_up=10, stats_interval=1.0):
+        if overrun_policy not in OVERRUN_POLICIES:
+            raise ValueError("Unknown overrun policy %s" % overrun_policy)
+        self.shared = shared
+        self.read_sensors = read_sensors
+        self.period = 1.0 / rate
+        self.overrun_policy = overrun_policy
+        self.on_events = on_events
+        self.max_catch_up = max_catch_up
+        self.stats_interval = stats_interval
+        self.done = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.cycles = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.degraded = 0
+        self.total_jitter = 0.0
+        self.max_jitter = 0.0
+        self.total_exec = 0.0
+        self.worst_exec = 0.0
+
+    def cycle(self, degraded=False):
+        sensors = self.read_sensors()
+        if sensors is None:
+            return
+        events = self.shared.update(sensors, cached_inference=degraded)
+        if self.on_events is not None:
+            self.on_events(events)
+
+    def run(self, cycles=None):
+        """
+        Runs until stop() is called, or for the given number of cycles
+        """
+        start = time.time()
+        deadline = start
+        next_stats = start + self.stats_interval
+        degrade_next = False
+        n = 0
+
+        while not self.done and (cycles is None or n<cycles):
+            now = time.time()
+            if deadline>now:
+                time.sleep(deadline-now)
+                now = time.time()
+
+            jitter = now-deadline
+            self.total_jitter += jitter
+            self.max_jitter = max(self.max_jitter, jitter)
+
+            degraded = degrade_next
+            degrade_next = False
+            if degraded:
+                self.degraded += 1
+            self.cycle(degraded)
+            end = time.time()
+            n += 1
+            self.cycles += 1
+
+            elapsed = end-now
+            self.total_exec += elapsed
+            self.worst_exec = max(self.worst_exec, elapsed)
+
+            deadline += self.period
+            if end>deadline:
+                self.overruns += 1
+                # whole periods already lost on top of the next one
+                missed = int((end-deadline) / self.period)
+                if self.overrun_policy==CATCH_UP and missed<=self.max_catch_up:
+                    # keep the schedule; the next cycles start immediately
+                    pass
+                elif self.overrun_policy==DEGRADE:
+                    # run the late cycle now, cheaply
+                    self.skipped += missed
+                    deadline += missed*self.period
+                    degrade_next = True
+                else:
+                    # wait for the next deadline still ahead
+                    self.skipped += missed+1
+                    deadline += (missed+1)*self.period
+
+            if end>=next_stats:
+                logger.info(json.dumps(self.stats()))
+                next_stats = end + self.stats_interval
+
+        logger.info(json.dumps(self.stats()))
+
+    def stop(self):
+        self.done = True
+
+    def stats(self):
+        cycles = max(self.cycles, 1)
+        return {'type': 'loop_stats',
+                'rate': 1.0 / self.period,
+                'cycles': self.cycles,
+                'overruns': self.overruns,
+                'skipped': self.skipped,
+                'degraded': self.degraded,
+                'mean_jitter': self.total_jitter / cycles,
+                'max_jitter': self.max_jitter,
+                'mean_exec': self.total_exec / cycles,
+                'worst_exec': self.worst_exec}
+
+if __name__=="__main__":
+    import shared
+    s = shared.SharedControl("demo_model")
+    loop = ControlLoop(s, lambda: {"pressure":0.1, "shoulder_acc":251.0}, rate=50.0)
+    loop.run(cycles=100)
+    print(loop.stats())
@@ -0,0 +1,146 @@
+import socket
+import json, time
+from threading import Thread
+from Queue import Queue, Empty, Full
+import config, logutil
+
+logger = logutil.get_logger('events')
+
+class EventSink(object):
+    """
+    Receives batches of output events. deliver() is called on the dispatcher's
+    worker thread with a dict of fsm_name -> list of (event, timestamp), in order.
+    """
+    def deliver(self, batch):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+class FileSink(EventSink):
+    """
+    Appends one JSON line per delivered event to a file; a stand-in for actuator I/O
+    """
+    def __init__(self, fname):
+        self.f = open(fname, 'a')
+
+    def deliver(self, batch):
+        for fsm_name, events in batch.iteritems():
+            for event, timestamp in events:
+                self.f.write(json.dumps({'fsm': fsm_name, 'event': event, 'time': timestamp}) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+class SocketSink(EventSink):
+    """
+    Sends each batch as one JSON datagram: {fsm_name: [[event, timestamp], ...]}
+    """
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def deliver(self, batch):
+        try:
+            self.sock.sendto(json.dumps(batch), self.address)
+        except socket.error:
+            pass
+
+    def close(self):
+        self.sock.close()
+
+class EventDispatcher(Thread):
+    """
+    Delivers FSM output events to an EventSink from a background thread, so slow
+    actuator I/O never blocks the control thread. post() only enqueues (and drops
+    events if the bounded queue is full); the worker drains up to max_batch posts at
+    a time, groups them per FSM and, if coalesce is set, collapses repeats of the
+    same event for an FSM that are still waiting to be delivered.
+    """
+    def __init__(self, sink, max_queue=1024, max_batch=64, coalesce=True):
+        Thread.__init__(self)
+        self.daemon = True
+        self.sink = sink
+        self.q = Queue(max_queue)
+        self.max_batch = max_batch
+        self.coalesce = coalesce
+        self.done = False
+
+        # metrics
+        self.posted = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.delivered = 0
+        self.batches = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def post(self, fsm_name, events):
+        """
+        Queues a list of events from one FSM; never blocks
+        """
+        try:
+            self.q.put_nowait((fsm_name, events, time.time()))
+            self.posted += len(events)
+        except Full:
+            self.dropped += len(events)
+
+    def run(self):
+        while not self.done or not self.q.empty():
+            try:
+                item = self.q.get(timeout=0.05)
+            except Empty:
+                continue
+            items = [item]
+            while len(items)<self.max_batch:
+                try:
+                    items.append(self.q.get_nowait())
+                except Empty:
+                    break
+            self.deliver(items)
+
+    def deliver(self, items):
+        batch = {}
+        for fsm_name, events, posted in items:
+            pending = batch.setdefault(fsm_name, [])
+            for event in events:
+                if self.coalesce and len(pending)>0 and pending[-1][0]==event:
+                    self.coalesced += 1
+                    continue
+                pending.append((event, posted))
+
+        try:
+            self.sink.deliver(batch)
+        except Exception, e:
+            logger.warn(json.dumps({'type': 'event_sink_error', 'error': str(e)}))
+            return
+
+        now = time.time()
+        self.batches += 1
+        for fsm_name, events in batch.iteritems():
+            for event, posted in events:
+                latency = now-posted
+                self.delivered += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+
+    def stats(self):
+        return {'type': 'event_sink_stats',
+                'posted': self.posted,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced,
+                'delivered': self.delivered,
+                'batches': self.batches,
+                'queued': self.q.qsize(),
+                'mean_latency': self.total_latency / max(self.delivered, 1),
+                'max_latency': self.max_latency}
+
+    def stop(self):
+        """
+        Delivers whatever is still queued, then stops the worker and closes the sink
+        """
+        self.done = True
+        if self.is_alive():
+            self.join()
+        self.sink.close()
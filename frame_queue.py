@@ -0,0 +1,198 @@
+import numpy as np
+import json, time
+from collections import deque
+from threading import Lock
+import logutil
+import sensor_encoder
+
+logger = logutil.get_logger('ingest')
+
+# how two readings of a sensor are merged when frames are coalesced
+LATEST = 'latest'
+MAX = 'max'
+MIN = 'min'
+
+def merge_rule(encoders):
+    """
+    Merge rule for a sensor given its (target, Encoder) list. A sensor feeding only
+    rising threshold encoders keeps its maximum (a spike past the threshold survives
+    the merge), only falling ones its minimum; anything else keeps the latest reading.
+    """
+    directions = set()
+    for target, encoder in encoders:
+        if encoder.transform is not None or not isinstance(encoder.encoder, sensor_encoder.ThresholdEncoder):
+            return LATEST
+        rising = (encoder.encoder.softness>0) != bool(encoder.flip)
+        directions.add(MAX if rising else MIN)
+    if len(directions)==1:
+        return directions.pop()
+    return LATEST
+
+def merge_value(rule, old, new):
+    if rule==MAX:
+        return np.maximum(old, new)
+    if rule==MIN:
+        return np.minimum(old, new)
+    return new
+
+class FrameQueue(object):
+    """
+    Bounded queue of sensor frames in front of SharedControl.update, for producers
+    that can outrun the control loop. put() never blocks; process() drains frames.
+
+    Once merge_depth frames are waiting, a new frame is merged into the
+    last queued one (per sensor: latest reading, or max/min for threshold encoders,
+    see merge_rule). When max_queue frames are waiting, the oldest is shed.
+
+    Frames that could move an output across its event threshold are critical: they
+    are never merged into and are shed last. An output's probability is multilinear
+    in the sensor probabilities, so it can change by at most the summed change of
+    the sensor probabilities it depends on; a frame is critical if that bound,
+    taken against the last processed frame, reaches within margin of the distance
+    from the output's last inferred probability to its threshold.
+    """
+    def __init__(self, shared, max_queue=32, merge_depth=None, margin=0.05):
+        self.shared = shared
+        self.max_queue = max_queue
+        self.merge_depth = max_queue//2 if merge_depth is None else merge_depth
+        self.margin = margin
+        self.queue = deque()
+        self.lock = Lock()
+
+        encoder = shared.sensor_encoder
+        self.merge_rules = dict((sensor, merge_rule(encoders)) for sensor, encoders in encoder.sensors.iteritems())
+        # a private compiled encoder, so put() can run on another thread
+        self.encoder = sensor_encoder.CompiledEncoder(encoder)
+        position = dict((target, k) for k, (sensor, target) in enumerate(self.encoder.encoders))
+
+        net = shared.bayes_net.compiled
+        self.outputs = []
+        for output in net.outputs:
+            if output["threshold"] is None:
+                # a temporal node's belief; fires nothing
+                continue
+            relevant = net.ancestors([i for i, value in output["query"]])
+            positions = [position[net.names[i]] for i in relevant if net.names[i] in position]
+            self.outputs.append((output["name"], np.array(positions, dtype=np.intp), output["threshold"]))
+        # sensor probabilities of the last processed frame
+        self.reference = None
+
+        # counters
+        self.received = 0
+        self.processed = 0
+        self.merged = 0
+        self.shed = 0
+        self.shed_critical = 0
+        self.critical = 0
+        self.max_depth = 0
+        self.max_wait = 0.0
+
+    def encode(self, sensors):
+        return self.encoder.encode_values(self.encoder.fill(sensors)).copy()
+
+    def is_critical(self, p):
+        if self.reference is None:
+            return True
+        caution = self.shared.bayes_net.event_caution
+        last_probs = self.shared.bayes_net.last_probs
+        stale = self.shared.bayes_net.stale
+        for name, positions, threshold in self.outputs:
+            last = last_probs.get(name)
+            if last is None:
+                return True
+            # a stale probability is off by up to stale[name] already
+            bound = np.sum(np.abs(p[positions]-self.reference[positions])) + stale.get(name, 0.0)
+            if bound+self.margin>=abs(last-(threshold+caution)):
+                return True
+        return False
+
+    def put(self, sensors, timestamp=None):
+        """
+        Queues a sensor_name:sensor_value dict; never blocks
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        sensors = dict(sensors)
+        with self.lock:
+            self.received += 1
+            p = self.encode(sensors)
+            critical = self.is_critical(p)
+            if critical:
+                self.critical += 1
+
+            if len(self.queue)>=self.merge_depth and len(self.queue)>0 and not self.queue[-1]["critical"]:
+                tail = self.queue[-1]
+                for sensor, value in sensors.iteritems():
+                    if sensor in tail["sensors"]:
+                        value = merge_value(self.merge_rules.get(sensor, LATEST), tail["sensors"][sensor], value)
+                    tail["sensors"][sensor] = value
+                tail["p"] = self.encode(tail["sensors"])
+                tail["critical"] = self.is_critical(tail["p"])
+                tail["frames"] += 1
+                self.merged += 1
+                return
+
+            if len(self.queue)>=self.max_queue:
+                self.shed_one()
+            self.queue.append({"sensors": sensors, "p": p, "critical": critical,
+                               "time": timestamp, "frames": 1})
+            self.max_depth = max(self.max_depth, len(self.queue))
+
+    def shed_one(self):
+        for k, frame in enumerate(self.queue):
+            if not frame["critical"]:
+                del self.queue[k]
+                self.shed += frame["frames"]
+                return
+        frame = self.queue.popleft()
+        self.shed += frame["frames"]
+        self.shed_critical += frame["frames"]
+
+    def get(self):
+        with self.lock:
+            if len(self.queue)==0:
+                return None
+            return self.queue.popleft()
+
+    def process(self, max_frames=None):
+        """
+        Runs SharedControl.update on queued frames, oldest first.
+        Returns the list of events from each update.
+        """
+        results = []
+        while max_frames is None or len(results)<max_frames:
+            frame = self.get()
+            if frame is None:
+                break
+            self.max_wait = max(self.max_wait, time.time()-frame["time"])
+            results.append(self.shared.update(frame["sensors"]))
+            self.reference = frame["p"]
+            self.processed += 1
+        return results
+
+    def stats(self):
+        return {'type': 'frame_queue_stats',
+                'received': self.received,
+                'processed': self.processed,
+                'merged': self.merged,
+                'shed': self.shed,
+                'shed_critical': self.shed_critical,
+                'critical': self.critical,
+                'depth': len(self.queue),
+                'max_depth': self.max_depth,
+                'max_wait': self.max_wait}
+
+    def log_stats(self):
+        logger.info(json.dumps(self.stats()))
+
+if __name__=="__main__":
+    import shared
+    s = shared.SharedControl("demo_model")
+    q = FrameQueue(s, max_queue=8)
+    # a producer running ten times faster than the control loop
+    for i in range(100):
+        q.put({"pressure": 0.1+0.001*i, "shoulder_acc": 251.0})
+        if i%10==0:
+            q.process(max_frames=1)
+    q.process()
+    print(q.stats())
@@ -48,6 +48,10 @@ class FSM(object):
                     self.fsm.__dict__['onreenter%s'%state] =  lambda x,y=callbacks["reenter"]: self.fire_event(y)
                 
             
+    @property
+    def state(self):
+        return self.fsm.current
+
     def fire_event(self, ev):
         self.event_stack.append(ev)
         logger.info(json.dumps({'type': 'fire_event', 'FSM': self.name, 'event': ev}))
@@ -118,7 +122,7 @@ class MultiFSM(object):
         # collect together all output events
         all_events = {}
         for fsm_name,fsm in self.fsms.iteritems():
-            all_events[fsm] = list(fsm.event_stack)
+            all_events[fsm_name] = list(fsm.event_stack)
             fsm.clear_events()
         return all_events
             
@@ -132,6 +136,32 @@ class MultiFSM(object):
             states[name] = fsm.state
         return states
         
+    def evidence(self, fsm_inputs):
+        """
+        Returns a dict of Bayes net evidence for the given fsm_input node names
+        ("fsm/state"): "T" if the named FSM is in that state, "F" otherwise
+        """
+        evidence = {}
+        for name in fsm_inputs:
+            fsm_name, state = name.split('/')
+            evidence[name] = "T" if self.fsms[fsm_name].state==state else "F"
+        return evidence
+
+    def snapshot(self):
+        """
+        Returns the current state and pending output events of each FSM
+        """
+        return dict((name, (fsm.state, list(fsm.event_stack))) for name, fsm in self.fsms.iteritems())
+
+    def restore(self, snapshot):
+        """
+        Puts each FSM back in a snapshot's state, without running any callbacks
+        """
+        for name, (state, event_stack) in snapshot.iteritems():
+            fsm = self.fsms[name]
+            fsm.fsm.current = state
+            fsm.event_stack = list(event_stack)
+
     def print_all_state(self):
         """
         Print the name and current state of each FSM
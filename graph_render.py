@@ -0,0 +1,183 @@
+import hashlib
+import subprocess
+import json, time
+import os, sys
+from threading import Thread, Lock
+from Queue import Queue
+import config, logutil
+
+logger = logutil.get_logger('render')
+
+MODEL_FILES = ["encoder.yaml", "bayes_net.yaml", "fsms.yaml"]
+
+def model_hash(model_dir, options):
+    """
+    Hash of a model's YAML files and the render options; the cache key
+    """
+    h = hashlib.sha1()
+    for name in MODEL_FILES:
+        h.update(name)
+        with open(os.path.join(model_dir, name), 'rb') as f:
+            h.update(f.read())
+    h.update(json.dumps(options, sort_keys=True))
+    return h.hexdigest()
+
+def open_image(fname):
+    if hasattr(os, 'startfile'):
+        # only on Windows
+        os.startfile(fname)
+    else:
+        # for macs
+        os.system('open "%s"' % fname)
+
+class RenderJob(object):
+    """
+    A request to render one model. The worker updates stage and progress (0..1);
+    done is set when it finishes, with fname (the image) or error.
+    cancel() stops it at the next stage, killing dot if it is running.
+    """
+    def __init__(self, model_dir, options, key, fname):
+        self.model_dir = model_dir
+        self.options = options
+        self.key = key
+        self.fname = fname
+        self.stage = "queued"
+        self.progress = 0.0
+        self.error = None
+        self.done = False
+        self.cancelled = False
+        self.cached = False
+        self.model = None
+        self.started = time.time()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def ok(self):
+        return self.done and self.error is None and not self.cancelled
+
+class GraphRenderer(Thread):
+    """
+    Renders model graphs on a background thread, caching images in cache_dir
+    under the hash of the model files and render options. A model that has not
+    changed since it was last rendered is served from the cache at once.
+    Jobs are polled (e.g. from a Tk after() callback): nothing is called back
+    on the worker thread.
+    """
+    def __init__(self, cache_dir=None, prog="dot"):
+        Thread.__init__(self)
+        self.daemon = True
+        self.cache_dir = config.GRAPH_CACHE_DIR if cache_dir is None else cache_dir
+        self.prog = prog
+        self.q = Queue()
+        self.lock = Lock()
+        self.jobs = {}
+        self.done = False
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def request(self, model_dir, rankdir="UD"):
+        """
+        Returns a RenderJob for the model; already done if the image is cached.
+        Repeated requests for a model still being rendered share one job.
+        """
+        options = {"rankdir": rankdir, "prog": self.prog}
+        key = model_hash(model_dir, options)
+        fname = os.path.join(self.cache_dir, key + ".png")
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is not None and not job.done and not job.cancelled:
+                return job
+            job = RenderJob(model_dir, options, key, fname)
+            if os.path.exists(fname):
+                job.stage, job.progress, job.done, job.cached = "cached", 1.0, True, True
+                return job
+            self.jobs[key] = job
+        self.q.put(job)
+        return job
+
+    def run(self):
+        while not self.done:
+            job = self.q.get()
+            if job is None:
+                break
+            try:
+                self.render(job)
+            except Exception, e:
+                job.error = str(e)
+                logger.warn(json.dumps({'type': 'render_error', 'model': job.model_dir, 'error': job.error}))
+            job.done = True
+            with self.lock:
+                self.jobs.pop(job.key, None)
+
+    def set_stage(self, job, stage, progress):
+        if job.cancelled:
+            raise RenderCancelled()
+        job.stage = stage
+        job.progress = progress
+
+    def render(self, job):
+        try:
+            import shared
+            self.set_stage(job, "loading model", 0.05)
+            job.model = shared.SharedControl(job.model_dir)
+            self.set_stage(job, "building graph", 0.3)
+            source = job.model.build_graph(job.options["rankdir"]).to_string()
+            self.set_stage(job, "running %s" % self.prog, 0.4)
+            self.run_dot(job, source)
+            self.set_stage(job, "done", 1.0)
+            logger.info(json.dumps({'type': 'render', 'model': job.model_dir, 'key': job.key,
+                                    'elapsed': time.time()-job.started}))
+        except RenderCancelled:
+            job.stage = "cancelled"
+
+    def run_dot(self, job, source):
+        """
+        Runs dot as a subprocess, polling so a cancel can kill it. The image is
+        written under a temporary name and renamed, so the cache never holds a
+        partial file. dot's messages go to a temporary file rather than a pipe,
+        which nothing reads while polling and which dot would block on once full.
+        """
+        tmp_dot = job.fname + ".%d.dot" % os.getpid()
+        tmp_png = job.fname + ".%d.tmp" % os.getpid()
+        tmp_err = job.fname + ".%d.err" % os.getpid()
+        with open(tmp_dot, 'w') as f:
+            f.write(source)
+        try:
+            with open(os.devnull, 'w') as out, open(tmp_err, 'w') as err:
+                proc = subprocess.Popen([self.prog, "-Tpng", "-o", tmp_png, tmp_dot],
+                                        stdout=out, stderr=err)
+            while proc.poll() is None:
+                if job.cancelled:
+                    proc.kill()
+                    proc.wait()
+                    raise RenderCancelled()
+                # dot gives no progress of its own; creep towards done
+                job.progress = min(0.95, job.progress + 0.01)
+                time.sleep(0.05)
+            if proc.returncode!=0:
+                with open(tmp_err) as f:
+                    # the last of the messages; warnings on large graphs can run long
+                    f.seek(max(0, os.path.getsize(tmp_err)-4096))
+                    raise RuntimeError("%s failed: %s" % (self.prog, f.read().strip()))
+            os.rename(tmp_png, job.fname)
+        finally:
+            for tmp in (tmp_dot, tmp_png, tmp_err):
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+    def stop(self):
+        self.done = True
+        self.q.put(None)
+
+class RenderCancelled(Exception):
+    pass
+
+if __name__=="__main__":
+    renderer = GraphRenderer()
+    renderer.start()
+    job = renderer.request(sys.argv[1] if len(sys.argv)>1 else "demo_model")
+    while not job.done:
+        print('%s %.0f%%' % (job.stage, 100*job.progress))
+        time.sleep(0.2)
+    print(job.fname if job.ok() else job.error)
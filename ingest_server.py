@@ -0,0 +1,352 @@
+import numpy as np
+import socket, select, struct, errno
+import json, time
+import config, logutil
+
+logger = logutil.get_logger('ingest')
+
+# message kinds; a frame is FRAME, a float64 timestamp and one float64 per sensor slot
+FRAME = 'F'
+SUBSCRIBE = 'S'
+UNSUBSCRIBE = 'U'
+# event messages sent back: EVENTS, the frame's timestamp, a uint32 length and a JSON list
+EVENTS = 'E'
+EVENT_HEADER = struct.Struct('<cdI')
+
+DEFAULT_PORT = 16680
+
+def would_block(e):
+    return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+class IngestServer(object):
+    """
+    Network entry point for a SharedControl. Clients send binary frames (a sensor
+    value vector in the model's slot layout, plus a timestamp) over UDP or TCP on the
+    same port. Each poll() reads every pending frame, keeps only the latest
+    (bursts are coalesced into one update), runs SharedControl.update_values and
+    pushes any fired events to the subscribed clients.
+
+    TCP subscribers have a bounded output buffer; events that would overflow it are
+    dropped for that client rather than stalling the loop.
+
+    Two latencies are kept: latency, from poll() waking up to the events being
+    pushed, and frame_latency, from the frame's own timestamp, which includes
+    the time it waited before the poll (and assumes the client's clock is this one's).
+    """
+    def __init__(self, shared, host='127.0.0.1', port=DEFAULT_PORT, max_client_buffer=65536):
+        self.shared = shared
+        slots, self.width = shared.sensor_layout()
+        self.frame_size = 1 + 8 + 8*self.width
+        self.values = np.zeros(self.width)
+        self.max_client_buffer = max_client_buffer
+
+        self.bind(host, port)
+        self.tcp.listen(16)
+        self.tcp.setblocking(0)
+        self.address = self.tcp.getsockname()
+        self.udp_address = self.udp.getsockname()
+
+        # tcp socket -> client state; udp subscribers by address
+        self.clients = {}
+        self.udp_subscribers = {}
+        self.done = False
+
+        # counters
+        self.started = time.time()
+        self.frames_received = 0
+        self.frames_coalesced = 0
+        self.bad_messages = 0
+        self.updates = 0
+        self.events_sent = 0
+        self.events_dropped = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.total_frame_latency = 0.0
+        self.max_frame_latency = 0.0
+
+    def bind(self, host, port, attempts=16):
+        """
+        Binds the UDP and TCP sockets to the same port. With port 0 the port is
+        the one the system picks for UDP; if it is taken for TCP, another is tried.
+        """
+        for attempt in range(attempts):
+            self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp.bind((host, port))
+            self.udp.setblocking(0)
+            self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                self.tcp.bind((host, self.udp.getsockname()[1]))
+                return
+            except socket.error, e:
+                self.udp.close()
+                self.tcp.close()
+                if port!=0 or e.args[0]!=errno.EADDRINUSE:
+                    raise
+        raise socket.error(errno.EADDRINUSE, "No port free for both UDP and TCP")
+
+    def new_client(self):
+        return {'inbuf': '', 'outbuf': '', 'subscribed': False, 'dropped': 0}
+
+    def poll(self, timeout=0.01):
+        """
+        Waits up to timeout for input, then handles everything pending.
+        Returns the events fired, if a frame was processed, else None
+        """
+        readers = [self.udp, self.tcp] + self.clients.keys()
+        writers = [sock for sock, client in self.clients.iteritems() if client['outbuf']]
+        readable, writable, errored = select.select(readers, writers, [], timeout)
+        received = time.time()
+
+        self.latest = None
+        for sock in readable:
+            if sock is self.tcp:
+                self.accept()
+            elif sock is self.udp:
+                self.read_udp()
+            else:
+                self.read_tcp(sock)
+        for sock in writable:
+            if sock in self.clients:
+                self.flush(sock)
+
+        if self.latest is None:
+            return None
+
+        timestamp, data, offset = self.latest
+        self.values[:] = np.frombuffer(data, dtype='<f8', count=self.width, offset=offset)
+        events = self.shared.update_values(self.values)
+        self.updates += 1
+        fired = [event for fsm_events in events for event in fsm_events]
+        if fired:
+            self.push(timestamp, fired)
+
+        done = time.time()
+        self.total_latency += done-received
+        self.max_latency = max(self.max_latency, done-received)
+        self.total_frame_latency += done-timestamp
+        self.max_frame_latency = max(self.max_frame_latency, done-timestamp)
+        return events
+
+    def accept(self):
+        try:
+            sock, addr = self.tcp.accept()
+        except socket.error, e:
+            if would_block(e):
+                return
+            raise
+        sock.setblocking(0)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.clients[sock] = self.new_client()
+
+    def read_udp(self):
+        while True:
+            try:
+                data, addr = self.udp.recvfrom(65536)
+            except socket.error, e:
+                if would_block(e):
+                    return
+                raise
+            # a datagram is exactly one message
+            if len(data)!=(self.frame_size if data[:1]==FRAME else 1):
+                self.bad_messages += 1
+                continue
+            self.handle_message(data, 0, ('udp', addr))
+
+    def read_tcp(self, sock):
+        client = self.clients[sock]
+        try:
+            data = sock.recv(65536)
+        except socket.error, e:
+            if would_block(e):
+                return
+            data = ''
+        if not data:
+            self.drop_client(sock)
+            return
+
+        buf = client['inbuf'] + data
+        offset = 0
+        while offset<len(buf):
+            size = self.frame_size if buf[offset]==FRAME else 1
+            if offset+size>len(buf):
+                break
+            self.handle_message(buf, offset, ('tcp', sock))
+            offset += size
+        client['inbuf'] = buf[offset:]
+
+    def handle_message(self, data, offset, source):
+        kind = data[offset]
+        if kind==FRAME and len(data)-offset>=self.frame_size:
+            timestamp, = struct.unpack_from('<d', data, offset+1)
+            self.frames_received += 1
+            if self.latest is not None:
+                self.frames_coalesced += 1
+                if timestamp<self.latest[0]:
+                    # out of order; keep the newer frame
+                    return
+            self.latest = (timestamp, data, offset+9)
+        elif kind in (SUBSCRIBE, UNSUBSCRIBE):
+            protocol, client = source
+            if protocol=='udp':
+                if kind==SUBSCRIBE:
+                    self.udp_subscribers[client] = 0
+                else:
+                    self.udp_subscribers.pop(client, None)
+            else:
+                self.clients[client]['subscribed'] = kind==SUBSCRIBE
+        else:
+            self.bad_messages += 1
+
+    def push(self, timestamp, fired):
+        payload = json.dumps(fired)
+        message = EVENT_HEADER.pack(EVENTS, timestamp, len(payload)) + payload
+        for sock, client in self.clients.items():
+            if not client['subscribed']:
+                continue
+            if len(client['outbuf'])+len(message)>self.max_client_buffer:
+                # slow client: drop rather than block the control loop
+                client['dropped'] += 1
+                self.events_dropped += 1
+                continue
+            client['outbuf'] += message
+            self.events_sent += 1
+            self.flush(sock)
+        for addr in self.udp_subscribers:
+            try:
+                self.udp.sendto(message, addr)
+                self.events_sent += 1
+            except socket.error:
+                self.udp_subscribers[addr] += 1
+                self.events_dropped += 1
+
+    def flush(self, sock):
+        client = self.clients[sock]
+        try:
+            sent = sock.send(client['outbuf'])
+        except socket.error, e:
+            if would_block(e):
+                return
+            self.drop_client(sock)
+            return
+        client['outbuf'] = client['outbuf'][sent:]
+
+    def drop_client(self, sock):
+        self.clients.pop(sock, None)
+        sock.close()
+
+    def stats(self):
+        elapsed = max(time.time()-self.started, 1e-9)
+        return {'type': 'ingest_stats',
+                'frames_received': self.frames_received,
+                'frames_coalesced': self.frames_coalesced,
+                'bad_messages': self.bad_messages,
+                'updates': self.updates,
+                'frames_per_second': self.frames_received / elapsed,
+                'updates_per_second': self.updates / elapsed,
+                'mean_latency': self.total_latency / max(self.updates, 1),
+                'max_latency': self.max_latency,
+                'mean_frame_latency': self.total_frame_latency / max(self.updates, 1),
+                'max_frame_latency': self.max_frame_latency,
+                'events_sent': self.events_sent,
+                'events_dropped': self.events_dropped,
+                'clients': len(self.clients),
+                'udp_subscribers': len(self.udp_subscribers)}
+
+    def serve_forever(self, stats_interval=5.0):
+        """
+        Polls until stop() is called, logging stats every stats_interval seconds
+        """
+        last_stats = time.time()
+        while not self.done:
+            self.poll()
+            if time.time()-last_stats>stats_interval:
+                logger.info(json.dumps(self.stats()))
+                last_stats = time.time()
+
+    def stop(self):
+        self.done = True
+
+    def close(self):
+        for sock in self.clients.keys():
+            self.drop_client(sock)
+        self.udp.close()
+        self.tcp.close()
+
+class IngestClient(object):
+    """
+    Client for an IngestServer, e.g. a loopback test client or an acquisition process
+    """
+    def __init__(self, width, address, protocol='tcp'):
+        self.width = width
+        self.address = address
+        self.protocol = protocol
+        if protocol=='tcp':
+            self.sock = socket.create_connection(address)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.buf = ''
+
+    def send(self, message):
+        if self.protocol=='tcp':
+            self.sock.sendall(message)
+        else:
+            self.sock.sendto(message, self.address)
+
+    def subscribe(self):
+        self.send(SUBSCRIBE)
+
+    def unsubscribe(self):
+        self.send(UNSUBSCRIBE)
+
+    def send_frame(self, values, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        values = np.asarray(values, dtype='<f8').ravel()
+        self.send(FRAME + struct.pack('<d', timestamp) + values.tostring())
+
+    def receive_events(self, timeout=0.0):
+        """
+        Returns a list of (timestamp, events) received within timeout seconds
+        """
+        received = []
+        readable, writable, errored = select.select([self.sock], [], [], timeout)
+        while readable:
+            data = self.sock.recv(65536)
+            if not data:
+                break
+            self.buf += data
+            readable, writable, errored = select.select([self.sock], [], [], 0)
+
+        while len(self.buf)>=EVENT_HEADER.size:
+            kind, timestamp, length = EVENT_HEADER.unpack_from(self.buf)
+            end = EVENT_HEADER.size+length
+            if len(self.buf)<end:
+                break
+            received.append((timestamp, json.loads(self.buf[EVENT_HEADER.size:end])))
+            self.buf = self.buf[end:]
+        return received
+
+    def close(self):
+        self.sock.close()
+
+if __name__=="__main__":
+    import shared
+    s = shared.SharedControl("demo_model")
+    server = IngestServer(s, port=0)
+    slots, width = s.sensor_layout()
+    client = IngestClient(width, server.address)
+    client.subscribe()
+
+    frame = np.zeros(width)
+    frame[slots["pressure"]] = 0.1
+    frame[slots["shoulder_acc"]] = 251.0
+    for i in range(10):
+        client.send_frame(frame)
+    for i in range(5):
+        server.poll()
+    print('events:', client.receive_events(timeout=0.1))
+    print(server.stats())
+    client.close()
+    server.close()
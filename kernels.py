@@ -0,0 +1,242 @@
+import numpy as np
+import json, time
+import config, logutil
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+logger = logutil.get_logger('kernels')
+
+def backend_name(requested):
+    """
+    The kernel backend for config.KERNELS: "numba" (JIT-compiled loops) or
+    "numpy". "auto" picks numba when it can be imported.
+    """
+    if requested=="auto":
+        return "numpy" if numba is None else "numba"
+    if requested=="numba" and numba is None:
+        logger.warn(json.dumps({'type': 'kernels_unavailable', 'backend': requested}))
+        return "numpy"
+    if requested not in ("numba", "numpy"):
+        raise ValueError("Unknown kernel backend %s" % requested)
+    return requested
+
+# selected once, when the first module that uses kernels is loaded
+BACKEND = backend_name(config.KERNELS)
+
+# the kernels as plain loops over the same arguments as the NumPy kernels in
+# sensor_encoder, posterior_tables and loopy_bp. numba compiles them for the
+# numba backend; run as they are, they are the reference check() compares
+# both backends with.
+
+def _threshold(x, threshold, softness, out):
+    for i in range(x.shape[0]):
+        out[i] = 1.0 / (1.0 + np.exp(-((x[i]-threshold[i])*softness[i])))
+
+def _range(x, left, right, left_softness, right_softness, out):
+    for i in range(x.shape[0]):
+        rising = 1.0 / (1.0 + np.exp(-((x[i]-left[i])*left_softness[i])))
+        falling = 1.0 / (1.0 + np.exp(-((x[i]-right[i])*right_softness[i])))
+        out[i] = rising * (1.0-falling)
+
+def _gaussian(x, centres, widths, out):
+    for i in range(x.shape[0]):
+        d = x[i]-centres[i]
+        out[i] = np.exp(-(d*d / widths[i] / widths[i]))
+
+def _binary(x, p, no_p, out):
+    for i in range(x.shape[0]):
+        out[i] = p[i] if x[i]>0.5 else no_p[i]
+
+def _contract(flat, probs):
+    # the last axis varies fastest, so its pairs are adjacent
+    buf = flat.copy()
+    size = buf.shape[0]
+    for k in range(probs.shape[0]-1, -1, -1):
+        p = probs[k]
+        size //= 2
+        for j in range(size):
+            buf[j] = buf[2*j]*(1-p) + buf[2*j+1]*p
+    return buf[0]
+
+def _normalise(msgs):
+    for i in range(msgs.shape[0]):
+        total = msgs[i, 0] + msgs[i, 1]
+        if total<=0:
+            msgs[i, 0] = 0.5
+            msgs[i, 1] = 0.5
+        else:
+            msgs[i, 0] /= total
+            msgs[i, 1] /= total
+
+def _exp_normalise(log_msgs):
+    msgs = np.empty_like(log_msgs)
+    for i in range(log_msgs.shape[0]):
+        peak = max(log_msgs[i, 0], log_msgs[i, 1])
+        if not (-np.inf<peak<np.inf):
+            peak = 0.0
+        msgs[i, 0] = np.exp(log_msgs[i, 0]-peak)
+        msgs[i, 1] = np.exp(log_msgs[i, 1]-peak)
+    return msgs
+
+def loop_kernels(compile):
+    """
+    The kernels, by function name, with the same signatures as the NumPy
+    versions, built on the loops above passed through compile
+    """
+    threshold, range_, gaussian, binary = [compile(f) for f in (_threshold, _range, _gaussian, _binary)]
+    contract_, normalise_, exp_only = [compile(f) for f in (_contract, _normalise, _exp_normalise)]
+
+    def threshold_group(x, params, out, tmp):
+        threshold(x, params[0], params[1], out)
+
+    def range_group(x, params, out, tmp):
+        range_(x, params[0], params[1], params[2], params[3], out)
+
+    def gaussian_group(x, params, out, tmp):
+        gaussian(x, params[0], params[1], out)
+
+    def binary_group(x, params, out, tmp):
+        binary(x, params[0], params[1], out)
+
+    def contract(table, probs):
+        return float(contract_(np.ascontiguousarray(table, dtype=np.float64).ravel(),
+                               np.asarray(probs, dtype=np.float64)))
+
+    def normalise(msgs):
+        normalise_(msgs)
+
+    def exp_normalise(log_msgs):
+        msgs = exp_only(log_msgs)
+        normalise_(msgs)
+        return msgs
+
+    return dict((kernel.__name__, kernel) for kernel in [threshold_group, range_group, gaussian_group,
+                                                         binary_group, contract, normalise, exp_normalise])
+
+# the loops run by Python, for check()
+REFERENCE = loop_kernels(lambda f: f)
+
+# the loops compiled by numba
+JIT = loop_kernels(numba.njit) if numba is not None else {}
+
+def warm_up_args():
+    """
+    Small arguments of the types the kernels are called with (C-contiguous
+    float64 arrays), by kernel name, to compile each kernel ahead of use
+    """
+    v = lambda: np.ones(1)
+    return {"threshold_group": (v(), (v(), v()), v(), v()),
+            "range_group": (v(), (v(), v(), v(), v()), v(), v()),
+            "gaussian_group": (v(), (v(), v()), v(), v()),
+            "binary_group": (v(), (v(), v()), v(), v()),
+            "contract": (np.ones(2), [0.5]),
+            "normalise": (np.ones((1, 2)),),
+            "exp_normalise": (np.zeros((1, 2)),)}
+
+# kernels compiled so far
+WARM = set()
+
+def select(numpy_version, backend=None):
+    """
+    The kernel to run for numpy_version: its JIT version under the numba
+    backend (default BACKEND), otherwise numpy_version itself. A JIT kernel
+    is compiled here, on first selection, rather than on the first live frame.
+    """
+    backend = BACKEND if backend is None else backend_name(backend)
+    name = numpy_version.__name__
+    if backend!="numba" or name not in JIT:
+        return numpy_version
+    kernel = JIT[name]
+    if name not in WARM:
+        start = time.time()
+        kernel(*warm_up_args()[name])
+        WARM.add(name)
+        logger.info(json.dumps({'type': 'kernel_compiled', 'kernel': name, 'elapsed': time.time()-start}))
+    return kernel
+
+def check(trials=200, seed=0, tolerance=1e-12):
+    """
+    Runs every kernel on random inputs: the NumPy version, and the JIT
+    version when numba is installed, each against the reference loops.
+    Returns the largest absolute difference per kernel and backend (e.g.
+    "contract/numpy"); raises AssertionError if one is over tolerance.
+    """
+    import sensor_encoder, posterior_tables, loopy_bp
+    rng = np.random.RandomState(seed)
+    backends = [("numpy", None)] + ([("numba", JIT)] if numba is not None else [])
+    diffs = {}
+    def compare(numpy_version, call):
+        name = numpy_version.__name__
+        expected = np.asarray(call(REFERENCE[name]))
+        for backend, kernels in backends:
+            result = np.asarray(call(numpy_version if kernels is None else kernels[name]))
+            key = "%s/%s" % (name, backend)
+            diffs[key] = max(diffs.get(key, 0.0), float(np.max(np.abs(result-expected))) if expected.size else 0.0)
+
+    groups = [(sensor_encoder.threshold_group, 2), (sensor_encoder.range_group, 4),
+              (sensor_encoder.gaussian_group, 2), (sensor_encoder.binary_group, 2)]
+    for trial in range(trials):
+        n = rng.randint(1, 16)
+        x = rng.randn(n)*3
+        for numpy_version, n_params in groups:
+            params = tuple([rng.rand(n)*2+0.1 for k in range(n_params)])
+            def call(kernel):
+                out, tmp = np.zeros(n), np.zeros(n)
+                kernel(x, params, out, tmp)
+                return out
+            compare(numpy_version, call)
+
+        k = rng.randint(0, 8)
+        table = rng.rand(*((2,)*k))
+        probs = list(rng.rand(k))
+        compare(posterior_tables.contract, lambda kernel: kernel(table, probs))
+
+        msgs = rng.rand(n, 2)
+        msgs[rng.rand(n)<0.1] = 0.0
+        def call(kernel):
+            out = msgs.copy()
+            kernel(out)
+            return out
+        compare(loopy_bp.normalise, call)
+
+        log_msgs = np.log(rng.rand(n, 2))
+        log_msgs[rng.rand(n)<0.1] = -np.inf
+        compare(loopy_bp.exp_normalise, lambda kernel: kernel(log_msgs.copy()))
+
+    over = dict((key, diff) for key, diff in diffs.iteritems() if not diff<=tolerance)
+    assert not over, "kernels differ from the reference: %s" % json.dumps(over, sort_keys=True)
+    return diffs
+
+if __name__=="__main__":
+    import sys
+    import shared, sensor_encoder
+    print('backend: %s (numba %s)' % (BACKEND, 'available' if numba is not None else 'not installed'))
+    backends = ["numpy"] + (["numba"] if numba is not None else [])
+    diffs = check()
+    print('largest difference from the reference loops: %s' % json.dumps(diffs, sort_keys=True))
+
+    # per-frame cost of the encoder and the table engine, per backend
+    model_dir = sys.argv[1] if len(sys.argv)>1 else "demo_model"
+    frames = 20000
+    for backend in backends:
+        s = shared.SharedControl(model_dir, engine="tables", backend=backend)
+        encoder = sensor_encoder.CompiledEncoder(s.sensor_encoder, backend=backend)
+        values = np.random.RandomState(1).randn(frames, encoder.width)
+        encoder.encode_values(values[0])
+        start = time.time()
+        for frame in values:
+            encoder.encode_values(frame)
+        encode = (time.time()-start)/frames
+
+        tables = s.bayes_net.engine
+        probs = dict((name, 0.3) for name, kind in zip(tables.net.names, tables.net.types) if kind=="sensor_input")
+        fsm_evidence = s.fsms.evidence(s.bayes_net.fsm_inputs)
+        tables.query(probs, fsm_evidence)
+        start = time.time()
+        for i in range(frames):
+            tables.query(probs, fsm_evidence)
+        query = (time.time()-start)/frames
+        print('%-6s encode %.2f us/frame, table query %.2f us/frame' % (backend, encode*1e6, query*1e6))
@@ -0,0 +1,208 @@
+import numpy as np
+import json
+from collections import deque
+from Tkinter import *
+
+COLOURS = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b', '#e377c2', '#17becf']
+
+class Series(object):
+    """
+    Ring buffer of (time, value) samples. Times are kept non-decreasing (a late
+    sample is stamped with the last time), so each segment of the ring is sorted.
+    """
+    def __init__(self, capacity=1<<20):
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.values = np.zeros(capacity)
+        self.n = 0
+        self.threshold = None
+
+    def append(self, t, v):
+        k = self.n % self.capacity
+        if self.n>0:
+            t = max(t, self.times[(self.n-1) % self.capacity])
+        self.times[k] = t
+        self.values[k] = v
+        self.n += 1
+
+    def segments(self):
+        """
+        (times, values) views of the ring, oldest first
+        """
+        if self.n<=self.capacity:
+            return [(self.times[:self.n], self.values[:self.n])]
+        k = self.n % self.capacity
+        return [(self.times[k:], self.values[k:]), (self.times[:k], self.values[:k])]
+
+    def decimate(self, t0, t1, width):
+        """
+        Min and max of the samples in each of width pixel columns over [t0, t1);
+        NaN for empty columns. Only the samples in the window are touched.
+        """
+        lo = np.empty(width)
+        hi = np.empty(width)
+        lo.fill(np.nan)
+        hi.fill(np.nan)
+        for times, values in self.segments():
+            seg_lo, seg_hi = decimate(times, values, t0, t1, width)
+            lo = np.fmin(lo, seg_lo)
+            hi = np.fmax(hi, seg_hi)
+        return lo, hi
+
+def decimate(times, values, t0, t1, width):
+    lo = np.empty(width)
+    hi = np.empty(width)
+    lo.fill(np.nan)
+    hi.fill(np.nan)
+    start, stop = np.searchsorted(times, [t0, t1])
+    if stop<=start:
+        return lo, hi
+    t = times[start:stop]
+    v = values[start:stop]
+    # first sample of each pixel column; columns with no samples are skipped
+    edges = np.searchsorted(t, t0 + (t1-t0)*np.arange(width)/float(width))
+    nonempty = np.diff(np.append(edges, len(t)))>0
+    first = edges[nonempty]
+    lo[nonempty] = np.minimum.reduceat(v, first)
+    hi[nonempty] = np.maximum.reduceat(v, first)
+    return lo, hi
+
+class LivePlot(Frame):
+    """
+    Live plot of query posteriors and encoded sensor probabilities from log
+    records, with each query's threshold and fire_event markers overlaid.
+    Each series is decimated to min/max per pixel column before drawing, so a
+    redraw costs O(width) canvas coordinates however many samples are in view.
+    Redraws every interval ms from the Tk event loop.
+    """
+    def __init__(self, master, span=30.0, capacity=1<<20, interval=50, height=200, **kwargs):
+        Frame.__init__(self, master, **kwargs)
+        self.span = span
+        self.capacity = capacity
+        self.interval = interval
+        self.series = {}
+        self.order = []
+        self.markers = deque(maxlen=256)
+        self.latest = None
+        self.show_encode = IntVar(self, 1)
+
+        self.canvas = Canvas(self, height=height, bg='white', highlightthickness=0)
+        self.toggle = Checkbutton(self, text="Show sensor probabilities", variable=self.show_encode)
+        self.canvas.grid(row=0, column=0, sticky=NSEW)
+        self.toggle.grid(row=1, column=0, sticky=W)
+        self.rowconfigure(index=0, weight=1)
+        self.columnconfigure(index=0, weight=1)
+
+        # canvas items per series: min/max trace, threshold line, legend entry
+        self.items = {}
+        self.after(self.interval, self.redraw)
+
+    def add_records(self, records):
+        """
+        Takes log records (dicts with 'created' and a JSON 'msg')
+        """
+        for rec in records:
+            try:
+                msg = json.loads(rec['msg'])
+                kind = msg.get('type')
+            except (ValueError, AttributeError, KeyError):
+                continue
+            t = rec['created']
+            if kind=='query':
+                series = self.get_series('query: %s' % msg['query'])
+                series.append(t, float(msg['value']))
+                series.threshold = float(msg['threshold'])
+            elif kind=='encode':
+                self.get_series('p(%s)' % msg['target']).append(t, float(msg['p']))
+            elif kind=='encode_summary':
+                # aggregated at the source (see config.LOG_POLICIES)
+                self.get_series('p(%s)' % msg['target']).append(t, float(msg['mean']))
+            elif kind=='fire_event':
+                self.markers.append((t, msg['event']))
+            else:
+                continue
+            self.latest = t if self.latest is None else max(self.latest, t)
+
+    def get_series(self, name):
+        series = self.series.get(name)
+        if series is None:
+            series = self.series[name] = Series(self.capacity)
+            self.order.append(name)
+            colour = COLOURS[(len(self.order)-1) % len(COLOURS)]
+            self.items[name] = {
+                'trace': self.canvas.create_line(0, 0, 0, 0, fill=colour),
+                'threshold': self.canvas.create_line(0, 0, 0, 0, fill=colour, dash=(4, 4)),
+                'legend': self.canvas.create_text(0, 0, text=name, fill=colour, anchor=NW)}
+        return series
+
+    def redraw(self):
+        try:
+            self.draw()
+        finally:
+            self.after(self.interval, self.redraw)
+
+    def draw(self):
+        width = max(self.canvas.winfo_width(), 2)
+        height = max(self.canvas.winfo_height(), 2)
+        if self.latest is None:
+            return
+        # one column past the latest sample, so it falls inside [t0, t1)
+        t1 = self.latest + self.span/width
+        t0 = t1-self.span
+        def y(p):
+            return 4 + (1-p)*(height-8)
+
+        legend_y = 4
+        x = np.arange(width)
+        for name in self.order:
+            series = self.series[name]
+            items = self.items[name]
+            visible = self.show_encode.get() or not name.startswith('p(')
+            lo, hi = series.decimate(t0, t1, width) if visible else (None, None)
+            if lo is None or not np.any(~np.isnan(lo)):
+                for item in items.values():
+                    self.canvas.itemconfigure(item, state=HIDDEN)
+                continue
+
+            # a zig-zag through each column's min and max
+            drawn = ~np.isnan(lo)
+            coords = np.empty((drawn.sum(), 4))
+            coords[:, 0] = coords[:, 2] = x[drawn]
+            coords[:, 1] = y(lo[drawn])
+            coords[:, 3] = y(hi[drawn])
+            self.canvas.coords(items['trace'], *coords.ravel().tolist())
+            self.canvas.itemconfigure(items['trace'], state=NORMAL)
+
+            if series.threshold is not None:
+                self.canvas.coords(items['threshold'], 0, y(series.threshold), width, y(series.threshold))
+                self.canvas.itemconfigure(items['threshold'], state=NORMAL)
+            self.canvas.coords(items['legend'], 6, legend_y)
+            self.canvas.itemconfigure(items['legend'], state=NORMAL)
+            legend_y += 14
+
+        self.canvas.delete('marker')
+        for t, event in self.markers:
+            if t0<=t<t1:
+                mx = (t-t0)/(t1-t0)*width
+                self.canvas.create_line(mx, 0, mx, height, fill='gray', tags='marker')
+                self.canvas.create_text(mx+2, height-4, text=event, fill='gray', anchor=SW, tags='marker')
+
+if __name__=="__main__":
+    import time
+    root = Tk()
+    root.geometry('800x300')
+    plot = LivePlot(root, span=10.0)
+    plot.pack(fill=BOTH, expand=1)
+    start = time.time()
+    def feed():
+        now = time.time()
+        ts = np.linspace(now-0.05, now, 5000)
+        records = [{'created': t, 'msg': json.dumps({'type': 'query', 'query': 'grasp?', 'threshold': '0.86466472',
+                                                     'value': '%.8f' % (0.5+0.45*np.sin(t-start)+0.05*np.random.rand())})}
+                   for t in ts]
+        if np.sin(now-start)>0.95:
+            records.append({'created': now, 'msg': json.dumps({'type': 'fire_event', 'fsm': 'hand', 'event': 'grasp'})})
+        plot.add_records(records)
+        root.after(50, feed)
+    feed()
+    root.mainloop()
@@ -0,0 +1,425 @@
+import numpy as np
+import ast, json, urllib
+import os, sys, time
+from multiprocessing import Pool
+
+# Columnar storage for shared_control_*.log sessions.
+# Each line of a session log is str(rec) for a logging record whose msg is a JSON
+# object with a 'type'. A session converts to a directory with one table per
+# type; each table is a set of flat column files plus a schema.json:
+#   float columns ('f8'): numbers and numeric strings (p, value, threshold, ...)
+#   category columns ('cat'): strings, stored as int32 codes (-1 = missing)
+#   string columns ('str'): free text with too many distinct values for a
+#       category column (e.g. the encode 'result'), stored as int64 (offset,
+#       length) pairs into a .blob file of UTF-8 text (length -1 = missing)
+# Every table has 'time' (the record's created time) and 'logger' columns.
+# Nested dicts are flattened one level ("value.gripped" for sensor_update).
+
+FLOAT = 'f8'
+CATEGORY = 'cat'
+STRING = 'str'
+DTYPES = {FLOAT: np.float64, CATEGORY: np.int32, STRING: np.int64}
+MISSING = {FLOAT: np.nan, CATEGORY: -1, STRING: None}
+
+# a category column with more distinct values than this becomes a string
+# column, so the category table held in memory stays bounded
+MAX_CATEGORIES = 1024
+
+def as_float(v):
+    if isinstance(v, (int, long, float)) and not isinstance(v, bool):
+        return float(v)
+    if isinstance(v, basestring):
+        try:
+            return float(v.strip('[] '))
+        except ValueError:
+            return None
+    return None
+
+def flatten(msg):
+    """
+    Returns the fields of a decoded message with nested dicts flattened one level
+    """
+    fields = {}
+    for key, v in msg.iteritems():
+        if key=='type':
+            continue
+        if isinstance(v, dict):
+            for sub, w in v.iteritems():
+                fields['%s.%s' % (key, sub)] = w
+        else:
+            fields[key] = v
+    return fields
+
+def file_name(name):
+    return urllib.quote(name, safe='')
+
+class ColumnWriter(object):
+    """
+    Appends values of one column to its file, a chunk at a time
+    """
+    def __init__(self, path, name, kind):
+        self.path = path
+        self.name = name
+        self.kind = kind
+        self.fname = file_name(name) + '.bin'
+        self.f = open(os.path.join(path, self.fname), 'wb')
+        self.length = 0
+        self.categories = {}
+        self.buf = []
+        self.blob_name = None
+        self.blob = None
+        self.blob_length = 0
+
+    def pad(self, rows):
+        """
+        Fills with missing values up to rows
+        """
+        if rows>self.length+len(self.buf):
+            self.buf.extend([MISSING[self.kind]]*(rows-self.length-len(self.buf)))
+
+    def append(self, v):
+        if self.kind==FLOAT:
+            f = as_float(v)
+            self.buf.append(np.nan if f is None else f)
+            return
+        if v is not None and not isinstance(v, basestring):
+            v = json.dumps(v)
+        if self.kind==CATEGORY:
+            if v is None:
+                v = -1
+            elif v in self.categories:
+                v = self.categories[v]
+            elif len(self.categories)<MAX_CATEGORIES:
+                self.categories[v] = len(self.categories)
+                v = self.categories[v]
+            else:
+                self.to_strings()
+        self.buf.append(v)
+
+    def to_strings(self):
+        """
+        Turns this category column into a string column, rewriting the codes
+        written so far as strings, a chunk at a time
+        """
+        self.flush()
+        self.f.close()
+        categories = [None]*len(self.categories)
+        for v, code in self.categories.iteritems():
+            categories[code] = v
+        fname = os.path.join(self.path, self.fname)
+        os.rename(fname, fname + '.codes')
+        codes = np.memmap(fname + '.codes', mode='r', dtype=DTYPES[CATEGORY], shape=(self.length,)) \
+            if self.length else np.zeros(0, dtype=DTYPES[CATEGORY])
+
+        self.kind = STRING
+        self.categories = {}
+        self.f = open(fname, 'wb')
+        self.blob_name = file_name(self.name) + '.blob'
+        self.blob = open(os.path.join(self.path, self.blob_name), 'wb')
+        self.length = 0
+        chunk = 65536
+        for start in range(0, len(codes), chunk):
+            self.buf = [categories[c] if c>=0 else None for c in codes[start:start+chunk]]
+            self.flush()
+        del codes
+        os.remove(fname + '.codes')
+
+    def flush(self):
+        if not self.buf:
+            return
+        if self.kind==STRING:
+            pairs = np.empty((len(self.buf), 2), dtype=DTYPES[STRING])
+            for k, v in enumerate(self.buf):
+                if v is None:
+                    pairs[k] = (0, -1)
+                else:
+                    data = v.encode('utf-8')
+                    self.blob.write(data)
+                    pairs[k] = (self.blob_length, len(data))
+                    self.blob_length += len(data)
+            pairs.tofile(self.f)
+        else:
+            np.array(self.buf, dtype=DTYPES[self.kind]).tofile(self.f)
+        self.length += len(self.buf)
+        self.buf = []
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        if self.blob is not None:
+            self.blob.close()
+
+    def schema(self):
+        schema = {'kind': self.kind, 'file': self.fname, 'length': self.length}
+        if self.kind==STRING:
+            schema['blob'] = self.blob_name
+        if self.kind==CATEGORY:
+            categories = [None]*len(self.categories)
+            for v, code in self.categories.iteritems():
+                categories[code] = v
+            schema['categories'] = categories
+        return schema
+
+class TableWriter(object):
+    """
+    Buffers rows of one event type and writes them out column by column every
+    chunk_rows rows, so memory use does not grow with the session
+    """
+    def __init__(self, path, chunk_rows):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.chunk_rows = chunk_rows
+        self.columns = {}
+        self.rows = 0
+        self.last_time = -np.inf
+        self.sorted = True
+
+    def append(self, created, logger, fields):
+        if created<self.last_time:
+            self.sorted = False
+        self.last_time = created
+        fields = dict(fields, time=created, logger=logger)
+        for name, v in fields.iteritems():
+            column = self.columns.get(name)
+            if column is None:
+                kind = CATEGORY if as_float(v) is None or name=='logger' else FLOAT
+                column = self.columns[name] = ColumnWriter(self.path, name, kind)
+            column.pad(self.rows)
+            column.append(v)
+        self.rows += 1
+        if self.rows % self.chunk_rows==0:
+            self.flush()
+
+    def flush(self):
+        for column in self.columns.itervalues():
+            column.pad(self.rows)
+            column.flush()
+
+    def close(self):
+        self.flush()
+        for column in self.columns.itervalues():
+            column.close()
+        return {'rows': self.rows,
+                'sorted': self.sorted,
+                'columns': dict((name, column.schema()) for name, column in self.columns.iteritems())}
+
+def convert(log_file, out_dir=None, chunk_rows=65536):
+    """
+    Streams a session log into columnar tables under out_dir (default:
+    <log_file>.columns). Returns the path of the written schema.json.
+    """
+    if out_dir is None:
+        out_dir = log_file + '.columns'
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    start = time.time()
+    tables = {}
+    lines = 0
+    skipped = 0
+    with open(log_file) as f:
+        for line in f:
+            lines += 1
+            try:
+                rec = ast.literal_eval(line)
+                msg = json.loads(rec['msg'])
+                table_type = msg['type']
+            except Exception:
+                # not a record with a JSON message (e.g. plain text logging)
+                skipped += 1
+                continue
+            table = tables.get(table_type)
+            if table is None:
+                table = tables[table_type] = TableWriter(os.path.join(out_dir, file_name(table_type)), chunk_rows)
+            table.append(rec['created'], rec.get('name', ''), flatten(msg))
+
+    schema = {'source': os.path.abspath(log_file),
+              'lines': lines,
+              'skipped': skipped,
+              'elapsed': time.time()-start,
+              'tables': dict((name, dict(table.close(), dir=os.path.basename(table.path)))
+                             for name, table in tables.iteritems())}
+    fname = os.path.join(out_dir, 'schema.json')
+    with open(fname, 'w') as f:
+        json.dump(schema, f, indent=1)
+    return fname
+
+def convert_all(log_files, processes=None, chunk_rows=65536):
+    """
+    Converts several session logs in parallel, one process per file
+    """
+    pool = Pool(processes)
+    try:
+        results = [pool.apply_async(convert, (log_file, None, chunk_rows)) for log_file in log_files]
+        return [result.get() for result in results]
+    finally:
+        pool.close()
+        pool.join()
+
+class Table(object):
+    """
+    One event type of a converted session. Columns are memory-mapped, so opening
+    a table costs nothing and slices only read the pages they touch.
+    """
+    def __init__(self, path, schema):
+        self.path = path
+        self.rows = schema['rows']
+        self.sorted = schema['sorted']
+        self.schema = schema['columns']
+        self.cache = {}
+
+    def __len__(self):
+        return self.rows
+
+    def names(self):
+        return sorted(self.schema)
+
+    def column(self, name):
+        """
+        The raw column: float64 values, int32 codes for category columns, or
+        (offset, length) pairs for string columns
+        """
+        if name not in self.cache:
+            column = self.schema[name]
+            shape = (self.rows, 2) if column['kind']==STRING else (self.rows,)
+            if self.rows==0:
+                self.cache[name] = np.zeros(shape, dtype=DTYPES[column['kind']])
+            else:
+                self.cache[name] = np.memmap(os.path.join(self.path, column['file']), mode='r',
+                                             dtype=DTYPES[column['kind']], shape=shape)
+        return self.cache[name]
+
+    def code(self, name, value):
+        """
+        The code of a category value in a column, or None if it never occurs
+        """
+        categories = self.schema[name].get('categories', [])
+        return categories.index(value) if value in categories else None
+
+    def decode(self, name, codes):
+        """
+        The strings for values of a category or string column
+        """
+        column = self.schema[name]
+        if column['kind']==STRING:
+            with open(os.path.join(self.path, column['blob']), 'rb') as f:
+                strings = []
+                for offset, length in codes:
+                    if length<0:
+                        strings.append(None)
+                    else:
+                        f.seek(offset)
+                        strings.append(f.read(length).decode('utf-8'))
+                return strings
+        categories = column['categories']
+        return [categories[c] if c>=0 else None for c in codes]
+
+    def time_range(self, t0=None, t1=None):
+        """
+        Rows with t0 <= time < t1, as a slice (sorted tables) or an index array
+        """
+        times = self.column('time')
+        if self.sorted:
+            start = 0 if t0 is None else np.searchsorted(times, t0, 'left')
+            stop = len(times) if t1 is None else np.searchsorted(times, t1, 'left')
+            return slice(start, stop)
+        mask = np.ones(len(times), dtype=bool)
+        if t0 is not None:
+            mask &= times>=t0
+        if t1 is not None:
+            mask &= times<t1
+        return np.nonzero(mask)[0]
+
+    def select(self, columns, t0=None, t1=None, **where):
+        """
+        Returns a dict of column -> array for rows in [t0, t1) whose category
+        columns equal the given values, e.g. select(['time', 'value'], query='grasp?')
+        """
+        rows = self.time_range(t0, t1)
+        if where:
+            mask = None
+            for name, value in where.iteritems():
+                if name in self.schema and self.schema[name]['kind']==STRING:
+                    match = np.array([s==value for s in self.decode(name, self.column(name)[rows])], dtype=bool)
+                    mask = match if mask is None else mask & match
+                    continue
+                code = self.code(name, value) if name in self.schema else None
+                if code is None:
+                    return dict((c, np.zeros(0)) for c in columns)
+                match = self.column(name)[rows]==code
+                mask = match if mask is None else mask & match
+            if isinstance(rows, slice):
+                rows = np.arange(rows.start, rows.stop)[mask]
+            else:
+                rows = rows[mask]
+        return dict((c, np.asarray(self.column(c)[rows])) for c in columns)
+
+class Session(object):
+    """
+    A converted session log (the directory written by convert())
+    """
+    def __init__(self, path):
+        if path.endswith('.log'):
+            path = path + '.columns'
+        self.path = path
+        with open(os.path.join(path, 'schema.json')) as f:
+            self.schema = json.load(f)
+        self.tables = {}
+
+    def types(self):
+        return sorted(self.schema['tables'])
+
+    def table(self, table_type):
+        if table_type not in self.tables:
+            schema = self.schema['tables'][table_type]
+            self.tables[table_type] = Table(os.path.join(self.path, schema['dir']), schema)
+        return self.tables[table_type]
+
+    # query helpers
+
+    def posteriors(self, query, t0=None, t1=None):
+        """
+        (times, p, threshold) of an output's query (e.g. "grasp?") over [t0, t1)
+        """
+        r = self.table('query').select(['time', 'value', 'threshold'], t0, t1, query=query)
+        return r['time'], r['value'], r['threshold']
+
+    def sensor_probs(self, target, t0=None, t1=None):
+        """
+        (times, p) of an encoded sensor node over [t0, t1)
+        """
+        r = self.table('encode').select(['time', 'p'], t0, t1, target=target)
+        return r['time'], r['p']
+
+    def fired(self, t0=None, t1=None):
+        """
+        List of (time, fsm, event) for every fire_event record in [t0, t1)
+        """
+        table = self.table('fire_event')
+        rows = table.time_range(t0, t1)
+        events = table.decode('event', table.column('event')[rows])
+        fsms = [None]*len(events)
+        for name in ('fsm', 'FSM'):
+            if name in table.schema:
+                for k, fsm in enumerate(table.decode(name, table.column(name)[rows])):
+                    fsms[k] = fsms[k] or fsm
+        return zip(table.column('time')[rows].tolist(), fsms, events)
+
+    def transitions(self, t0=None, t1=None):
+        """
+        List of (time, event, src, dst) for FSM transitions in [t0, t1)
+        """
+        table = self.table('transition')
+        rows = table.time_range(t0, t1)
+        columns = [table.decode(name, table.column(name)[rows]) for name in ('event', 'src', 'dst')]
+        return zip(table.column('time')[rows].tolist(), *columns)
+
+if __name__=="__main__":
+    if len(sys.argv)<2:
+        print('usage: log_columns.py shared_control_*.log ...')
+        sys.exit(-1)
+    for schema in convert_all(sys.argv[1:]):
+        session = Session(os.path.dirname(schema))
+        print('%s: %d lines in %.2fs' % (session.schema['source'], session.schema['lines'], session.schema['elapsed']))
+        for table_type in session.types():
+            print('    %s: %d rows' % (table_type, len(session.table(table_type))))
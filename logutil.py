@@ -1,5 +1,7 @@
 import socket
 import logging
+import json
+from threading import Lock
 from logging.handlers import DatagramHandler
 import config
 
@@ -20,9 +22,151 @@ class DatagramHandler2(DatagramHandler):
         except socket.error:
             pass
 
+    def close(self):
+        # emit the aggregate windows still open, while the handlers can send them
+        policy_filter.flush()
+        DatagramHandler.close(self)
+
+# json.dumps writes a record's type as '"type": "<type>"'
+TYPE_FIELD = '"type": "'
+
+def record_type(msg):
+    """
+    The 'type' of a JSON log message, found without parsing it; a nested
+    'type' can be found instead, so callers parse the message to confirm
+    """
+    start = msg.find(TYPE_FIELD)
+    if start<0:
+        return None
+    start += len(TYPE_FIELD)
+    end = msg.find('"', start)
+    return msg[start:end] if end>=0 else None
+
+class PolicyFilter(logging.Filter):
+    """
+    Applies per-type policies (config.LOG_POLICIES) to JSON log records, at
+    the source so dropped records are never sent. Each policy works per key
+    (the value of the policy's 'key' field in the record, e.g. the target):
+        sample: pass every Nth record ('every')
+        delta: pass a record when its 'field' moved by at least 'delta' since
+            the last one passed, or 'max_interval' seconds have gone by
+        aggregate: pass one '<type>_summary' record per 'window' seconds with
+            the count, min, max and mean of 'field'
+    Types without a policy (fire_event, transition, ...) pass unchanged.
+    Messages are only parsed when their type has a policy that needs the
+    fields; records of other types, and sampled ones, are decided on the type alone.
+    """
+    def __init__(self, policies):
+        logging.Filter.__init__(self)
+        self.policies = policies
+        self.lock = Lock()
+        self.state = {}
+        # open aggregate windows, by key
+        self.windows = {}
+        self.passed = {}
+        self.dropped = {}
+
+    def filter(self, record):
+        msg = record.msg
+        if not isinstance(msg, basestring) or not msg.startswith('{'):
+            return True
+        kind = record_type(msg)
+        policy = self.policies.get(kind)
+        if policy is None:
+            return True
+        rec = None
+        if policy['policy']!='sample' or 'key' in policy:
+            try:
+                rec = json.loads(msg)
+                kind = rec.get('type')
+            except (ValueError, AttributeError):
+                return True
+            policy = self.policies.get(kind)
+            if policy is None:
+                return True
+
+        with self.lock:
+            key = (kind, None if rec is None else rec.get(policy.get('key')))
+            keep = getattr(self, policy['policy'])(policy, key, rec, record)
+            counts = self.passed if keep else self.dropped
+            counts[kind] = counts.get(kind, 0) + 1
+        return keep
+
+    def sample(self, policy, key, rec, record):
+        n = self.state.get(key, 0)
+        self.state[key] = n+1
+        return n % policy['every'] == 0
+
+    def delta(self, policy, key, rec, record):
+        value = float(rec[policy['field']])
+        last = self.state.get(key)
+        if last is not None:
+            last_value, last_time = last
+            if abs(value-last_value)<policy['delta'] and \
+                    record.created-last_time<policy.get('max_interval', float('inf')):
+                return False
+        self.state[key] = (value, record.created)
+        return True
+
+    def aggregate(self, policy, key, rec, record):
+        value = float(rec[policy['field']])
+        agg = self.windows.get(key)
+        if agg is None:
+            agg = self.windows[key] = {'start': record.created, 'count': 0, 'sum': 0.0,
+                                     'min': value, 'max': value, 'policy': policy}
+        agg['count'] += 1
+        agg['sum'] += value
+        agg['min'] = min(agg['min'], value)
+        agg['max'] = max(agg['max'], value)
+        # where flush() sends a window that no later record closes
+        agg['logger'], agg['level'], agg['last'] = record.name, record.levelno, record.created
+        if record.created-agg['start']<policy['window']:
+            return False
+
+        # the record that closes the window carries the summary
+        del self.windows[key]
+        record.msg = self.summary(key, agg, record.created)
+        record.args = None
+        return True
+
+    def summary(self, key, agg, end):
+        policy = agg['policy']
+        summary = {'type': '%s_summary' % key[0], 'field': policy['field'],
+                   'window': end-agg['start'], 'count': agg['count'],
+                   'min': '%.8f' % agg['min'], 'max': '%.8f' % agg['max'],
+                   'mean': '%.8f' % (agg['sum']/agg['count'])}
+        if 'key' in policy:
+            summary[policy['key']] = key[1]
+        return json.dumps(summary)
+
+    def flush(self):
+        """
+        Emits the summaries of the aggregate windows still open (e.g. when the
+        logging stops), through the logger of each window's last record
+        """
+        with self.lock:
+            windows = self.windows.items()
+            self.windows = {}
+        for key, agg in windows:
+            logger = logging.getLogger(agg['logger'])
+            logger.handle(logger.makeRecord(agg['logger'], agg['level'], __file__, 0,
+                                            self.summary(key, agg, agg['last']), None, None))
+
+    def stats(self):
+        """
+        Records passed and dropped so far, per type
+        """
+        with self.lock:
+            return {'passed': dict(self.passed), 'dropped': dict(self.dropped)}
+
+# one filter shared by all loggers, so the policies see every record of a type
+policy_filter = PolicyFilter(config.LOG_POLICIES)
+
 def get_logger(name):
     logger = logging.getLogger(name)
     logger.propagate = config.LOG_TO_STDOUT
     logger.setLevel(config.LOG_LEVEL)
     logger.addHandler(DatagramHandler2(config.LOG_IP, config.LOG_PORT))
+    if policy_filter not in logger.filters:
+        logger.addFilter(policy_filter)
     return logger
@@ -1,12 +1,15 @@
 import sys, os
 from Tkinter import *
+import tkFont
 from tkFileDialog import askdirectory
 import socket, cPickle, logging
 from datetime import datetime
 from threading import Thread
-from time import sleep
+from time import sleep, time
 from Queue import Queue, Empty
-from shared import SharedControl
+from graph_render import GraphRenderer, open_image
+from live_plot import LivePlot
+from message_store import MessageStore, RecordIndex
 import demjson, json
 import config
 
@@ -63,27 +66,41 @@ class LogReceiver(Thread):
 class LogViewer(object):
 
     DEFAULT_BG = '#f0f0ed'
+    # records checked against a new filter per update
+    FILTER_CHUNK = 20000
 
     def __init__(self):
         self.receiver = LogReceiver()
-        self.messages = []
-        self.filtered_messages = []
+        # all records, bounded in memory; the listbox only holds the rows in view
+        self.messages = MessageStore()
+        # numbers of the records matching the filter (None: no filter), and how
+        # many records have been checked against it so far
+        self.filtered_messages = None
+        self.filter_pos = 0
+        # row at the top of the listbox, counting from the newest (row 0)
+        self.view_top = 0
+        # number of the selected record, kept across refreshes
+        self.selected = None
         self.fsm_path = []
         self.model = None
+        self.renderer = GraphRenderer()
+        self.render_job = None
 
         self.root = Tk()
-        self.root.geometry('950x500+50+50')
+        self.root.geometry('950x750+50+50')
         self.root.title("Shared control log viewer [%s]" % self.receiver.get_log_name())
 
         # grid row/col weighting adjustments
         self.root.rowconfigure(index=1, weight=1)
         self.root.rowconfigure(index=9, weight=1)
+        self.root.rowconfigure(index=10, weight=1)
         self.root.columnconfigure(index=0, weight=1)
         self.root.columnconfigure(index=1, weight=1)
 
         # StringVars for the text widgets that need modified
         self.filter_message = StringVar(self.root, "")
         self.filter_text = StringVar()
+        self.render_status = StringVar(self.root, "")
 
         # create all the Tk widgets
 
@@ -103,8 +120,12 @@ class LogViewer(object):
         self.jsontext = Text(self.root, height=6)
         # Label for the JSON text widget
         self.jsonheader = Label(self.root, text="JSON:", bg=LogViewer.DEFAULT_BG)
+        # Live plot of query and encode probabilities
+        self.plot = LivePlot(self.root, bg=LogViewer.DEFAULT_BG)
 
         self.chartbutton = Button(self.root, text="View model graph", bg=LogViewer.DEFAULT_BG, padx=6, pady=6, command=self.show_chart)
+        # Progress of a model graph being rendered
+        self.render_label = Label(self.root, textvariable=self.render_status, bg=LogViewer.DEFAULT_BG)
 
         # place all the widgets using the grid layout manager
 
@@ -114,20 +135,25 @@ class LogViewer(object):
         self.listhscroll.grid(row=5, column=0, columnspan=8, sticky=EW)
     
         self.chartbutton.grid(row=6, column=2, sticky=EW)
+        self.render_label.grid(row=7, column=2, sticky=EW)
 
         self.filter_label.grid(row=6, column=0, sticky=E)
         self.filter.grid(row=6, column=1, sticky=EW)
 
         self.jsonheader.grid(row=8, column=0, sticky=W)
         self.jsontext.grid(row=9, column=0, columnspan=8, padx=5, pady=5, sticky=NSEW)
+        self.plot.grid(row=10, column=0, columnspan=8, padx=5, pady=5, sticky=NSEW)
 
         # set up event handling/states
 
         # call filter_updated whenever the filter_text value is modified
         self.filter_text.trace("w", self.filter_updated)
         # link scrollbars to listbox
-        self.listbox.config(yscrollcommand=self.listvscroll.set)
-        self.listvscroll.config(command=self.listbox.yview)
+        self.listvscroll.config(command=self.scroll_list)
+        self.listbox.bind('<MouseWheel>', lambda e: self.scroll_list('scroll', -e.delta/120*3, 'units'))
+        self.listbox.bind('<Button-4>', lambda e: self.scroll_list('scroll', -3, 'units'))
+        self.listbox.bind('<Button-5>', lambda e: self.scroll_list('scroll', 3, 'units'))
+        self.line_height = tkFont.Font(font=self.listbox.cget('font')).metrics('linespace')
         self.listbox.config(xscrollcommand=self.listhscroll.set)
         self.listhscroll.config(command=self.listbox.xview)
         # handle selections in the listbox
@@ -144,6 +170,7 @@ class LogViewer(object):
         self.root.after(50, self.update)
 
         self.receiver.start()
+        self.renderer.start()
 
         try:
             self.root.mainloop()
@@ -152,27 +179,53 @@ class LogViewer(object):
 
     def quit(self):
         self.receiver.stop()
+        self.messages.close()
+        self.renderer.stop()
         sys.exit(0)
 
     def show_chart(self):
+        """
+        Renders the model graph in the background; while a render is running the
+        button cancels it instead
+        """
+        if self.render_job is not None:
+            self.render_job.cancel()
+            return
+
         model_dir = askdirectory(initialdir=os.getcwd(), parent=self.root, title='Select model directory', mustexist=True)
         if not model_dir:
             return
 
         try:
-            self.model = SharedControl(model_dir)
-            fname = os.path.basename(model_dir)+'.png'
-            self.model.render_graph(fname)
-            if hasattr(os, 'startfile'):
-                # only on Windows
-                os.startfile(fname)
-            else:
-                # for macs
-                os.system('open "%s"' % fname)
+            self.render_job = self.renderer.request(model_dir)
+            self.chartbutton.config(text="Cancel rendering")
         except Exception, e:
             print('Failed to load model files from "%s"' % model_dir)
-            
-        
+
+    def poll_render(self):
+        """
+        Shows the progress of the current render job, and the image once it is done
+        """
+        job = self.render_job
+        if job is None:
+            return
+        if not job.done and not job.cancelled:
+            self.render_status.set('%s (%d%%)' % (job.stage, 100*job.progress))
+            return
+
+        self.render_job = None
+        self.chartbutton.config(text="View model graph")
+        if job.cancelled:
+            self.render_status.set('Rendering cancelled')
+        elif job.error is not None:
+            print('Failed to load model files from "%s"' % job.model_dir)
+            self.render_status.set('Rendering failed')
+        else:
+            if job.model is not None:
+                self.model = job.model
+            self.render_status.set('Cached graph' if job.cached else 'Rendered in %.1fs' % (time()-job.started))
+            open_image(os.path.abspath(job.fname))
+
     def format_rec(self, rec):
         """
         Formats a log record object for display in the listbox
@@ -190,6 +243,7 @@ class LogViewer(object):
         if len(w.curselection()) == 0:
             return
         index = int(w.curselection()[0])
+        self.selected = self.record_number(self.view_top+index)
 
         # get the content of the selected index
         val = w.get(index)
@@ -216,7 +270,9 @@ class LogViewer(object):
         """
         Returns the label text for the filter text box 
         """
-        return 'Filter messages [showing %d/%d]:' % (self.listbox.size(), len(self.messages))
+        if self.filter_pos<len(self.messages) and self.filtered_messages is not None:
+            return 'Filter messages [filtering %d/%d]:' % (self.filter_pos, len(self.messages))
+        return 'Filter messages [showing %d/%d]:' % (self.shown(), len(self.messages))
 
     def record_matches(self, rec, filt):
         """
@@ -228,41 +284,135 @@ class LogViewer(object):
 
         return False
 
-    def filter_updated(self, name, index, mode):
+    def shown(self):
         """
-        Handler for the user typing in the filter text widget. Updates the content
-        of the listbox based on the new filter text.
+        Number of records passing the filter
         """
-        # retrieve current text and delete all listbox content
-        filt = self.filter_text.get()
-        self.listbox.delete(0, END)
+        if self.filtered_messages is None:
+            return len(self.messages)
+        return len(self.filtered_messages)
+
+    def record_number(self, row):
+        """
+        The number in the message store of the record shown in a row of the list, newest first
+        """
+        n = self.shown()-1-row
+        if self.filtered_messages is not None:
+            n = self.filtered_messages[n]
+        return n
+
+    def record_at(self, row):
+        return self.messages[self.record_number(row)]
 
-        # find all messages matching the current filter text
-        fm = []
-        for m in self.messages:
-            if len(filt) == 0 or self.record_matches(m, filt):
-                fm.append(m)
-                self.listbox.insert(0, self.format_rec(m))
+    def visible_rows(self):
+        return max(1, self.listbox.winfo_height() // self.line_height)
 
-        self.filtered_messages = fm
+    def refresh_list(self):
+        """
+        Fills the listbox with the rows in view, reading old records back from
+        the message store as needed, and sets the scrollbar to match
+        """
+        shown = self.shown()
+        rows = self.visible_rows()
+        self.view_top = max(0, min(self.view_top, shown-rows))
+        xview = self.listbox.xview()[0]
+        self.listbox.delete(0, END)
+        for row in range(self.view_top, min(self.view_top+rows, shown)):
+            self.listbox.insert(END, self.format_rec(self.record_at(row)))
+            if self.record_number(row)==self.selected:
+                self.listbox.selection_set(END)
+        self.listbox.xview_moveto(xview)
+        self.set_scrollbar()
+
+    def prepend_rows(self, added):
+        """
+        Shows <added> new records at the top of a list scrolled to the newest
+        row, leaving the other rows (and the selection among them) as they are
+        """
+        rows = self.visible_rows()
+        for row in reversed(range(min(added, rows))):
+            self.listbox.insert(0, self.format_rec(self.record_at(row)))
+        self.listbox.delete(rows, END)
+        self.set_scrollbar()
+
+    def set_scrollbar(self):
+        shown = self.shown()
+        if shown==0:
+            self.listvscroll.set(0, 1)
+        else:
+            self.listvscroll.set(float(self.view_top)/shown, float(self.view_top+self.visible_rows())/shown)
+
+    def scroll_list(self, *args):
+        """
+        Scrollbar/mouse wheel handler: ('moveto', fraction) or ('scroll', n, 'units'|'pages')
+        """
+        rows = self.visible_rows()
+        if args[0]=='moveto':
+            self.view_top = int(float(args[1])*self.shown())
+        elif args[0]=='scroll':
+            step = rows if args[2]=='pages' else 1
+            self.view_top += int(args[1])*step
+        self.refresh_list()
+
+    def scan_filter(self):
+        """
+        Checks the next records against the filter (a chunk at a time, so a new
+        filter over a long session does not block the UI). Returns the number
+        of new matches.
+        """
+        if self.filtered_messages is None:
+            self.filter_pos = len(self.messages)
+            return 0
+        filt = self.filter_text.get()
+        matches = 0
+        stop = min(len(self.messages), self.filter_pos+LogViewer.FILTER_CHUNK)
+        for n in range(self.filter_pos, stop):
+            if self.record_matches(self.messages[n], filt):
+                self.filtered_messages.append(n)
+                matches += 1
+        self.filter_pos = stop
+        return matches
+
+    def filter_updated(self, name, index, mode):
+        """
+        Handler for the user typing in the filter text widget. Restarts the
+        filtering from the oldest record.
+        """
+        if self.filtered_messages is not None:
+            self.filtered_messages.close()
+        if len(self.filter_text.get()) == 0:
+            self.filtered_messages = None
+        else:
+            self.filtered_messages = RecordIndex(self.messages.path)
+        self.filter_pos = 0
+        self.view_top = 0
+        self.scan_filter()
+        self.refresh_list()
         self.filter_message.set(self.get_filter_message())
 
     def update(self):
         """
         Called every 50ms using after() to retrieve newly received messages from
-        the LogReceiver instance. Adds any messages matching the current filter
-        to the listbox and appends all of them to the overall list.
+        the LogReceiver instance. Stores them, filters them and adds the new rows
+        in view; a list scrolled away from the newest row stays where it is.
         """
         new_messages = self.receiver.get_messages()
+        before = self.shown()
         if len(new_messages) > 0:
-            filt = self.filter_text.get()
-            for n in new_messages:
-                if len(filt) == 0 or self.record_matches(n, filt):
-                    self.listbox.insert(0, self.format_rec(n))
-                    self.filtered_messages.append(n)
             self.messages.extend(new_messages)
+            self.plot.add_records(new_messages)
+        self.scan_filter()
+        added = self.shown()-before
+        if added > 0:
+            if self.view_top > 0:
+                # the rows in view are unchanged; only the scrollbar moves
+                self.view_top += added
+                self.set_scrollbar()
+            else:
+                self.prepend_rows(added)
 
         self.filter_message.set(self.get_filter_message())
+        self.poll_render()
         self.root.after(50, self.update)
 
 if __name__ == "__main__":
@@ -0,0 +1,221 @@
+import numpy as np
+import copy
+import string
+import kernels
+
+# smallest message value, so messages can be divided out in the log domain
+TINY = 1e-300
+
+class LoopyBP(object):
+    """
+    Loopy belief propagation over a CompiledNet.
+    Each inferred node becomes one factor over (parents..., node). Factors of the
+    same arity are stacked, so every factor-to-variable message for a given
+    position is computed by a single einsum. Messages are kept between frames,
+    one set per evidence context (the clamped fsm_input nodes and any observed
+    inferred nodes), so each frame starts from the messages last converged
+    under the same clamping.
+    """
+    def __init__(self, net, damping=0.5, tolerance=1e-6, max_iterations=100, backend=None):
+        self.net = net
+        self.exp_normalise = kernels.select(exp_normalise, backend)
+        self.normalise = kernels.select(normalise, backend)
+        self.damping = damping
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+
+        # one edge per (factor, position); edge_var is the variable at the end of each edge.
+        # CPTs may add auxiliary variables (e.g. noisy-OR chains), numbered after the nodes
+        self.n_vars = len(net.names)
+        edge_var = []
+        self.groups = []
+        by_arity = {}
+        for i, cpt in enumerate(net.cpts):
+            if cpt is None:
+                continue
+            for scope, table in cpt.factors(list(net.parents[i]) + [i], self.new_variable):
+                edges = range(len(edge_var), len(edge_var)+len(scope))
+                edge_var.extend(scope)
+                by_arity.setdefault(len(scope), []).append((table, edges))
+
+        for arity, factors in sorted(by_arity.iteritems()):
+            letters = string.ascii_letters.replace("z", "")[:arity]
+            # einsum subscripts for the message to each position
+            subscripts = []
+            for j in range(arity):
+                operands = ["z"+letters] + ["z"+letters[k] for k in range(arity) if k!=j]
+                subscripts.append("%s->z%s" % (",".join(operands), letters[j]))
+            self.groups.append({"tables": np.array([f[0] for f in factors]),
+                                "edges": np.array([f[1] for f in factors], dtype=np.intp),
+                                "subscripts": subscripts})
+
+        self.edge_var = np.array(edge_var, dtype=np.intp)
+        self.n_edges = len(edge_var)
+
+        # converged factor-to-variable messages, one set per (evidence context,
+        # run): see context() and query()
+        self.messages = {}
+        self.fsm_inputs = [i for i, kind in enumerate(net.types) if kind=="fsm_input"]
+        self.observable = [name for name, kind in zip(net.names, net.types) if kind=="inferred"]
+
+        # metrics
+        self.iterations = 0
+        self.frames = 0
+        self.total_iterations = 0
+        self.max_frame_iterations = 0
+
+    def new_variable(self):
+        self.n_vars += 1
+        return self.n_vars-1
+
+    def priors(self, sensor_evidence, fsm_evidence, clamps=()):
+        """
+        Unary potentials for every variable, as an (n, 2) array [p(F), p(T)]
+        """
+        net = self.net
+        prior = np.ones((self.n_vars, 2))
+        for i, name in enumerate(net.names):
+            if net.types[i]!="inferred":
+                p = net.root_prob(i, sensor_evidence, fsm_evidence)
+                prior[i, 0] = 1-p
+                prior[i, 1] = p
+            elif name in fsm_evidence:
+                prior[i, 1 if fsm_evidence[name]=="F" else 0] = 0.0
+        for i, value in clamps:
+            prior[i, 1-value] = 0.0
+        return prior
+
+    def context(self, fsm_evidence):
+        """
+        The clamping fsm_evidence applies: the value of each fsm_input node and
+        of each observed inferred node (None if unobserved)
+        """
+        return (tuple([int(self.net.root_prob(i, {}, fsm_evidence)) for i in self.fsm_inputs]),
+                tuple([fsm_evidence.get(name) for name in self.observable]))
+
+    def beliefs(self, prior, msgs):
+        """
+        Log of prior * product of all incoming factor messages, per variable
+        """
+        log_msgs = np.log(np.maximum(msgs, TINY))
+        with np.errstate(divide="ignore"):
+            log_belief = np.log(prior)
+        n = len(prior)
+        log_belief[:, 0] += np.bincount(self.edge_var, weights=log_msgs[:, 0], minlength=n)
+        log_belief[:, 1] += np.bincount(self.edge_var, weights=log_msgs[:, 1], minlength=n)
+        return log_belief, log_msgs
+
+    def run(self, key, prior):
+        """
+        Iterate to convergence from the stored messages for key; returns marginals p(T)
+        """
+        msgs = self.messages.get(key)
+        if msgs is None:
+            msgs = np.empty((self.n_edges, 2))
+            msgs.fill(0.5)
+        new_msgs = np.empty_like(msgs)
+
+        iterations = 0
+        for iterations in range(1, self.max_iterations+1):
+            log_belief, log_msgs = self.beliefs(prior, msgs)
+
+            # variable-to-factor messages: belief with the factor's own message divided out
+            var_msgs = self.exp_normalise(log_belief[self.edge_var] - log_msgs)
+
+            for group in self.groups:
+                edges = group["edges"]
+                arity = edges.shape[1]
+                for j in range(arity):
+                    others = [var_msgs[edges[:, k]] for k in range(arity) if k!=j]
+                    new_msgs[edges[:, j]] = np.einsum(group["subscripts"][j], group["tables"], *others)
+            self.normalise(new_msgs)
+
+            new_msgs *= 1-self.damping
+            new_msgs += self.damping*msgs
+            delta = np.max(np.abs(new_msgs-msgs)) if self.n_edges else 0.0
+            msgs, new_msgs = new_msgs, msgs
+            if delta<self.tolerance:
+                break
+
+        self.messages[key] = msgs
+        self.iterations += iterations
+
+        log_belief, log_msgs = self.beliefs(prior, msgs)
+        return self.exp_normalise(log_belief)[:, 1]
+
+    def query(self, sensor_evidence, fsm_evidence):
+        """
+        Returns a dict of output name -> (p, p, p). Conjunctive queries are
+        evaluated by the chain rule, with one extra clamped run per literal
+        """
+        self.iterations = 0
+        context = self.context(fsm_evidence)
+        marginals = self.run((context, None), self.priors(sensor_evidence, fsm_evidence))
+        results = {}
+        for output in self.net.outputs:
+            query = output["query"]
+            i, value = query[0]
+            p = marginals[i] if value else 1-marginals[i]
+            for k in range(1, len(query)):
+                if p<=0:
+                    break
+                prior = self.priors(sensor_evidence, fsm_evidence, query[:k])
+                conditional = self.run((context, output["name"], k), prior)
+                i, value = query[k]
+                p *= conditional[i] if value else 1-conditional[i]
+            results[output["name"]] = (p, p, p)
+
+        self.frames += 1
+        self.total_iterations += self.iterations
+        self.max_frame_iterations = max(self.max_frame_iterations, self.iterations)
+        return results
+
+    def stats(self):
+        return {"engine": "loopy_bp",
+                "iterations": self.iterations,
+                "mean_iterations": self.total_iterations / float(max(self.frames, 1)),
+                "max_iterations": self.max_frame_iterations}
+
+    def reset(self):
+        """
+        Discard the stored messages, so the next frame starts cold
+        """
+        self.messages = {}
+
+    def snapshot(self):
+        """
+        The warm-start messages, which the next frame's result depends on
+        """
+        return dict((key, msgs.copy()) for key, msgs in self.messages.iteritems())
+
+    def restore(self, snapshot):
+        self.messages = dict((key, msgs.copy()) for key, msgs in snapshot.iteritems())
+
+    def fork(self):
+        """
+        An engine for another session: the same factors, starting cold
+        """
+        engine = copy.copy(self)
+        engine.messages = {}
+        engine.iterations = engine.frames = engine.total_iterations = engine.max_frame_iterations = 0
+        return engine
+
+def exp_normalise(log_msgs):
+    """
+    Exponentiate and normalise each row of an (n, 2) array of log values
+    """
+    peak = np.max(log_msgs, axis=1)
+    peak[~np.isfinite(peak)] = 0.0
+    msgs = np.exp(log_msgs - peak[:, None])
+    normalise(msgs)
+    return msgs
+
+def normalise(msgs):
+    """
+    Normalise each row of an (n, 2) array in place; all-zero rows become uniform
+    """
+    total = msgs.sum(axis=1)
+    zero = total<=0
+    msgs[zero] = 0.5
+    total[zero] = 1.0
+    msgs /= total[:, None]
@@ -0,0 +1,173 @@
+import cPickle
+import numpy as np
+import os, sys, shutil, tempfile
+from array import array
+from collections import deque, OrderedDict
+from cStringIO import StringIO
+
+class MessageStore(object):
+    """
+    Append-only store of log records with bounded memory. The newest
+    memory_records records are held in memory; older ones are spilled to disk
+    in segments of pickled records, each with an index file of record offsets.
+    Records on disk are read back a page at a time, with a small LRU cache of
+    pages, so scrolling through old records only touches the pages in view.
+    Records are numbered from 0 in arrival order.
+    """
+    def __init__(self, path=None, memory_records=10000, segment_records=65536,
+                 page_records=256, cache_pages=16):
+        if segment_records % page_records:
+            raise ValueError("segment_records must be a multiple of page_records")
+        self.temporary = path is None
+        self.path = tempfile.mkdtemp(prefix='shared_control_messages_') if path is None else path
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.memory_records = memory_records
+        self.segment_records = segment_records
+        self.page_records = page_records
+        self.cache_pages = cache_pages
+
+        self.recent = deque()
+        self.spilled = 0
+        # closed segments: (data file, index file); segment k holds records
+        # k*segment_records .. (k+1)*segment_records-1
+        self.segments = []
+        self.f = None
+        self.offsets = array('l')
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return self.spilled + len(self.recent)
+
+    def append(self, rec):
+        self.recent.append(rec)
+        if len(self.recent)>self.memory_records:
+            self.spill(self.recent.popleft())
+
+    def extend(self, recs):
+        for rec in recs:
+            self.append(rec)
+
+    def spill(self, rec):
+        if self.f is None:
+            k = len(self.segments)
+            self.fname = os.path.join(self.path, 'segment_%06d.pkl' % k)
+            self.f = open(self.fname, 'w+b')
+            self.offsets = array('l')
+        self.offsets.append(self.f.tell())
+        cPickle.dump(rec, self.f, cPickle.HIGHEST_PROTOCOL)
+        self.spilled += 1
+        if len(self.offsets)==self.segment_records:
+            self.close_segment()
+
+    def close_segment(self):
+        index = self.fname[:-4] + '.idx'
+        np.array(self.offsets, dtype=np.int64).tofile(index)
+        self.f.close()
+        self.f = None
+        self.segments.append((self.fname, index))
+
+    def __getitem__(self, i):
+        if i<0:
+            i += len(self)
+        if i<0 or i>=len(self):
+            raise IndexError(i)
+        if i>=self.spilled:
+            return self.recent[i-self.spilled]
+        page = i // self.page_records
+        return self.load_page(page)[i - page*self.page_records]
+
+    def load_page(self, page):
+        records = self.cache.get(page)
+        if records is not None:
+            # most recently used last
+            del self.cache[page]
+            self.cache[page] = records
+            return records
+
+        first = page*self.page_records
+        last = min(first+self.page_records, self.spilled)
+        segment, start = divmod(first, self.segment_records)
+        count = last-first
+        if segment<len(self.segments):
+            data, index = self.segments[segment]
+            offsets = np.memmap(index, dtype=np.int64, mode='r')
+            # this page's first offset and the next page's, if there is one
+            offsets = [offsets[k] for k in (start, start+count) if k<len(offsets)]
+        else:
+            # the segment still being written
+            data = self.fname
+            self.f.flush()
+            offsets = self.offsets[start:start+count+1:count]
+        with open(data, 'rb') as f:
+            f.seek(offsets[0])
+            raw = f.read(offsets[1]-offsets[0]) if len(offsets)>1 else f.read()
+
+        buf = StringIO(raw)
+        records = [cPickle.load(buf) for k in range(count)]
+        if count==self.page_records:
+            # only full pages are final
+            self.cache[page] = records
+            if len(self.cache)>self.cache_pages:
+                self.cache.popitem(last=False)
+        return records
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        if self.temporary:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+class RecordIndex(object):
+    """
+    Append-only list of record numbers (e.g. the records matching a filter),
+    kept in memory up to memory_entries and spilled to a file beyond that
+    """
+    def __init__(self, path, memory_entries=65536):
+        self.fname = os.path.join(path, 'index_%d.bin' % id(self))
+        self.memory_entries = memory_entries
+        self.f = None
+        self.on_disk = 0
+        self.tail = array('l')
+
+    def __len__(self):
+        return self.on_disk + len(self.tail)
+
+    def append(self, n):
+        self.tail.append(n)
+        if len(self.tail)>=self.memory_entries:
+            if self.f is None:
+                self.f = open(self.fname, 'w+b')
+            self.f.seek(0, 2)
+            np.array(self.tail, dtype=np.int64).tofile(self.f)
+            self.on_disk += len(self.tail)
+            self.tail = array('l')
+
+    def __getitem__(self, i):
+        if i<0:
+            i += len(self)
+        if i<0 or i>=len(self):
+            raise IndexError(i)
+        if i>=self.on_disk:
+            return self.tail[i-self.on_disk]
+        self.f.seek(8*i)
+        return int(np.fromstring(self.f.read(8), dtype=np.int64)[0])
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            os.remove(self.fname)
+
+if __name__=="__main__":
+    import time
+    store = MessageStore(memory_records=1000, segment_records=4096)
+    start = time.time()
+    for i in range(100000):
+        store.append({'created': i, 'msg': '{"type": "query", "value": "%d"}' % i})
+    print('appended %d records in %.2fs, %d in memory' % (len(store), time.time()-start, len(store.recent)))
+    start = time.time()
+    assert all([store[i]['created']==i for i in range(0, len(store), 7)])
+    print('random reads in %.2fs' % (time.time()-start))
+    store.close()
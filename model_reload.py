@@ -0,0 +1,88 @@
+import os, sys, json, time
+from threading import Thread
+import config, logutil
+from shared import Model
+
+logger = logutil.get_logger('reload')
+
+MODEL_FILES = ["fsms.yaml", "bayes_net.yaml", "encoder.yaml"]
+
+def file_stamps(model_dir):
+    """
+    (mtime, size) of each model file, None for a missing file
+    """
+    stamps = []
+    for name in MODEL_FILES:
+        try:
+            st = os.stat(os.path.join(model_dir, name))
+            stamps.append((st.st_mtime, st.st_size))
+        except OSError:
+            stamps.append(None)
+    return stamps
+
+class ModelWatcher(Thread):
+    """
+    Watches a SharedControl's model directory and hot-reloads it. When a model
+    file changes (and has stayed unchanged for one poll, so half-written files
+    are not read), the new model is loaded and validated on this thread, then
+    staged; SharedControl swaps it in at the start of its next update.
+    A model that fails to load or validate, or that changes the sensor layout
+    (unless allow_layout_change, see SharedControl.stage_model), is logged and
+    the current one kept. SharedControl.rollback() goes back to the model
+    before the last swap.
+    """
+    def __init__(self, shared, interval=0.5, allow_layout_change=False):
+        Thread.__init__(self)
+        self.daemon = True
+        self.shared = shared
+        self.model_dir = shared.model_dir
+        self.interval = interval
+        self.allow_layout_change = allow_layout_change
+        self.done = False
+        self.loaded = file_stamps(self.model_dir)
+        self.reloads = 0
+        self.failures = 0
+
+    def run(self):
+        seen = self.loaded
+        while not self.done:
+            time.sleep(self.interval)
+            stamps = file_stamps(self.model_dir)
+            if stamps!=seen:
+                # still changing; wait for it to settle
+                seen = stamps
+                continue
+            if stamps!=self.loaded:
+                self.loaded = stamps
+                self.reload()
+
+    def reload(self):
+        """
+        Loads, validates and stages the model; returns True on success
+        """
+        start = time.time()
+        try:
+            model = Model(self.model_dir, self.shared.engine, **self.shared.engine_options)
+            model.validate()
+            self.shared.stage_model(model, self.allow_layout_change)
+        except (Exception, SystemExit), e:
+            # the YAML loaders exit on missing or malformed files
+            self.failures += 1
+            logger.warn(json.dumps({'type': 'model_reload_error', 'model': self.model_dir, 'error': str(e)}))
+            return False
+        self.reloads += 1
+        logger.info(json.dumps({'type': 'model_reload', 'model': self.model_dir, 'elapsed': time.time()-start}))
+        return True
+
+    def stop(self):
+        self.done = True
+
+if __name__=="__main__":
+    import shared
+    s = shared.SharedControl(sys.argv[1] if len(sys.argv)>1 else "demo_model")
+    watcher = ModelWatcher(s)
+    watcher.start()
+    print('Watching %s; edit a model file to reload it' % s.model_dir)
+    while True:
+        s.update({"pressure":0.1, "shoulder_acc":251.0})
+        time.sleep(0.1)
@@ -0,0 +1,212 @@
+import numpy as np
+import itertools
+import kernels
+from multiprocessing.sharedctypes import RawArray
+
+# einsum can only name this many distinct variables
+MAX_VARIABLES = 52
+
+# unary factors selecting a value
+INDICATOR = [np.array([1.0, 0.0]), np.array([0.0, 1.0])]
+
+def reachable_assignments(names):
+    """
+    Every assignment of the fsm_input nodes <names> that the FSMs can produce.
+    Inputs "fsm/state" of the same FSM are mutually exclusive: at most one is true
+    (none, if the FSM is in a state without an input node). Returns tuples of 0/1.
+    """
+    by_fsm = {}
+    for k, name in enumerate(names):
+        by_fsm.setdefault(name.split('/')[0], []).append(k)
+
+    choices = []
+    for positions in by_fsm.values():
+        choices.append([None] + positions)
+
+    assignments = []
+    for choice in itertools.product(*choices):
+        assignment = [0]*len(names)
+        for k in choice:
+            if k is not None:
+                assignment[k] = 1
+        assignments.append(tuple(assignment))
+    return assignments
+
+def contract(table, probs):
+    """
+    Evaluates a multilinear function from its values at the corners of the unit
+    hypercube (one axis per variable), at the point probs
+    """
+    value = table
+    for p in reversed(probs):
+        value = np.dot(value, [1-p, p])
+    return float(value)
+
+class PosteriorTables(object):
+    """
+    Exact inference by precomputed tables over a CompiledNet.
+    With the fsm_input nodes fixed, an output's probability is multilinear in
+    the probabilities of the sensors it depends on. For every reachable
+    assignment of its fsm_input nodes, the output's value at each corner of the
+    sensor hypercube (its multilinear coefficients in the vertex basis) is
+    computed once by variable elimination; a frame is then a contraction of the
+    table for the current FSM state with the sensor probabilities.
+    Outputs whose tables would be larger than max_table_size entries are left
+    out of the results, so BayesNet falls back to libpgm for them.
+    """
+    def __init__(self, net, max_table_size=65536, backend=None):
+        self.net = net
+        self.contract = kernels.select(contract, backend)
+        self.max_table_size = max_table_size
+        self.entries = []
+        self.fallback = []
+
+        for output in net.outputs:
+            relevant = net.ancestors([i for i, value in output["query"]])
+            sensors = [i for i in relevant if net.types[i]=="sensor_input"]
+            fsm_inputs = [i for i in relevant if net.types[i]=="fsm_input"]
+            assignments = reachable_assignments([net.names[i] for i in fsm_inputs])
+            if len(assignments) * 2**len(sensors) > max_table_size:
+                self.fallback.append(output["name"])
+                continue
+
+            entry = {"name": output["name"],
+                     "query": output["query"],
+                     "relevant": relevant,
+                     "conditioning": net.conditioning([i for i, value in output["query"]]),
+                     "sensors": sensors,
+                     "fsm_inputs": fsm_inputs,
+                     "rows": {}}
+            try:
+                for assignment in assignments:
+                    entry["rows"][assignment] = self.tabulate(entry, assignment)
+            except ValueError:
+                # too many variables to eliminate in one einsum
+                self.fallback.append(output["name"])
+                continue
+            self.entries.append(entry)
+        self.by_name = dict((entry["name"], entry) for entry in self.entries)
+
+    def tabulate(self, entry, assignment):
+        """
+        p(query | sensors, fsm_inputs=assignment) for every sensor assignment,
+        as an array with one axis per sensor
+        """
+        net = self.net
+        ids = {}
+        def var(i):
+            return ids.setdefault(i, len(ids))
+        aux = [len(net.names)]
+        def new_variable():
+            aux[0] += 1
+            return aux[0]-1
+
+        operands = []
+        for i in entry["relevant"]:
+            if net.cpts[i] is None:
+                continue
+            for scope, table in net.cpts[i].factors(list(net.parents[i]) + [i], new_variable):
+                operands += [table, [var(v) for v in scope]]
+        for i, value in zip(entry["fsm_inputs"], assignment):
+            operands += [INDICATOR[value], [var(i)]]
+        for i, value in entry["query"]:
+            operands += [INDICATOR[value], [var(i)]]
+        output = [var(i) for i in entry["sensors"]]
+        if len(ids)>MAX_VARIABLES:
+            raise ValueError("Too many variables (%d) to tabulate %s" % (len(ids), entry["name"]))
+        return np.einsum(*(operands + [output]), optimize=True)
+
+    def query(self, sensor_evidence, fsm_evidence, names=None):
+        """
+        Returns a dict of output name -> (p, p, p) for every tabulated output
+        (or those of them in names)
+        """
+        net = self.net
+        results = {}
+        for entry in self.entries:
+            if names is not None and entry["name"] not in names:
+                continue
+            key, table = self.row(entry, fsm_evidence)
+            if table is None:
+                continue
+            probs = [net.root_prob(i, sensor_evidence, fsm_evidence) for i in entry["sensors"]]
+            p = self.contract(table, probs)
+            results[entry["name"]] = (p, p, p)
+        return results
+
+    def share(self):
+        """
+        Moves every table into one block of shared memory, read-only, so that
+        processes forked afterwards (see shard) map the same pages instead of
+        each holding a copy. Rows tabulated on demand later stay private to the
+        process that needed them. Returns the size of the block in bytes.
+        """
+        tables = [(entry, key, table) for entry in self.entries for key, table in entry["rows"].iteritems()]
+        block = np.frombuffer(RawArray('d', max(1, sum([t.size for e, k, t in tables]))), dtype=np.float64)
+        offset = 0
+        for entry, key, table in tables:
+            view = block[offset:offset+table.size].reshape(table.shape)
+            view[...] = table
+            view.flags.writeable = False
+            entry["rows"][key] = view
+            offset += table.size
+        self.shared_block = block
+        return block.nbytes
+
+    def row(self, entry, fsm_evidence):
+        """
+        The assignment of the fsm_input nodes and its table, or (None, None) if
+        a node that conditions the output is observed (tables assume only the
+        inputs are; see CompiledNet.conditioning)
+        """
+        if any([name in fsm_evidence for name in entry["conditioning"]]):
+            return None, None
+        key = tuple([int(self.net.root_prob(i, {}, fsm_evidence)) for i in entry["fsm_inputs"]])
+        table = entry["rows"].get(key)
+        if table is None:
+            # evidence the FSMs could not have produced; tabulate it on demand
+            table = entry["rows"][key] = self.tabulate(entry, key)
+        return key, table
+
+    def sensitivity(self, name, fsm_evidence):
+        """
+        For each sensor an output depends on (in ancestor order), the largest
+        change in the output's probability per unit change of that sensor's
+        probability, over the whole hypercube: the output is multilinear, so
+        this is the largest difference between opposite corners along the
+        sensor's axis. None if the output is not tabulated for this evidence.
+        """
+        entry = self.by_name.get(name)
+        if entry is None:
+            return None
+        key, table = self.row(entry, fsm_evidence)
+        if table is None:
+            return None
+        bounds = entry.setdefault("sensitivity", {})
+        if key not in bounds:
+            bounds[key] = np.array([np.abs(np.diff(table, axis=k)).max() for k in range(table.ndim)])
+        return bounds[key]
+
+    def fork(self):
+        """
+        The tables carry nothing from one frame to the next, so every session
+        uses this same engine (and the same, possibly shared, tables)
+        """
+        return self
+
+    def sizes(self):
+        """
+        Table size per output: number of FSM assignments, sensors and total entries
+        """
+        sizes = {}
+        for entry in self.entries:
+            rows = len(entry["rows"])
+            sizes[entry["name"]] = {"assignments": rows,
+                                    "sensors": len(entry["sensors"]),
+                                    "entries": rows * 2**len(entry["sensors"])}
+        return sizes
+
+    def stats(self):
+        return {"engine": "tables",
+                "table_entries": sum([s["entries"] for s in self.sizes().values()]),
+                "fallback_outputs": len(self.fallback)}
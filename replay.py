@@ -0,0 +1,141 @@
+import cPickle
+import bisect
+import json, time
+import os, sys
+import config, logutil
+
+logger = logutil.get_logger('replay')
+
+class Recording(object):
+    """
+    A sensor stream (timestamped sensor dicts, as passed to SharedControl.update)
+    with periodic SharedControl snapshots. checkpoints[k] is (time, frame, snapshot):
+    the state after every frame before frame, taken at the time of the last one.
+    """
+    def __init__(self, model_dir=None):
+        self.model_dir = model_dir
+        self.times = []
+        self.frames = []
+        self.checkpoints = []
+        self.checkpoint_times = []
+
+    def add_frame(self, timestamp, sensor_dict):
+        self.times.append(timestamp)
+        self.frames.append(dict(sensor_dict))
+
+    def add_checkpoint(self, timestamp, snapshot):
+        self.checkpoints.append((timestamp, len(self.frames), snapshot))
+        self.checkpoint_times.append(timestamp)
+
+    def nearest_checkpoint(self, t):
+        """
+        The last checkpoint at or before time t
+        """
+        k = bisect.bisect_right(self.checkpoint_times, t)-1
+        return self.checkpoints[max(k, 0)]
+
+    def save(self, fname):
+        with open(fname, 'wb') as f:
+            cPickle.dump(self.__dict__, f, cPickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(fname):
+        recording = Recording()
+        with open(fname, 'rb') as f:
+            recording.__dict__.update(cPickle.load(f))
+        return recording
+
+class Recorder(object):
+    """
+    Wraps a SharedControl: update() runs it as usual and records the frame,
+    taking a snapshot every interval seconds of stream time
+    """
+    def __init__(self, shared, interval=1.0, recording=None):
+        self.shared = shared
+        self.interval = interval
+        self.recording = Recording(shared.model_dir) if recording is None else recording
+        self.last_checkpoint = None
+        # the state before the first frame
+        self.initial = shared.snapshot()
+
+    def update(self, sensor_dict, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        if self.last_checkpoint is None:
+            self.recording.add_checkpoint(float('-inf'), self.initial)
+            self.last_checkpoint = timestamp
+        events = self.shared.update(sensor_dict)
+        self.recording.add_frame(timestamp, sensor_dict)
+        if timestamp-self.last_checkpoint>=self.interval:
+            self.recording.add_checkpoint(timestamp, self.shared.snapshot())
+            self.last_checkpoint = timestamp
+        return events
+
+class Replayer(object):
+    """
+    Replays a Recording through a SharedControl built from the same model.
+    seek(t) restores the nearest checkpoint at or before t and replays only the
+    frames after it, unless carrying on from the current position is shorter.
+    """
+    def __init__(self, shared, recording):
+        self.shared = shared
+        self.recording = recording
+        self.position = 0
+        shared.restore(recording.checkpoints[0][2])
+
+    def time(self):
+        """
+        Time of the last frame replayed, or None before the first
+        """
+        return self.recording.times[self.position-1] if self.position>0 else None
+
+    def step(self):
+        """
+        Replays the next frame; returns (timestamp, events), or None at the end
+        """
+        if self.position>=len(self.recording.frames):
+            return None
+        timestamp = self.recording.times[self.position]
+        events = self.shared.update(self.recording.frames[self.position])
+        self.position += 1
+        return timestamp, events
+
+    def seek(self, t):
+        """
+        Brings the SharedControl to its state just after the last frame at or
+        before t. Returns the number of frames replayed to get there.
+        """
+        start = time.time()
+        times = self.recording.times
+        target = bisect.bisect_right(times, t)
+        checkpoint_time, frame, snapshot = self.recording.nearest_checkpoint(t)
+        if not (frame<=self.position<=target):
+            self.shared.restore(snapshot)
+            self.position = frame
+        replayed = 0
+        while self.position<target:
+            self.step()
+            replayed += 1
+        logger.info(json.dumps({'type': 'replay_seek', 'time': t, 'frames_replayed': replayed,
+                                'elapsed': time.time()-start}))
+        return replayed
+
+    def run_until(self, t):
+        """
+        Replays forward to time t; returns a list of (timestamp, events)
+        """
+        results = []
+        while self.position<len(self.recording.times) and self.recording.times[self.position]<=t:
+            results.append(self.step())
+        return results
+
+if __name__=="__main__":
+    import shared, random
+    s = shared.SharedControl("demo_model")
+    recorder = Recorder(s, interval=1.0)
+    for i in range(600):
+        recorder.update({"pressure": random.random(), "shoulder_acc": 250.0*random.random()}, timestamp=i*0.05)
+
+    replayer = Replayer(shared.SharedControl("demo_model"), recorder.recording)
+    print('frames replayed to reach t=23.4: %d' % replayer.seek(23.4))
+    print(replayer.shared.fsms.all_state())
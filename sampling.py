@@ -0,0 +1,140 @@
+import numpy as np
+import copy
+import math
+
+def normal_quantile(confidence):
+    """
+    Two-sided z value for the given confidence level (e.g. 0.95 -> 1.96),
+    found by bisection on erf
+    """
+    lo, hi = 0.0, 40.0
+    for i in range(100):
+        mid = (lo+hi) / 2
+        if math.erf(mid/math.sqrt(2)) < confidence:
+            lo = mid
+        else:
+            hi = mid
+    return (lo+hi) / 2
+
+def wilson_interval(p, n, z):
+    """
+    Wilson score interval for a proportion p estimated from n (effective) samples
+    """
+    if n<=0:
+        return 0.0, 1.0
+    z2 = z*z
+    denom = 1.0 + z2/n
+    centre = (p + z2/(2*n)) / denom
+    half = z*np.sqrt(p*(1-p)/n + z2/(4*n*n)) / denom
+    return max(0.0, centre-half), min(1.0, centre+half)
+
+class LikelihoodWeighting(object):
+    """
+    Approximate inference by likelihood-weighted sampling over a CompiledNet.
+    Every node is sampled for all n_samples at once, in topological order;
+    observed non-root nodes are clamped and weight the samples by their likelihood.
+    Weights are accumulated as log-likelihoods, so long chains of evidence do
+    not underflow.
+    """
+    def __init__(self, net, n_samples=4096, confidence=0.95, seed=None):
+        self.net = net
+        self.n_samples = n_samples
+        self.z = normal_quantile(confidence)
+        self.seed = seed
+        self.rng = np.random.RandomState(seed)
+
+        # buffers reused between frames
+        self.values = np.zeros((len(net.names), n_samples), dtype=np.uint8)
+        self.weights = np.empty(n_samples)
+        self.log_weights = np.empty(n_samples)
+        self.mask = np.empty(n_samples, dtype=bool)
+
+        # effective sample size of the last query
+        self.n_effective = 0.0
+
+    def sample(self, sensor_evidence, fsm_evidence):
+        net = self.net
+        values, log_weights = self.values, self.log_weights
+        log_weights.fill(0.0)
+        for i, name in enumerate(net.names):
+            if net.types[i]=="fsm_input":
+                # hard evidence; never sampled
+                values[i] = net.root_prob(i, sensor_evidence, fsm_evidence)
+                continue
+
+            if name in fsm_evidence:
+                # evidence on an inferred node: clamp it and weight by its likelihood
+                value = 0 if fsm_evidence[name]=="F" else 1
+                values[i] = value
+                if net.types[i]=="sensor_input":
+                    p = net.root_prob(i, sensor_evidence, fsm_evidence)
+                    with np.errstate(divide="ignore"):
+                        log_weights += np.log(p if value else 1-p)
+                else:
+                    log_weights += net.cpts[i].log_p(values[net.parents[i]], value)
+                continue
+
+            if net.types[i]=="sensor_input":
+                p = net.root_prob(i, sensor_evidence, fsm_evidence)
+            else:
+                p = net.cpts[i].p_true(values[net.parents[i]])
+            np.less(self.rng.random_sample(self.n_samples), p, out=values[i])
+
+        # weights relative to the largest, which only rescales the estimates
+        top = log_weights.max()
+        if top==-np.inf:
+            self.weights.fill(0.0)
+        else:
+            np.exp(log_weights-top, out=self.weights)
+
+    def query(self, sensor_evidence, fsm_evidence):
+        """
+        Returns a dict of output name -> (p, lower, upper), where [lower, upper]
+        is the Wilson interval at the engine's confidence level
+        """
+        self.sample(sensor_evidence, fsm_evidence)
+        values, weights, mask = self.values, self.weights, self.mask
+        total = weights.sum()
+        results = {}
+        if total<=0:
+            # evidence impossible under every sample
+            self.n_effective = 0.0
+            for output in self.net.outputs:
+                results[output["name"]] = (0.0, 0.0, 1.0)
+            return results
+
+        self.n_effective = total*total / np.dot(weights, weights)
+        for output in self.net.outputs:
+            mask.fill(True)
+            for i, value in output["query"]:
+                mask &= values[i]==value
+            p = min(1.0, np.dot(weights, mask) / total)
+            lower, upper = wilson_interval(p, self.n_effective, self.z)
+            results[output["name"]] = (p, lower, upper)
+        return results
+
+    def stats(self):
+        return {"engine": "sampling", "n_samples": self.n_samples, "n_effective": self.n_effective}
+
+    def snapshot(self):
+        """
+        The random generator state, so a replay draws the same samples
+        """
+        return self.rng.get_state()
+
+    def restore(self, snapshot):
+        self.rng.set_state(snapshot)
+
+    def fork(self):
+        """
+        An engine for another session, with its own random generator (seeded
+        as this one was) and sample buffers
+        """
+        engine = copy.copy(self)
+        engine.rng = np.random.RandomState(self.seed)
+        engine.values = np.zeros_like(self.values)
+        engine.weights = np.empty_like(self.weights)
+        engine.log_weights = np.empty_like(self.log_weights)
+        engine.mask = np.empty_like(self.mask)
+        engine.n_effective = 0.0
+        return engine
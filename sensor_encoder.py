@@ -5,6 +5,7 @@ import pydot
 import json
 import os, sys
 import config, logutil
+import kernels
 
 logger = logutil.get_logger('sensors')
 
@@ -129,36 +130,53 @@ class Multivariate(object):
     def transform(self, values):
         return norm(np.dot(values-self.centre, self.matrix), self.norm)
 
+    def dims(self):
+        """Number of sensor values this transform reads"""
+        return len(self.centre)
+
 class SensorEncoder(object):
 
     def __init__(self):
         self.sensors = defaultdict(list)
+        self.compiled = None
 
     def add_encoder(self, sensor, target, encoder):
         self.sensors[sensor].append((target, encoder))
+        self.compiled = None
+
+    def compile(self):
+        """
+        Returns the CompiledEncoder for the current set of encoders
+        """
+        if self.compiled is None:
+            self.compiled = CompiledEncoder(self)
+        return self.compiled
 
     def encode(self, sensor_dict):
+        compiled = self.compile()
+        return self.encode_values(compiled.fill(sensor_dict), sensor_dict)
+
+    def encode_values(self, values, present=None):
+        """
+        Encodes a slot vector laid out as in compile().slots. Returns a dict of
+        target node -> probability, for the sensors in present (default all)
+        """
+        compiled = self.compile()
+        p = compiled.encode_values(values)
         nodes = {}
-        for sensor, vector in sensor_dict.iteritems():
-            vector = np.array(vector)
-            if sensor in self.sensors:
-                for target, encoder in self.sensors[sensor]:
-                    p = encoder.encode(vector)
-                    logger.info(json.dumps({ \
-                            'type': 'encode',
-                            'sensor': sensor,
-                            'value': '%s' % vector,
-                            'target': target,
-                            'p' : '%.8f' % p,
-                            'result': 'p(%s)=%.8f' % (target, p)
-                    }))
-                        
-                        #"P> %s=%s p(%s)=%.8f" % (sensor, vector, target, p))
-                    if target not in nodes:
-                        nodes[target] = p
-                    else:
-                        # can't write to the same target node twice -- this is meaningless
-                        raise ValueError()
+        for k, (sensor, target) in enumerate(compiled.encoders):
+            if present is None or sensor in present:
+                logger.info(json.dumps({ \
+                        'type': 'encode',
+                        'sensor': sensor,
+                        'value': '%s' % values[compiled.slots[sensor]],
+                        'target': target,
+                        'p' : '%.8f' % p[k],
+                        'result': 'p(%s)=%.8f' % (target, p[k])
+                }))
+
+                    #"P> %s=%s p(%s)=%.8f" % (sensor, vector, target, p))
+                nodes[target] = p[k]
         return nodes
 
     def get_targets(self):
@@ -189,6 +207,185 @@ class SensorEncoder(object):
 
         return target_nodes
 
+def sigmoid_inplace(x):
+    np.negative(x, out=x)
+    np.exp(x, out=x)
+    np.add(x, 1.0, out=x)
+    np.reciprocal(x, out=x)
+
+def threshold_group(x, params, out, tmp):
+    threshold, softness = params
+    np.subtract(x, threshold, out=out)
+    np.multiply(out, softness, out=out)
+    sigmoid_inplace(out)
+
+def range_group(x, params, out, tmp):
+    left, right, left_softness, right_softness = params
+    threshold_group(x, (left, left_softness), out, tmp)
+    threshold_group(x, (right, right_softness), tmp, None)
+    np.subtract(1.0, tmp, out=tmp)
+    np.multiply(out, tmp, out=out)
+
+def gaussian_group(x, params, out, tmp):
+    centres, widths = params
+    np.subtract(x, centres, out=out)
+    np.square(out, out=out)
+    np.divide(out, widths, out=out)
+    np.divide(out, widths, out=out)
+    np.negative(out, out=out)
+    np.exp(out, out=out)
+
+def binary_group(x, params, out, tmp):
+    p, no_p = params
+    np.greater(x, 0.5, out=tmp)
+    np.multiply(tmp, p-no_p, out=out)
+    np.add(out, no_p, out=out)
+
+# encoder type -> (parameters, vectorised evaluation) used by CompiledEncoder
+ENCODER_GROUPS = [
+    (ThresholdEncoder, lambda e: (e.threshold, e.softness), threshold_group),
+    (RangeEncoder, lambda e: (e.left, e.right, e.left_softness,
+                              e.left_softness if e.right_softness is None else e.right_softness), range_group),
+    (GaussianEncoder, lambda e: (e.centres, e.widths), gaussian_group),
+    (BinaryEncoder, lambda e: (e.p, e.no_p), binary_group),
+]
+
+class CompiledEncoder(object):
+    """
+    The encoders of a SensorEncoder compiled into parameter arrays, one group per
+    encoder type. Sensor readings live in a flat vector (values) with a fixed slot
+    per sensor, in name order, one value per transform dimension. Each group is
+    evaluated with a handful of ufunc calls into preallocated buffers, so the cost
+    per frame is roughly one NumPy call per encoder type (or one JIT-compiled
+    loop, under the numba kernel backend; see kernels).
+    """
+    def __init__(self, sensor_encoder, backend=None):
+        self.sensors = sorted(sensor_encoder.sensors)
+        self.slots = {}
+        width = 0
+        for sensor in self.sensors:
+            dims = 1
+            for target, encoder in sensor_encoder.sensors[sensor]:
+                if encoder.transform is not None:
+                    dims = max(dims, encoder.transform.dims())
+            self.slots[sensor] = slice(width, width+dims)
+            width += dims
+        self.width = width
+        self.values = np.zeros(width)
+
+        # (sensor, target) for each encoder; p holds their probabilities in this order
+        encoders = []
+        for sensor in self.sensors:
+            for target, encoder in sensor_encoder.sensors[sensor]:
+                encoders.append((sensor, target, encoder))
+        self.encoders = [(sensor, target) for sensor, target, encoder in encoders]
+        targets = [target for sensor, target in self.encoders]
+        for target in targets:
+            if targets.count(target)>1:
+                # can't write to the same target node twice -- this is meaningless
+                raise ValueError("Target node %s is encoded more than once" % target)
+        n = len(encoders)
+        self.x = np.zeros(n)
+        self.p = np.zeros(n)
+
+        # univariate encoders read the first value in their sensor's slot
+        univariate = [k for k, (s, t, e) in enumerate(encoders) if e.transform is None]
+        self.uni_pos = np.array(univariate, dtype=np.intp)
+        self.uni_index = np.array([self.slots[encoders[k][0]].start for k in univariate], dtype=np.intp)
+        self.uni_x = np.zeros(len(univariate))
+
+        # multivariate transforms, zero-padded to a common input and output size
+        multivariate = [k for k, (s, t, e) in enumerate(encoders) if e.transform is not None]
+        transforms = [encoders[k][2].transform for k in multivariate]
+        matrices = []
+        for transform in transforms:
+            if transform.matrix is None:
+                matrices.append(np.eye(transform.dims()))
+            else:
+                matrices.append(np.array(transform.matrix, dtype=float).reshape(transform.dims(), -1))
+        m = len(multivariate)
+        in_dims = max([len(t.centre) for t in transforms] or [1])
+        out_dims = max([matrix.shape[1] for matrix in matrices] or [1])
+        self.multi_pos = np.array(multivariate, dtype=np.intp)
+        # padding reads an arbitrary value, which meets only zero matrix rows
+        self.multi_index = np.zeros((m, in_dims), dtype=np.intp)
+        self.multi_centre = np.zeros((m, in_dims))
+        self.multi_matrix = np.zeros((m, in_dims, out_dims))
+        for j, k in enumerate(multivariate):
+            slot = self.slots[encoders[k][0]]
+            dims = transforms[j].dims()
+            self.multi_index[j, :] = slot.start
+            self.multi_index[j, :dims] = np.arange(slot.start, slot.start+dims)
+            self.multi_centre[j, :dims] = transforms[j].centre
+            self.multi_matrix[j, :dims, :matrices[j].shape[1]] = matrices[j]
+        self.multi_norm = np.array([t.norm for t in transforms], dtype=float)[:, None]
+        self.multi_inv_norm = 1.0 / self.multi_norm[:, 0]
+        self.multi_values = np.zeros((m, in_dims))
+        self.multi_proj = np.zeros((m, out_dims))
+        self.multi_x = np.zeros(m)
+
+        # one group of parameter arrays per encoder type
+        self.groups = []
+        for encoder_type, get_params, evaluate in ENCODER_GROUPS:
+            members = [k for k, (s, t, e) in enumerate(encoders) if type(e.encoder) is encoder_type]
+            if len(members)==0:
+                continue
+            params = zip(*[get_params(encoders[k][2].encoder) for k in members])
+            self.groups.append({"pos": np.array(members, dtype=np.intp),
+                                "params": tuple([np.array(param, dtype=float) for param in params]),
+                                "evaluate": kernels.select(evaluate, backend),
+                                "x": np.zeros(len(members)),
+                                "out": np.zeros(len(members)),
+                                "tmp": np.zeros(len(members))})
+        grouped = sum([len(group["pos"]) for group in self.groups])
+        if grouped!=n:
+            raise ValueError("Encoder type cannot be compiled")
+
+        self.flip = np.array([e.flip for s, t, e in encoders], dtype=bool)
+        self.flipped = np.zeros(n)
+
+    def fill(self, sensor_dict):
+        """
+        Copies the readings in a sensor_name:sensor_value dict into the slot vector
+        """
+        for sensor, vector in sensor_dict.iteritems():
+            slot = self.slots.get(sensor)
+            if slot is not None:
+                self.values[slot] = np.ravel(vector)[:slot.stop-slot.start]
+        return self.values
+
+    def encode_values(self, values):
+        """
+        Encodes a slot vector (at least width long); returns p, the probability for
+        each entry in encoders. p is overwritten by the next call. The readings
+        are kept in values, as fill() keeps them, so they are the frame's state.
+        """
+        if values is not self.values:
+            self.values[:] = values[:self.width]
+            values = self.values
+        x = self.x
+        if len(self.uni_pos):
+            np.take(values, self.uni_index, out=self.uni_x)
+            x[self.uni_pos] = self.uni_x
+        if len(self.multi_pos):
+            np.take(values, self.multi_index, out=self.multi_values)
+            np.subtract(self.multi_values, self.multi_centre, out=self.multi_values)
+            np.einsum('md,mde->me', self.multi_values, self.multi_matrix, out=self.multi_proj)
+            np.power(self.multi_proj, self.multi_norm, out=self.multi_proj)
+            np.sum(self.multi_proj, axis=1, out=self.multi_x)
+            np.power(self.multi_x, self.multi_inv_norm, out=self.multi_x)
+            x[self.multi_pos] = self.multi_x
+
+        p = self.p
+        for group in self.groups:
+            np.take(x, group["pos"], out=group["x"])
+            group["evaluate"](group["x"], group["params"], group["out"], group["tmp"])
+            p[group["pos"]] = group["out"]
+
+        np.subtract(1.0, p, out=self.flipped)
+        np.copyto(p, self.flipped, where=self.flip)
+        return p
+
 def load_sensor_encoder(yaml_file):
     if not os.path.exists(yaml_file):
         print('Error: file "%s" does not exist!' % yaml_file)
@@ -0,0 +1,158 @@
+import numpy as np
+import mmap
+import os, sys, time
+import sensor_encoder
+
+# header: magic, slot width, capacity, sequence number of the last published frame
+MAGIC = 0x53454e53524e4731
+HEADER_SIZE = 4*8
+H_MAGIC, H_WIDTH, H_CAPACITY, H_SEQ = range(4)
+
+def record_dtype(width):
+    return np.dtype([('seq', '<i8'), ('timestamp', '<f8'), ('values', '<f8', (width,))])
+
+class SensorRing(object):
+    """
+    Ring buffer of sensor frames in a memory-mapped file (e.g. under /dev/shm),
+    shared between an acquisition process (the writer) and the control loop.
+    Each frame is a vector of sensor values in the fixed slot layout of the model's
+    encoder.yaml (see SharedControl.sensor_layout), tagged with a sequence number
+    and a timestamp. Readers get NumPy views straight into the mapping: nothing
+    is copied or serialised.
+
+    A slot's seq is negated while the writer is filling it; a frame view is only
+    valid while valid(seq) is True, i.e. until the writer laps the ring.
+    """
+    def __init__(self, path, width=None, capacity=256, create=False):
+        self.path = path
+        if create:
+            dtype = record_dtype(width)
+            size = HEADER_SIZE + capacity*dtype.itemsize
+            with open(path, 'w+b') as f:
+                f.truncate(size)
+        self.f = open(path, 'r+b')
+        self.mm = mmap.mmap(self.f.fileno(), 0)
+
+        self.header = np.frombuffer(self.mm, dtype='<i8', count=4)
+        if create:
+            self.header[H_WIDTH] = width
+            self.header[H_CAPACITY] = capacity
+            self.header[H_SEQ] = 0
+            self.header[H_MAGIC] = MAGIC
+        elif self.header[H_MAGIC]!=MAGIC:
+            raise ValueError('"%s" is not a sensor ring' % path)
+        elif width is not None and self.header[H_WIDTH]!=width:
+            raise ValueError('Sensor ring "%s" has %d slots, model needs %d' % (path, self.header[H_WIDTH], width))
+
+        self.width = int(self.header[H_WIDTH])
+        self.capacity = int(self.header[H_CAPACITY])
+        self.records = np.frombuffer(self.mm, dtype=record_dtype(self.width),
+                                     count=self.capacity, offset=HEADER_SIZE)
+        self.seqs = self.records['seq']
+        self.timestamps = self.records['timestamp']
+        self.values = self.records['values']
+
+        # reader state
+        self.last_read = 0
+        self.dropped = 0
+
+    # writer side
+
+    def next_frame(self):
+        """
+        Returns a view of the slot the next frame will be written to, so a writer
+        can fill it in place before publish_next(). Marks the slot as being written.
+        """
+        seq = self.header[H_SEQ]+1
+        slot = seq % self.capacity
+        self.seqs[slot] = -seq
+        return self.values[slot]
+
+    def publish_next(self, timestamp=None):
+        """
+        Publishes the frame filled in through next_frame(); returns its sequence number
+        """
+        seq = self.header[H_SEQ]+1
+        slot = seq % self.capacity
+        self.timestamps[slot] = time.time() if timestamp is None else timestamp
+        self.seqs[slot] = seq
+        self.header[H_SEQ] = seq
+        return seq
+
+    def publish(self, values, timestamp=None):
+        """
+        Copies a frame of sensor values into the ring and publishes it
+        """
+        self.next_frame()[:] = values
+        return self.publish_next(timestamp)
+
+    # reader side
+
+    def latest(self):
+        """
+        Returns (seq, timestamp, values) for the most recent frame, or None if nothing
+        has been published. Marks everything up to it as read.
+        """
+        seq = int(self.header[H_SEQ])
+        if seq==0:
+            return None
+        slot = seq % self.capacity
+        self.last_read = seq
+        return seq, self.timestamps[slot], self.values[slot]
+
+    def read_new(self):
+        """
+        Returns a list of (seq, timestamp, values) for every frame published since the
+        last read, oldest first. Frames the writer has already overwritten are
+        skipped and counted in dropped.
+        """
+        seq = int(self.header[H_SEQ])
+        first = self.last_read+1
+        # leave one slot of slack for the frame the writer may be filling
+        oldest = seq-self.capacity+2
+        if first<oldest:
+            self.dropped += oldest-first
+            first = oldest
+        frames = []
+        for s in range(first, seq+1):
+            slot = s % self.capacity
+            frames.append((s, self.timestamps[slot], self.values[slot]))
+        self.last_read = max(self.last_read, seq)
+        return frames
+
+    def valid(self, seq):
+        """
+        True if the frame with this sequence number has not been overwritten
+        """
+        return self.seqs[seq % self.capacity]==seq
+
+    def close(self):
+        self.header = self.records = self.seqs = self.timestamps = self.values = None
+        self.mm.close()
+        self.f.close()
+
+    def unlink(self):
+        self.close()
+        os.remove(self.path)
+
+def ring_for_model(model_dir, path, capacity=256, create=False):
+    """
+    Opens (or creates) a sensor ring laid out for the encoder.yaml in model_dir
+    """
+    encoder = sensor_encoder.load_sensor_encoder(os.path.join(model_dir, "encoder.yaml"))
+    return SensorRing(path, encoder.compile().width, capacity, create)
+
+if __name__=="__main__":
+    import shared
+    s = shared.SharedControl("demo_model")
+    slots, width = s.sensor_layout()
+    ring = SensorRing("/dev/shm/shared_control_demo", width, create=True)
+
+    frame = ring.next_frame()
+    frame[slots["pressure"]] = 0.1
+    frame[slots["shoulder_acc"]] = 251.0
+    ring.publish_next()
+
+    for seq, timestamp, values in ring.read_new():
+        print('frame %d at %.3f:' % (seq, timestamp), s.update_values(values))
+    ring.unlink()
@@ -0,0 +1,203 @@
+import multiprocessing
+import zlib
+import json, time
+import os, sys
+from Queue import Empty
+import config, logutil
+from shared import Model, SharedControl
+
+logger = logutil.get_logger('shard')
+
+def shard_of(session_id, shards):
+    """
+    The shard a session is routed to; stable across processes and runs
+    """
+    return zlib.crc32(str(session_id)) % shards
+
+def worker_main(shard, model, inbox, outbox):
+    """
+    Runs the sessions routed to one shard. Each message from the supervisor is
+    a batch of (session_id, timestamp, frame), a frame being a sensor dict or a
+    slot value vector; the events are sent back as one batch, with the time
+    spent on it. Sessions are created on their first frame.
+    """
+    sessions = {}
+    while True:
+        msg = inbox.get()
+        if msg is None:
+            break
+        kind, batch = msg
+        if kind=="close":
+            for session_id in batch:
+                sessions.pop(session_id, None)
+            continue
+
+        start = time.time()
+        results = []
+        for session_id, timestamp, frame in batch:
+            session = sessions.get(session_id)
+            if session is None:
+                session = sessions[session_id] = SharedControl(model.model_dir, model=model.session())
+            if isinstance(frame, dict):
+                events = session.update(frame)
+            else:
+                events = session.update_values(frame)
+            results.append((session_id, timestamp, events))
+        outbox.put((shard, results, time.time()-start, len(sessions)))
+
+class ShardedRuntime(object):
+    """
+    Hosts many SharedControl sessions across worker processes. The supervisor
+    (this object) routes each session by id to one of the workers, so a
+    session's frames are always handled in order by the same process.
+    The model is loaded once here before the workers are forked; with the
+    "tables" engine its posterior tables are moved to shared memory first, so
+    every worker maps the same read-only copy.
+    Frames are batched per shard (up to batch_size, or until flush()) and the
+    events come back in batches from results().
+    """
+    def __init__(self, model_dir, workers=None, engine="tables", batch_size=64, stats_interval=5.0, **engine_options):
+        self.model_dir = model_dir
+        self.shards = multiprocessing.cpu_count() if workers is None else workers
+        self.batch_size = batch_size
+        self.stats_interval = stats_interval
+        self.model = Model(model_dir, engine, **engine_options)
+        self.model.validate()
+        self.shared_bytes = 0
+        if hasattr(self.model.bayes_net.engine, "share"):
+            self.shared_bytes = self.model.bayes_net.engine.share()
+        self.model_bytes = self.model.bayes_net.memory()["total_bytes"]
+
+        self.outbox = multiprocessing.Queue()
+        self.inboxes = []
+        self.workers = []
+        for shard in range(self.shards):
+            inbox = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=worker_main, args=(shard, self.model, inbox, self.outbox))
+            worker.daemon = True
+            self.inboxes.append(inbox)
+            self.workers.append(worker)
+        self.pending = [[] for shard in range(self.shards)]
+
+        # per-shard load
+        self.started = None
+        self.last_stats = None
+        self.frames_sent = [0]*self.shards
+        self.frames_done = [0]*self.shards
+        self.busy = [0.0]*self.shards
+        self.sessions = [0]*self.shards
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        self.started = self.last_stats = time.time()
+
+    def submit(self, session_id, frame, timestamp=None):
+        """
+        Queues a frame (a sensor dict, or a vector in the model's slot layout)
+        for a session
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        shard = shard_of(session_id, self.shards)
+        self.pending[shard].append((session_id, timestamp, frame))
+        if len(self.pending[shard])>=self.batch_size:
+            self.send(shard)
+
+    def send(self, shard):
+        batch = self.pending[shard]
+        if batch:
+            self.pending[shard] = []
+            self.frames_sent[shard] += len(batch)
+            self.inboxes[shard].put(("frames", batch))
+
+    def flush(self):
+        for shard in range(self.shards):
+            self.send(shard)
+
+    def close_session(self, session_id):
+        shard = shard_of(session_id, self.shards)
+        self.send(shard)
+        self.inboxes[shard].put(("close", [session_id]))
+
+    def results(self, timeout=0.0):
+        """
+        Returns the (session_id, timestamp, events) handled since the last call,
+        waiting up to timeout for the first batch
+        """
+        results = []
+        block = timeout>0
+        while True:
+            try:
+                shard, batch, busy, sessions = self.outbox.get(block, timeout)
+            except Empty:
+                break
+            block = False
+            self.frames_done[shard] += len(batch)
+            self.busy[shard] += busy
+            self.sessions[shard] = sessions
+            results.extend(batch)
+        if self.stats_interval is not None and time.time()-self.last_stats>=self.stats_interval:
+            logger.info(json.dumps(self.stats()))
+            self.last_stats = time.time()
+        return results
+
+    def backlog(self):
+        """
+        Frames submitted but not yet handled, over all shards
+        """
+        return sum(self.frames_sent)-sum(self.frames_done) + sum([len(p) for p in self.pending])
+
+    def drain(self, timeout=None):
+        """
+        Flushes and collects results until every submitted frame is handled
+        """
+        self.flush()
+        results = []
+        start = time.time()
+        while sum(self.frames_done)<sum(self.frames_sent):
+            if timeout is not None and time.time()-start>timeout:
+                break
+            results.extend(self.results(timeout=0.1))
+        return results
+
+    def stats(self):
+        elapsed = time.time()-self.started
+        shards = []
+        for shard in range(self.shards):
+            shards.append({'shard': shard,
+                           'sessions': self.sessions[shard],
+                           'frames': self.frames_done[shard],
+                           'backlog': self.frames_sent[shard]-self.frames_done[shard]+len(self.pending[shard]),
+                           'load': self.busy[shard]/elapsed if elapsed>0 else 0.0})
+        return {'type': 'shard_stats',
+                'elapsed': elapsed,
+                'frames': sum(self.frames_done),
+                'frames_per_second': sum(self.frames_done)/elapsed if elapsed>0 else 0.0,
+                'model_bytes': self.model_bytes,
+                'shared_table_bytes': self.shared_bytes,
+                'shards': shards}
+
+    def stop(self):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for worker in self.workers:
+            worker.join(5.0)
+
+if __name__=="__main__":
+    import random
+    model_dir = sys.argv[1] if len(sys.argv)>1 else "demo_model"
+    frames = 20000
+    for workers in sorted(set([1, multiprocessing.cpu_count()])):
+        runtime = ShardedRuntime(model_dir, workers=workers, stats_interval=None)
+        runtime.start()
+        start = time.time()
+        for i in range(frames):
+            runtime.submit("session-%d" % (i % 64), {"pressure": random.random(), "shoulder_acc": 250.0*random.random()})
+            if i % 1024==0:
+                runtime.results()
+        runtime.drain()
+        elapsed = time.time()-start
+        print('%d worker(s): %.0f frames/s' % (workers, frames/elapsed))
+        print(json.dumps(runtime.stats()['shards']))
+        runtime.stop()
@@ -2,33 +2,239 @@ import yaml
 import fsm
 import bayes_net
 import sensor_encoder
-import os, sys, json
+import os, sys, json, time
+import random, copy
 import pydot
+from threading import Lock
 import config, logutil
 
 logger = logutil.get_logger('shared')
 
-class SharedControl(object):
-
-    def __init__(self, model_dir):        
+class Model(object):
+    """
+    The three parts of a model directory, loaded together
+    """
+    def __init__(self, model_dir, engine="exact", **engine_options):
+        self.model_dir = model_dir
         self.fsms = fsm.load_fsms(os.path.join(model_dir, "fsms.yaml"))
-        self.bayes_net = bayes_net.load_bayes_net(os.path.join(model_dir, "bayes_net.yaml"))
+        self.bayes_net = bayes_net.load_bayes_net(os.path.join(model_dir, "bayes_net.yaml"), engine, **engine_options)
         self.sensor_encoder = sensor_encoder.load_sensor_encoder(os.path.join(model_dir, "encoder.yaml"))
+
+    def session(self):
+        """
+        A Model for another session: its own FSMs, sensor encoder and Bayes net
+        state (the state carried between frames), sharing this model's Bayes
+        net structure and tables (see BayesNet.fork)
+        """
+        model = Model.__new__(Model)
+        model.model_dir = self.model_dir
+        model.fsms = fsm.load_fsms(os.path.join(self.model_dir, "fsms.yaml"))
+        model.bayes_net = self.bayes_net.fork()
+        model.sensor_encoder = sensor_encoder.load_sensor_encoder(os.path.join(self.model_dir, "encoder.yaml"))
+        return model
+
+    def validate(self):
+        """
+        Raises ValueError if the parts do not fit together: every output event and
+        fsm_input node must name an existing FSM (and state), and every encoder
+        target must be a sensor_input node
+        """
+        fsms = self.fsms.fsms
+        for name, output in self.bayes_net.outputs.iteritems():
+            ev = output["event"]
+            fsm_name = ev.get("fsm", None)
+            if fsm_name is not None and fsm_name not in fsms:
+                raise ValueError("Output %s sends to unknown FSM %s" % (name, fsm_name))
+            if fsm_name is not None and ev["event"] not in [e["name"] for e in fsms[fsm_name].events()]:
+                raise ValueError("Output %s sends unknown event %s to FSM %s" % (name, ev["event"], fsm_name))
+        for name in self.bayes_net.fsm_inputs:
+            fsm_name, state = name.split('/')
+            if fsm_name not in fsms or state not in fsms[fsm_name].states():
+                raise ValueError("fsm_input %s does not name an FSM state" % name)
+        net = self.bayes_net.compiled
+        sensor_inputs = set([name for name, kind in zip(net.names, net.types) if kind=="sensor_input"])
+        for sensor, target in self.sensor_encoder.compile().encoders:
+            if target not in sensor_inputs:
+                raise ValueError("Sensor %s is encoded to %s, which is not a sensor_input node" % (sensor, target))
+
+class Timings(list):
+    """
+    The (stage, time) at which each stage of a frame ended (see SharedControl.mark)
+    """
+    def mark(self, stage):
+        self.append((stage, time.time()))
+
+class SharedControl(object):
+
+    def __init__(self, model_dir, engine="exact", model=None, **engine_options):
+        """
+        Load the model in model_dir. engine selects the Bayes net inference
+        engine ("exact" or one of bayes_net.ENGINES); engine_options are passed to it.
+        An already loaded Model can be given instead (e.g. from Model.session()).
+        """
+        self.model_dir = model_dir
+        self.engine = engine
+        self.engine_options = engine_options
+        self.event_dispatcher = None
+        # a validated Model waiting to be swapped in, and the one it replaced
+        self.pending_model = None
+        self.previous_model = None
+        self.model_lock = Lock()
+        # when set (e.g. to a Timings), update calls its mark(stage) as each stage of a frame ends
+        self.timings = None
+        self.use_model(Model(model_dir, engine, **engine_options) if model is None else model)
+
+    def use_model(self, model):
+        self.model = model
+        self.fsms = model.fsms
+        self.bayes_net = model.bayes_net
+        self.sensor_encoder = model.sensor_encoder
+        # events inferred on the last frame, for update(..., cached_inference=True)
+        self.last_inferred = None
+
+    def stage_model(self, model, allow_layout_change=False):
+        """
+        Queues a loaded and validated Model; it replaces the current one at the
+        start of the next frame, i.e. the next call to update, update_values or
+        update_probs (from any thread; the swap itself happens on the thread
+        calling update). Slot vectors from SensorRing, IngestServer
+        or FrameQueue are laid out for the current sensor layout, so a model
+        whose layout differs is rejected with ValueError, unless
+        allow_layout_change is set by a caller that rebuilds its producers.
+        """
+        compiled = model.sensor_encoder.compile()
+        slots, width = self.sensor_layout()
+        if (compiled.slots, compiled.width)!=(slots, width) and not allow_layout_change:
+            moved = [name for name in sorted(set(slots) | set(compiled.slots))
+                     if slots.get(name)!=compiled.slots.get(name)]
+            raise ValueError("Model %s changes the sensor layout (slots of %s)" % (
+                model.model_dir, ", ".join(moved)))
+        with self.model_lock:
+            self.pending_model = model
+
+    def swap_model(self):
+        """
+        Swaps in the staged model, if any. FSMs whose current state still exists
+        in the new model keep it; the others restart in their initial state.
+        """
+        if self.pending_model is None:
+            return
+        with self.model_lock:
+            model, self.pending_model = self.pending_model, None
+        if model is None:
+            return
+        kept = {}
+        for name, new_fsm in model.fsms.fsms.iteritems():
+            old_fsm = self.fsms.fsms.get(name)
+            if old_fsm is not None and old_fsm.state in new_fsm.states():
+                new_fsm.fsm.current = old_fsm.state
+                kept[name] = old_fsm.state
+        # drop the startup events of the new FSMs
+        model.fsms.get_events()
+        self.previous_model = self.model
+        self.use_model(model)
+        logger.info(json.dumps({'type': 'model_swap', 'model': model.model_dir, 'kept_states': kept}))
+
+    def rollback(self, allow_layout_change=False):
+        """
+        Stages the model that the last swap replaced (see stage_model). Its Bayes
+        net state is from before that swap, so it starts afresh (see BayesNet.fork);
+        the sensor readings held in the encoder's slots carry over if the layout
+        is the same. FSM states carry over as in any swap.
+        """
+        if self.previous_model is None:
+            return False
+        model = copy.copy(self.previous_model)
+        model.bayes_net = model.bayes_net.fork()
+        compiled = model.sensor_encoder.compile()
+        if (compiled.slots, compiled.width)==self.sensor_layout():
+            compiled.values[:] = self.sensor_encoder.compile().values
+        self.stage_model(model, allow_layout_change)
+        return True
+
+    def snapshot(self):
+        """
+        Everything that carries over between frames: FSM states and pending events,
+        the sensor readings held in the encoder's slots, the last inferred events and
+        the Bayes net/engine state. Restoring it and feeding the same frames gives
+        the same events.
+        """
+        return {"fsms": self.fsms.snapshot(),
+                "sensor_values": self.sensor_encoder.compile().values.copy(),
+                "last_inferred": self.last_inferred,
+                "bayes_net": self.bayes_net.snapshot()}
+
+    def restore(self, snapshot):
+        self.fsms.restore(snapshot["fsms"])
+        self.sensor_encoder.compile().values[:] = snapshot["sensor_values"]
+        self.last_inferred = snapshot["last_inferred"]
+        self.bayes_net.restore(snapshot["bayes_net"])
+
+    def mark(self, stage):
+        if self.timings is not None:
+            self.timings.mark(stage)
+
+    def set_event_sink(self, dispatcher):
+        """
+        Sends all output events to an event_sink.EventDispatcher (which must be
+        started), as well as returning them from update. None disables this.
+        """
+        self.event_dispatcher = dispatcher
         
-    def update(self, sensor_dict):
+    def update(self, sensor_dict, cached_inference=False):
         """
         Takes a dictionary of sensor_name:sensor_value mappings.
         Returns a list of strings, representing all output events fired.
+        If cached_inference is True, the Bayes net is not run and the events it
+        inferred on the previous frame are used again.
         """
+        self.swap_model()
         # encode sensor values
         # get a node name->probability mapping
-        sensor_probs = self.sensor_encoder.encode(sensor_dict)      
+        sensor_probs = self.sensor_encoder.encode(sensor_dict)
+        self.mark("encode")
+        return self._update_probs(sensor_probs, cached_inference)
+
+    def update_values(self, values, cached_inference=False):
+        """
+        As update(), but takes a vector of sensor values laid out in the fixed
+        slots of sensor_layout() (e.g. a frame view from a sensor_ring.SensorRing)
+        """
+        self.swap_model()
+        sensor_probs = self.sensor_encoder.encode_values(values)
+        self.mark("encode")
+        return self._update_probs(sensor_probs, cached_inference)
+
+    def sensor_layout(self):
+        """
+        Returns (slots, width): the slice of the sensor value vector for each sensor name
+        """
+        compiled = self.sensor_encoder.compile()
+        return compiled.slots, compiled.width
+
+    def update_probs(self, sensor_probs, cached_inference=False):
+        """
+        Runs inference and the FSMs on encoded sensor probabilities
+        (a dict of sensor_input node -> probability)
+        """
+        self.swap_model()
+        return self._update_probs(sensor_probs, cached_inference)
+
+    def _update_probs(self, sensor_probs, cached_inference):
+        # no swap here: a model staged after the frame was encoded waits for the next frame
         logger.info(json.dumps({'type': 'sensor_update', 'value': sensor_probs}))
         
-        fsm_evidence = {}
+        # fsm_input nodes are true when their FSM is in the named state
+        fsm_evidence = self.fsms.evidence(self.bayes_net.fsm_inputs)
+        self.mark("evidence")
         
         # infer bayes net output variables
-        events = self.bayes_net.infer(sensor_probs, fsm_evidence)
+        if cached_inference and self.last_inferred is not None:
+            events = self.last_inferred
+        else:
+            events = self.bayes_net.infer(sensor_probs, fsm_evidence)
+            self.last_inferred = events
+        self.mark("infer")
         logger.info(json.dumps({'type': 'inferred_events', 'value': events}))
 
         # trigger messages to the FSM (will be list of (fsm_name, event_name) pairs))
@@ -38,10 +244,19 @@ class SharedControl(object):
             self.fsms.send(event["fsm"], event["event"])
             
         all_events = self.fsms.get_events()
+        self.mark("fsm")
+        if self.event_dispatcher is not None:
+            for fsm_name, fsm_events in all_events.iteritems():
+                if fsm_events:
+                    self.event_dispatcher.post(fsm_name, fsm_events)
+            self.mark("dispatch")
         return list(all_events.values())
             
-    def render_graph(self, fname="shared_control_map.png"):
-        dot_object = pydot.Dot(graph_name="main_graph",rankdir="UD", labelloc='b', 
+    def build_graph(self, rankdir="UD"):
+        """
+        Returns the pydot graph of the whole model: encoders, Bayes net and FSMs
+        """
+        dot_object = pydot.Dot(graph_name="main_graph",rankdir=rankdir, labelloc='b', 
                        labeljust='r', ranksep=1)
                        
         dot_object.set_node_defaults(shape='circle', fixedsize='false',
@@ -77,12 +292,42 @@ class SharedControl(object):
             bn_node = sensor_inputs[target] 
             edge = pydot.Edge(target_node, bn_node, style="dashed")
             dot_object.add_edge(edge)
-            
-        import cPickle
-        dot_object.write_png(fname, prog="dot")
-    
+        return dot_object
+
+    def render_graph(self, fname="shared_control_map.png"):
+        """
+        Renders the model graph to a PNG with dot, synchronously (see graph_render
+        for cached rendering in the background)
+        """
+        self.build_graph().write_png(fname, prog="dot")
+
+def check_sessions(model_dir, engine="exact", frames=100, **engine_options):
+    """
+    Checks that the sessions of one Model filter independently: two sessions
+    fed different frames must end exactly as two separately loaded
+    SharedControls fed the same frames, in their events, output probabilities
+    and temporal beliefs. Raises AssertionError otherwise. The sampling engine
+    needs a seed in engine_options to be comparable.
+    """
+    model = Model(model_dir, engine, **engine_options)
+    sessions = [SharedControl(model_dir, model=model.session()) for k in range(2)]
+    separate = [SharedControl(model_dir, engine, **engine_options) for k in range(2)]
+    sensors = sorted(model.sensor_encoder.compile().slots)
+    rngs = [random.Random(0), random.Random(1)]
+    for i in range(frames):
+        for k in range(2):
+            sensor_dict = dict((sensor, rngs[k].random()) for sensor in sensors)
+            events = sessions[k].update(sensor_dict)
+            assert events==separate[k].update(sensor_dict), "session %d diverged at frame %d" % (k, i)
+    for session, control in zip(sessions, separate):
+        assert session.bayes_net.last_probs==control.bayes_net.last_probs
+        assert session.bayes_net.belief==control.bayes_net.belief
+
 if __name__=="__main__":
     s = SharedControl("demo_model")             
     s.render_graph()
     events = s.update({"pressure":0.5, "shoulder_acc":251.0})
     print('Shared control events:', events)
+    for engine in ["exact", "tables", "loopy_bp"]:
+        check_sessions("demo_model", engine)
+    print('Sessions of one model are independent')
@@ -0,0 +1,437 @@
+import numpy as np
+import yaml
+import itertools, copy
+import os, sys, json, time
+import argparse
+from multiprocessing import Pool
+import config, logutil
+import sensor_encoder, bayes_net
+from posterior_tables import PosteriorTables
+
+logger = logutil.get_logger('sweep')
+
+# Parameter sweeps over a model against a recorded sensor dataset.
+# Parameters are named by path:
+#   encoder.<sensor>.<target>.<param>   e.g. encoder.pressure.gripped.threshold
+#   output.<name>.logp                  e.g. output.send_grasp.logp
+# A grid maps paths to lists of values; every combination is evaluated.
+
+def expand_grid(grid):
+    """
+    Returns (names, values): the parameter paths in sorted order and an array
+    with one row per combination of the grid's values
+    """
+    names = sorted(grid)
+    values = np.array(list(itertools.product(*[grid[name] for name in names])), dtype=float)
+    return names, values.reshape(-1, len(names))
+
+def load_recording(fname, slots, width):
+    """
+    Reads a CSV recording with a header row: a time column, then one column per
+    sensor (sensor.0, sensor.1, ... for multi-dimensional sensors).
+    Returns (times, values) with values laid out in the given slots.
+    """
+    with open(fname) as f:
+        header = [name.strip() for name in f.readline().split(',')]
+    data = np.loadtxt(fname, delimiter=',', skiprows=1, ndmin=2)
+    values = np.zeros((len(data), width))
+    times = None
+    for column, name in enumerate(header):
+        if name=="time":
+            times = data[:, column]
+            continue
+        sensor, dot, dim = name.partition('.')
+        if sensor not in slots:
+            continue
+        values[:, slots[sensor].start + (int(dim) if dim else 0)] = data[:, column]
+    if times is None:
+        raise ValueError('Recording "%s" has no time column' % fname)
+    return times, values
+
+def load_truth(fname):
+    """
+    Reads annotated events from YAML: a list of {time, event, [fsm], [external]}.
+    Ground-truth events are FSM output events (as returned by SharedControl.update).
+    External events (e.g. grasp_complete from the actuator) are not scored but are
+    sent to the FSMs at their time, as they were during the recording.
+    """
+    with open(fname) as f:
+        return yaml.load(f) or []
+
+class FSMTable(object):
+    """
+    The transitions of one FSM spec as arrays, so many copies of the FSM (one per
+    configuration) can be stepped at once. Mirrors fysom and fsm.FSM: an event that
+    is not allowed in the current state is ignored; callbacks emit output events
+    in the order before, exit, enter (or reenter), after.
+    """
+    def __init__(self, spec):
+        events = spec["events"]
+        callbacks = spec.get("state_callbacks", {}) or {}
+        states = set([spec["initial"]])
+        for ev in events.itervalues():
+            src = ev.get("src", "*")
+            states.update([src] if isinstance(src, basestring) else src)
+            states.add(ev["dst"])
+        states.discard("*")
+        states.discard("=")
+        self.states = sorted(states)
+        self.index = dict((state, k) for k, state in enumerate(self.states))
+        self.initial = self.index[spec["initial"]]
+
+        # event -> (next state per state, -1 if not allowed; output events per state)
+        self.events = {}
+        for name, ev in events.iteritems():
+            src = ev.get("src", "*")
+            src = [src] if isinstance(src, basestring) else src
+            next_state = -np.ones(len(self.states), dtype=np.intp)
+            emitted = [[] for state in self.states]
+            for k, state in enumerate(self.states):
+                if state not in src and "*" not in src:
+                    continue
+                dst = state if ev["dst"]=="=" else ev["dst"]
+                next_state[k] = self.index[dst]
+                out = emitted[k]
+                if "before" in ev:
+                    out.append(ev["before"])
+                if dst!=state:
+                    if "exit" in callbacks.get(state, {}):
+                        out.append(callbacks[state]["exit"])
+                    if "enter" in callbacks.get(dst, {}):
+                        out.append(callbacks[dst]["enter"])
+                elif "reenter" in callbacks.get(dst, {}):
+                    out.append(callbacks[dst]["reenter"])
+                if "after" in ev:
+                    out.append(ev["after"])
+            self.events[name] = (next_state, emitted)
+
+class Sweep(object):
+    """
+    Evaluates many parameter configurations of a model over one recording.
+    All configurations are run together, frame by frame: encoder outputs are
+    broadcast to a (configurations, frames) array, inference is a contraction
+    of precomputed posterior tables (see posterior_tables) with one row per
+    configuration, and the FSMs are stepped as arrays of state indices.
+    """
+    def __init__(self, model_dir, times, values, names, truth=(), tolerance=0.5):
+        self.encoder = sensor_encoder.load_sensor_encoder(os.path.join(model_dir, "encoder.yaml"))
+        self.bayes_net = bayes_net.load_bayes_net(os.path.join(model_dir, "bayes_net.yaml"))
+        if self.bayes_net.temporal:
+            raise ValueError("Sweeps do not support temporal nodes (%s)" % ", ".join(self.bayes_net.temporal))
+        with open(os.path.join(model_dir, "fsms.yaml")) as f:
+            fsm_specs = yaml.load(f)
+        # same order as MultiFSM, which matters for broadcast events
+        fsms = {}
+        for name, spec in fsm_specs.iteritems():
+            fsms[name] = FSMTable(spec)
+        self.fsm_names = list(fsms)
+        self.fsms = [fsms[name] for name in self.fsm_names]
+
+        self.times = np.asarray(times, dtype=float)
+        self.values = np.asarray(values, dtype=float)
+        self.names = list(names)
+        self.tolerance = tolerance
+        self.truth = [ev for ev in truth if not ev.get("external", False)]
+        self.external = sorted([ev for ev in truth if ev.get("external", False)], key=lambda ev: ev["time"])
+
+        for name in self.names:
+            self.parameter(name)
+
+        net = self.bayes_net.compiled
+        self.tables = PosteriorTables(net, max_table_size=1<<20)
+        if self.tables.fallback:
+            raise ValueError("Outputs %s are too large to tabulate for a sweep" % ", ".join(self.tables.fallback))
+        self.entries = {}
+        for entry in self.tables.entries:
+            # one table row per code of the fsm_input values (bit j = input j)
+            m = len(entry["fsm_inputs"])
+            rows = np.zeros((1<<m, 1<<len(entry["sensors"])))
+            for assignment, table in entry["rows"].iteritems():
+                code = sum([value<<j for j, value in enumerate(assignment)])
+                rows[code] = table.ravel()
+            inputs = []
+            for i in entry["fsm_inputs"]:
+                fsm_name, state = net.names[i].split('/')
+                table = fsms[fsm_name]
+                inputs.append((self.fsm_names.index(fsm_name), table.index.get(state, -1)))
+            self.entries[entry["name"]] = {"rows": rows,
+                                           "inputs": inputs,
+                                           "sensors": [net.names[i] for i in entry["sensors"]]}
+
+    def parameter(self, name):
+        """
+        Resolves a parameter path to ('encoder', Encoder, attribute) or ('output', name)
+        """
+        parts = name.split('.')
+        if parts[0]=="encoder" and len(parts)==4:
+            sensor, target, attribute = parts[1:]
+            for t, encoder in self.encoder.sensors.get(sensor, []):
+                if t==target and hasattr(encoder.encoder, attribute):
+                    return ("encoder", encoder, attribute)
+        elif parts[0]=="output" and len(parts)==3 and parts[2]=="logp":
+            if parts[1] in self.bayes_net.outputs:
+                return ("output", parts[1])
+        raise ValueError("Unknown sweep parameter %s" % name)
+
+    def transformed(self, sensor, encoder):
+        """
+        The value each frame presents to an encoder (after any Multivariate transform)
+        """
+        slot = self.encoder.compile().slots[sensor]
+        transform = encoder.transform
+        if transform is None:
+            return self.values[:, slot.start]
+        dims = transform.dims()
+        if transform.matrix is None:
+            matrix = np.eye(dims)
+        else:
+            matrix = np.array(transform.matrix, dtype=float).reshape(dims, -1)
+        projected = np.dot(self.values[:, slot.start:slot.start+dims] - transform.centre, matrix)
+        return np.sum(projected**transform.norm, axis=1)**(1.0/transform.norm)
+
+    def encode(self, configs):
+        """
+        Sensor probabilities per target node, each (configurations or 1, frames)
+        """
+        swept = {}
+        for k, name in enumerate(self.names):
+            kind = self.parameter(name)
+            if kind[0]=="encoder":
+                swept.setdefault(id(kind[1]), {})[kind[2]] = configs[:, k:k+1]
+
+        probs = {}
+        for sensor, encoders in self.encoder.sensors.iteritems():
+            for target, encoder in encoders:
+                x = self.transformed(sensor, encoder)[None, :]
+                params = swept.get(id(encoder))
+                sub = encoder.encoder
+                if params:
+                    sub = copy.copy(sub)
+                    sub.__dict__.update(params)
+                if isinstance(sub, sensor_encoder.BinaryEncoder):
+                    p = np.where(x>0.5, sub.p, sub.no_p)
+                else:
+                    p = sub.prob(x)
+                probs[target] = 1-p if encoder.flip else p
+        return probs
+
+    def thresholds(self, configs):
+        """
+        Firing threshold per output, each (configurations,)
+        """
+        n = len(configs)
+        logps = {}
+        for name, output in self.bayes_net.outputs.iteritems():
+            logps[name] = np.zeros(n) + output["event"]["logp"]
+        for k, name in enumerate(self.names):
+            kind = self.parameter(name)
+            if kind[0]=="output":
+                logps[kind[1]] = configs[:, k]
+        caution = self.bayes_net.event_caution
+        return dict((name, 1-np.exp(logp)+caution) for name, logp in logps.iteritems())
+
+    def evaluate(self, configs):
+        """
+        Runs every configuration (a row of parameter values, in the order of names)
+        over the recording. Returns a list of {event: [times]} per configuration.
+        """
+        configs = np.atleast_2d(np.asarray(configs, dtype=float))
+        n = len(configs)
+        probs = self.encode(configs)
+        thresholds = self.thresholds(configs)
+        half = np.array([[0.5]])
+        inputs = []
+        for name, output in self.bayes_net.outputs.iteritems():
+            entry = self.entries[name]
+            sensors = [probs.get(sensor, half) for sensor in entry["sensors"]]
+            inputs.append((entry, sensors, thresholds[name], output["event"]))
+
+        states = np.zeros((n, len(self.fsms)), dtype=np.intp)
+        for f, table in enumerate(self.fsms):
+            states[:, f] = table.initial
+        fired = [{} for c in range(n)]
+        all_configs = np.ones(n, dtype=bool)
+        external = 0
+
+        for t in range(len(self.times)):
+            now = self.times[t]
+            while external<len(self.external) and self.external[external]["time"]<=now:
+                ev = self.external[external]
+                self.send(states, ev.get("fsm"), ev["event"], all_configs, fired, now)
+                external += 1
+
+            # infer every output against the FSM states at the start of the frame
+            firing = []
+            for entry, sensors, threshold, ev in inputs:
+                code = np.zeros(n, dtype=np.intp)
+                for j, (f, state) in enumerate(entry["inputs"]):
+                    code += (states[:, f]==state).astype(np.intp) << j
+                v = entry["rows"][code]
+                for p in reversed(sensors):
+                    column = p[:, t]
+                    v = v.reshape(n, -1, 2)
+                    v = v[:, :, 0] + (v[:, :, 1]-v[:, :, 0])*column[:, None]
+                firing.append((ev, v.reshape(n)>threshold))
+
+            for ev, mask in firing:
+                if mask.any():
+                    self.send(states, ev.get("fsm"), ev["event"], mask, fired, now)
+        return fired
+
+    def send(self, states, fsm_name, event, mask, fired, now):
+        """
+        Sends an event to the configurations in mask, as MultiFSM.send does
+        (a broadcast stops at the first FSM that accepts the event)
+        """
+        if fsm_name is None:
+            targets = range(len(self.fsms))
+        else:
+            targets = [self.fsm_names.index(fsm_name)]
+        pending = mask.copy()
+        for f in targets:
+            table = self.fsms[f]
+            if event not in table.events:
+                continue
+            next_state, emitted = table.events[event]
+            current = states[:, f]
+            step = next_state[current]
+            accepted = pending & (step>=0)
+            for state in np.unique(current[accepted]):
+                if emitted[state]:
+                    for c in np.nonzero(accepted & (current==state))[0]:
+                        for out in emitted[state]:
+                            fired[c].setdefault(out, []).append(now)
+            states[accepted, f] = step[accepted]
+            pending &= ~accepted
+
+    def score(self, fired):
+        """
+        Matches one configuration's events against the ground truth: each annotated
+        event pairs with the earliest unmatched event of the same name within
+        tolerance seconds. Returns counts and latencies (fired - annotated time).
+        """
+        hits = 0
+        latencies = []
+        used = {}
+        for ev in sorted(self.truth, key=lambda ev: ev["time"]):
+            times = fired.get(ev["event"], [])
+            taken = used.setdefault(ev["event"], set())
+            for k, t in enumerate(times):
+                if k not in taken and abs(t-ev["time"])<=self.tolerance:
+                    taken.add(k)
+                    hits += 1
+                    latencies.append(t-ev["time"])
+                    break
+        total = sum([len(times) for times in fired.itervalues()])
+        return {"events": total,
+                "counts": dict((name, len(times)) for name, times in fired.iteritems()),
+                "hits": hits,
+                "misses": len(self.truth)-hits,
+                "false_alarms": total-hits,
+                "mean_latency": float(np.mean(latencies)) if latencies else None,
+                "max_latency": float(np.max(np.abs(latencies))) if latencies else None}
+
+    def run(self, configs):
+        """
+        Evaluates and scores configurations; returns one result dict per row
+        """
+        results = []
+        for row, fired in zip(configs, self.evaluate(configs)):
+            result = self.score(fired)
+            result["params"] = dict(zip(self.names, [float(v) for v in row]))
+            result["times"] = fired
+            results.append(result)
+        return results
+
+# per-process sweep, set up once by the pool initializer
+_sweep = None
+
+def init_worker(args):
+    global _sweep
+    _sweep = Sweep(*args)
+
+def run_chunk(configs):
+    return _sweep.run(configs)
+
+def run_sweep(model_dir, times, values, grid, truth=(), tolerance=0.5, processes=None, chunk_size=64):
+    """
+    Evaluates every point of a parameter grid over a recording, spread over a
+    process pool. Returns the result dicts in grid order.
+    """
+    names, configs = expand_grid(grid)
+    args = (model_dir, times, values, names, truth, tolerance)
+    chunks = [configs[k:k+chunk_size] for k in range(0, len(configs), chunk_size)]
+    start = time.time()
+    if processes==1:
+        init_worker(args)
+        results = map(run_chunk, chunks)
+    else:
+        pool = Pool(processes, init_worker, (args,))
+        try:
+            results = pool.map(run_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    results = [result for chunk in results for result in chunk]
+    logger.info(json.dumps({'type': 'sweep', 'configurations': len(results), 'frames': len(times),
+                            'elapsed': time.time()-start}))
+    return results
+
+def write_results(fname, results):
+    """
+    Writes one CSV row per configuration: parameters, then the scores
+    """
+    if not results:
+        return
+    names = sorted(results[0]["params"])
+    columns = ["events", "hits", "misses", "false_alarms", "mean_latency", "max_latency"]
+    with open(fname, 'w') as f:
+        f.write(",".join(names + columns) + "\n")
+        for result in results:
+            row = [result["params"][name] for name in names] + [result[column] for column in columns]
+            f.write(",".join(["" if v is None else str(v) for v in row]) + "\n")
+
+def best(results, n=10):
+    """
+    The n configurations with fewest misses + false alarms, then lowest latency
+    """
+    def key(result):
+        latency = result["max_latency"]
+        return (result["misses"]+result["false_alarms"], float('inf') if latency is None else latency)
+    return sorted(results, key=key)[:n]
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Sweep encoder and output parameters over a recording")
+    parser.add_argument("model_dir", nargs="?", default="demo_model")
+    parser.add_argument("--recording", help="CSV recording (time column, then one column per sensor)")
+    parser.add_argument("--truth", help="YAML list of annotated events")
+    parser.add_argument("--grid", help="YAML dict of parameter path -> list of values")
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--out", default="sweep_results.csv")
+    args = parser.parse_args()
+
+    encoder = sensor_encoder.load_sensor_encoder(os.path.join(args.model_dir, "encoder.yaml"))
+    compiled = encoder.compile()
+    if args.recording:
+        times, values = load_recording(args.recording, compiled.slots, compiled.width)
+        truth = load_truth(args.truth) if args.truth else []
+        with open(args.grid) as f:
+            grid = yaml.load(f)
+    else:
+        # synthetic demo: a shoulder jerk every 2s while pressure stays low
+        times = np.arange(0, 10, 0.02)
+        values = np.zeros((len(times), compiled.width))
+        values[:, compiled.slots["pressure"].start] = 0.1
+        jerks = (times % 2.0)<0.1
+        values[:, compiled.slots["shoulder_acc"].start] = np.where(jerks, 2.0, 0.0)
+        truth = [{"time": 0.0, "event": "fes_grasp"}]
+        grid = {"encoder.shoulder_acc.shoulder_jerked.threshold": np.linspace(0.2, 1.5, 20),
+                "encoder.shoulder_acc.shoulder_jerked.softness": np.linspace(1, 40, 20),
+                "encoder.pressure.gripped.softness": [1, 10, 20],
+                "output.send_grasp.logp": np.linspace(-3, -0.5, 6)}
+
+    results = run_sweep(args.model_dir, times, values, grid, truth, args.tolerance, args.processes)
+    write_results(args.out, results)
+    for result in best(results, 5):
+        print(result["params"], result["hits"], result["misses"], result["false_alarms"], result["mean_latency"])
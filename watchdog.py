@@ -0,0 +1,209 @@
+import cPickle
+import thread
+import traceback
+import gc
+import json, time
+import os, sys
+from threading import Thread, Lock
+from Queue import Queue, Empty
+import config, logutil
+from shared import Timings
+
+logger = logutil.get_logger('watchdog')
+
+class SpikeRing(object):
+    """
+    Spike reports on disk, as numbered pickle files in one directory, keeping
+    only the newest max_reports. Numbering carries on from the files already there.
+    """
+    def __init__(self, path=None, max_reports=100):
+        self.path = config.SPIKE_DIR if path is None else path
+        self.max_reports = max_reports
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        numbers = self.numbers()
+        self.next = numbers[-1]+1 if numbers else 0
+
+    def numbers(self):
+        numbers = []
+        for name in os.listdir(self.path):
+            if name.startswith("spike_") and name.endswith(".pkl"):
+                numbers.append(int(name[6:-4]))
+        return sorted(numbers)
+
+    def fname(self, n):
+        return os.path.join(self.path, "spike_%08d.pkl" % n)
+
+    def write(self, report):
+        fname = self.fname(self.next)
+        with open(fname + ".tmp", 'wb') as f:
+            cPickle.dump(report, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(fname + ".tmp", fname)
+        self.next += 1
+        for n in self.numbers()[:-self.max_reports]:
+            os.remove(self.fname(n))
+        return fname
+
+    def reports(self):
+        """
+        File names of the reports on disk, oldest first
+        """
+        return [self.fname(n) for n in self.numbers()]
+
+def load_report(fname):
+    with open(fname, 'rb') as f:
+        return cPickle.load(f)
+
+def replay_report(shared, report):
+    """
+    Re-runs a spike's frame on a SharedControl of the same model: restores the
+    state from just before it and feeds the same sensor input. Returns the events.
+    """
+    shared.restore(report["snapshot"])
+    if report["values"] is not None:
+        return shared.update_values(report["values"])
+    return shared.update(report["sensors"])
+
+class SpikeWatchdog(Thread):
+    """
+    Watches SharedControl.update latency. update() here runs a frame as usual,
+    with the stage timings recorded (see SharedControl.mark); while a frame is
+    running past its budget, this thread samples the stack of the thread
+    running it every sample_interval seconds. A frame that ends over budget
+    is written to a SpikeRing as a report: latency, stage timings, the stack
+    samples, GC counts, the sensor input and the FSM states, and a snapshot
+    of the state before the frame so replay_report() can re-run it.
+    The snapshot is taken before every frame, which costs some time per frame;
+    capture_state=False leaves it (and replay) out.
+    """
+    def __init__(self, shared, budget=0.005, sample_interval=0.0005, max_samples=200,
+                 path=None, max_reports=100, capture_state=True):
+        Thread.__init__(self)
+        self.daemon = True
+        self.shared = shared
+        self.budget = budget
+        self.sample_interval = sample_interval
+        self.max_samples = max_samples
+        self.capture_state = capture_state
+        self.ring = SpikeRing(path, max_reports)
+        self.pending = Queue()
+        self.lock = Lock()
+        # the frame in progress: start time, thread id and stack samples
+        self.frame = None
+        self.done = False
+
+        # counters
+        self.frames = 0
+        self.spikes = 0
+        self.max_latency = 0.0
+        self.samples_taken = 0
+
+    def update(self, sensor_dict):
+        return self.run_frame(sensor_dict, None)
+
+    def update_values(self, values):
+        return self.run_frame(None, values)
+
+    def run_frame(self, sensor_dict, values):
+        shared = self.shared
+        snapshot = shared.snapshot() if self.capture_state else None
+        states = shared.fsms.all_state()
+        gc_before = gc.get_count()
+        shared.timings = Timings()
+        start = time.time()
+        frame = {"start": start, "thread": thread.get_ident(), "samples": []}
+        with self.lock:
+            self.frame = frame
+        try:
+            if values is not None:
+                events = shared.update_values(values)
+            else:
+                events = shared.update(sensor_dict)
+        finally:
+            end = time.time()
+            with self.lock:
+                self.frame = None
+            timings, shared.timings = shared.timings, None
+
+        latency = end-start
+        self.frames += 1
+        self.max_latency = max(self.max_latency, latency)
+        if latency>self.budget:
+            self.spikes += 1
+            stages = []
+            last = start
+            for stage, t in timings:
+                stages.append((stage, t-last))
+                last = t
+            stages.append(("return", end-last))
+            self.pending.put({"time": start, "latency": latency, "budget": self.budget,
+                              "stages": stages, "samples": frame["samples"],
+                              "gc_before": gc_before, "gc_after": gc.get_count(),
+                              "sensors": None if sensor_dict is None else dict(sensor_dict),
+                              "values": None if values is None else values.copy(),
+                              "fsm_states": states, "events": events,
+                              "snapshot": snapshot, "model": shared.model_dir})
+        return events
+
+    def run(self):
+        while not self.done:
+            time.sleep(self.sample_interval)
+            with self.lock:
+                frame = self.frame
+            if frame is not None and time.time()-frame["start"]>self.budget and \
+                    len(frame["samples"])<self.max_samples:
+                stack = sys._current_frames().get(frame["thread"])
+                if stack is not None:
+                    frame["samples"].append((time.time()-frame["start"], traceback.extract_stack(stack)))
+                    self.samples_taken += 1
+            elif frame is None:
+                # write reports between frames, off the control thread
+                self.write_pending()
+
+    def write_pending(self):
+        while True:
+            try:
+                report = self.pending.get_nowait()
+            except Empty:
+                return
+            fname = self.ring.write(report)
+            logger.warn(json.dumps({'type': 'latency_spike', 'latency': report["latency"],
+                                    'budget': report["budget"], 'stages': report["stages"],
+                                    'samples': len(report["samples"]), 'report': fname}))
+
+    def stats(self):
+        return {'type': 'watchdog_stats', 'frames': self.frames, 'spikes': self.spikes,
+                'max_latency': self.max_latency, 'samples': self.samples_taken}
+
+    def stop(self):
+        self.done = True
+        self.join()
+        self.write_pending()
+
+def summarise(report, depth=3):
+    """
+    The stack samples of a report, counted by their innermost depth frames
+    """
+    counts = {}
+    for elapsed, stack in report["samples"]:
+        key = tuple(["%s:%d %s" % (os.path.basename(f), line, fn) for f, line, fn, text in stack[-depth:]])
+        counts[key] = counts.get(key, 0) + 1
+    return sorted(counts.items(), key=lambda item: -item[1])
+
+if __name__=="__main__":
+    import random, shared
+    s = shared.SharedControl(sys.argv[1] if len(sys.argv)>1 else "demo_model")
+    watchdog = SpikeWatchdog(s, budget=0.004)
+    watchdog.start()
+    for i in range(500):
+        watchdog.update({"pressure": random.random(), "shoulder_acc": 250.0*random.random()})
+    watchdog.stop()
+    print(json.dumps(watchdog.stats()))
+    for fname in watchdog.ring.reports()[-3:]:
+        report = load_report(fname)
+        print('%s: %.1f ms, stages %s' % (fname, 1000*report["latency"],
+                                          ", ".join(["%s %.1f" % (stage, 1000*t) for stage, t in report["stages"]])))
+        for frames, count in summarise(report)[:3]:
+            print('    %3d  %s' % (count, " < ".join(reversed(frames))))
+        replayed = replay_report(shared.SharedControl(report["model"]), report)
+        print('    replayed events %s, recorded %s' % (replayed, report["events"]))